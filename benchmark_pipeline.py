@@ -0,0 +1,535 @@
+import argparse
+import contextlib
+import gc
+import io
+import json
+import os
+import platform
+import resource
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timezone
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+# Stage benchmarks on synthetic inputs.
+#
+# Every stage is timed over a sweep of input sizes and run once more under
+# tracemalloc for its peak allocation. Results are written as JSON; passing a
+# previous results file as --baseline flags any (stage, size) whose wall time
+# or peak allocation grew by more than the tolerance, and exits non-zero so the
+# harness can gate a change before it reaches a basin-wide run.
+#
+#   python benchmark_pipeline.py --profile quick
+#   python benchmark_pipeline.py --profile quick --baseline gis_outputs/benchmarks/benchmark_quick.json
+
+SYNTHETIC_CRS = "EPSG:32722"
+SYNTHETIC_ORIGIN = (300000.0, 8760000.0) # Upper Xingu, UTM 22S
+TILE_SIZE_M = 1000.0
+
+# Sizes per stage; the unit of each stage is listed in STAGE_UNITS
+SWEEPS = {
+    'quick': {
+        'segment_river_network': [100, 1_000],
+        'get_laz_bounds_and_crs': [10, 50],
+        'scan_lidar_tiles': [10, 50],
+        'aggregate_tiles_by_bbox': [100, 1_000],
+        'load_tile_inventory': [10, 1_000, 10_000],
+        'select_tiles_for_corridor': [10, 1_000, 10_000],
+        'write_geojson': [100, 1_000],
+        'write_geotable': [100, 1_000],
+        'write_geotable_partitioned': [100, 1_000],
+        'iter_point_chunks': [100_000, 1_000_000],
+        'filter_block': [512, 1024],
+        'render_coverage': [100, 3_150],
+    },
+    'full': {
+        'segment_river_network': [100, 1_000, 10_000],
+        'get_laz_bounds_and_crs': [10, 100, 500],
+        'scan_lidar_tiles': [10, 100, 500],
+        'aggregate_tiles_by_bbox': [100, 1_000, 10_000, 100_000],
+        'load_tile_inventory': [10, 1_000, 10_000, 100_000],
+        'select_tiles_for_corridor': [10, 1_000, 10_000, 100_000],
+        'write_geojson': [100, 1_000, 10_000],
+        'write_geotable': [100, 1_000, 10_000],
+        'write_geotable_partitioned': [100, 1_000, 10_000],
+        'iter_point_chunks': [100_000, 1_000_000, 10_000_000],
+        'filter_block': [512, 1024, 2048],
+        'render_coverage': [100, 3_150, 100_000],
+    },
+}
+
+STAGE_UNITS = {
+    'segment_river_network': 'river_km',
+    'get_laz_bounds_and_crs': 'tiles',
+    'scan_lidar_tiles': 'tiles',
+    'aggregate_tiles_by_bbox': 'tiles',
+    'load_tile_inventory': 'inventory_rows',
+    'select_tiles_for_corridor': 'inventory_rows',
+    'write_geojson': 'segments',
+    'write_geotable': 'segments',
+    'write_geotable_partitioned': 'segments',
+    'iter_point_chunks': 'points',
+    'filter_block': 'block_edge_cells',
+    'render_coverage': 'tiles',
+}
+
+DEFAULT_TOLERANCE = 0.25
+MIN_WALL_DELTA_S = 0.02 # Ignore regressions smaller than timer noise
+MIN_PEAK_DELTA_MB = 1.0
+
+
+# --- Synthetic inputs ---
+
+def make_synthetic_laz(path, n_points, bounds, crs_epsg=SYNTHETIC_CRS, ground_fraction=0.3, seed=0):
+    """
+    Writes a LAS 1.4 / point format 6 tile of random points inside bounds.
+
+    Ground returns (class 2) follow a gentle slope; the rest sit 5-30 m above
+    it as canopy. A .laz suffix gives a compressed file.
+
+    Args:
+        path (str): Output .las/.laz path.
+        n_points (int): Number of points.
+        bounds (tuple): (minx, miny, maxx, maxy) in crs_epsg.
+        crs_epsg (str, optional): CRS written as a WKT record; None writes no CRS.
+        ground_fraction (float): Share of points classified as ground.
+        seed (int): Random seed.
+
+    Returns:
+        str: path
+    """
+    import laspy
+    from pyproj import CRS
+
+    rng = np.random.default_rng(seed)
+    minx, miny, maxx, maxy = bounds
+    header = laspy.LasHeader(point_format=6, version="1.4")
+    header.scales = [0.01, 0.01, 0.01]
+    header.offsets = [minx, miny, 0.0]
+    if crs_epsg:
+        header.add_crs(CRS.from_user_input(crs_epsg))
+
+    x = rng.uniform(minx, maxx, n_points)
+    y = rng.uniform(miny, maxy, n_points)
+    ground_z = 250.0 + 0.002 * (x - minx) + 0.001 * (y - miny)
+    ground = rng.random(n_points) < ground_fraction
+    las = laspy.LasData(header)
+    las.x = x
+    las.y = y
+    las.z = np.where(ground, ground_z, ground_z + rng.uniform(5.0, 30.0, n_points))
+    las.classification = np.where(ground, 2, 1).astype(np.uint8)
+    las.write(path)
+    return path
+
+
+def make_tile_grid(n_tiles, origin=SYNTHETIC_ORIGIN, tile_size_m=TILE_SIZE_M):
+    """
+    Lays n_tiles square tiles out row by row in a near-square grid.
+
+    Returns:
+        numpy.ndarray: (n_tiles, 4) array of minx, miny, maxx, maxy.
+    """
+    cols = int(np.ceil(np.sqrt(n_tiles)))
+    idx = np.arange(n_tiles)
+    minx = origin[0] + (idx % cols) * tile_size_m
+    miny = origin[1] + (idx // cols) * tile_size_m
+    return np.column_stack([minx, miny, minx + tile_size_m, miny + tile_size_m])
+
+
+def make_synthetic_tiles(out_dir, n_tiles, points_per_tile=10_000, crs_cycle=(SYNTHETIC_CRS, None), seed=0):
+    """
+    Writes a grid of synthetic .laz tiles, cycling the header CRS through crs_cycle.
+
+    The default cycle leaves every other tile without a CRS record, so both
+    the header-CRS and the assumed-CRS paths of the matching stage are timed
+    (the scan stage passes assumed_tile_crs=SYNTHETIC_CRS for the latter).
+
+    Returns:
+        list: Paths of the written tiles, in grid order.
+    """
+    os.makedirs(out_dir, exist_ok=True)
+    paths = []
+    for i, bounds in enumerate(make_tile_grid(n_tiles)):
+        path = os.path.join(out_dir, f"SYN_T{i:06d}.laz")
+        if not os.path.exists(path):
+            make_synthetic_laz(path, points_per_tile, tuple(bounds), crs_cycle[i % len(crs_cycle)], seed=seed + i)
+        paths.append(path)
+    return paths
+
+
+def make_synthetic_rivers(total_length_km, n_rivers=None, origin=SYNTHETIC_ORIGIN, crs=SYNTHETIC_CRS,
+                          vertex_spacing_m=50.0, seed=0):
+    """
+    Builds meandering river polylines with a vertex every vertex_spacing_m.
+
+    Args:
+        total_length_km (float): Combined straight-line length of all rivers.
+        n_rivers (int, optional): Number of rivers. Defaults to one per 100 km.
+        origin (tuple): Start of the first river.
+        crs (str): CRS of the output.
+        vertex_spacing_m (float): Distance between vertices along x.
+        seed (int): Random seed for meander amplitude and wavelength.
+
+    Returns:
+        geopandas.GeoDataFrame: 'river_id' and LineString geometry.
+    """
+    rng = np.random.default_rng(seed)
+    n_rivers = n_rivers or max(1, int(np.ceil(total_length_km / 100.0)))
+    length_m = total_length_km * 1000.0 / n_rivers
+    t = np.arange(0.0, length_m + vertex_spacing_m, vertex_spacing_m)
+    lines = []
+    for i in range(n_rivers):
+        amplitude = rng.uniform(200.0, 800.0)
+        wavelength = rng.uniform(2000.0, 6000.0)
+        x = origin[0] + t
+        y = origin[1] + i * 3 * amplitude + amplitude * np.sin(2 * np.pi * t / wavelength)
+        lines.append(shapely.linestrings(x, y))
+    return gpd.GeoDataFrame({'river_id': np.arange(n_rivers)}, geometry=lines, crs=crs)
+
+
+def make_synthetic_inventory(n_tiles, tile_size_deg=0.01, origin=SYNTHETIC_ORIGIN, crs=SYNTHETIC_CRS):
+    """
+    Builds a tile inventory table with the columns of cms_brazil_lidar_tile_inventory.csv.
+
+    The grid starts at the same place as make_tile_grid and make_synthetic_rivers,
+    so synthetic corridors intersect the inventory.
+
+    Returns:
+        pandas.DataFrame
+    """
+    from reprojection import get_transformer
+    lonlat_origin = get_transformer(crs, "EPSG:4326").transform(*origin)
+    cols = int(np.ceil(np.sqrt(n_tiles)))
+    idx = np.arange(n_tiles)
+    min_lon = lonlat_origin[0] + (idx % cols) * tile_size_deg
+    min_lat = lonlat_origin[1] + (idx // cols) * tile_size_deg
+    return pd.DataFrame({
+        'filename': [f"SYN_T{i:06d}.laz" for i in idx],
+        'max_lat': min_lat + tile_size_deg,
+        'min_lat': min_lat,
+        'max_lon': min_lon + tile_size_deg,
+        'min_lon': min_lon,
+        'file_type': 'pointcloud',
+        'file_size_mb': 50.0,
+        'file_format': 'LAS/LAZ',
+        'version': 1.4,
+        'created': '1/2024',
+        'utmzone': '22S',
+        'srs': '+proj=utm +zone=22 +south +datum=WGS84 +units=m +no_defs ',
+    })
+
+
+def make_synthetic_dem(size, n_features=20, seed=0):
+    """
+    Builds a size x size float32 DTM: a gentle slope with noise, mounds, ring ditches and a data gap.
+
+    Returns:
+        numpy.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    yy, xx = np.mgrid[0:size, 0:size].astype(np.float32)
+    dem = 300.0 + 0.01 * xx + rng.normal(0.0, 0.15, (size, size)).astype(np.float32)
+    for k in range(n_features):
+        cy, cx = rng.uniform(0, size, 2)
+        distance = np.hypot(yy - cy, xx - cx)
+        if k % 2:
+            dem -= 1.5 * np.exp(-((distance - rng.choice([20, 40, 60])) / 3.0) ** 2)
+        else:
+            dem += np.exp(-(distance / rng.choice([4, 8, 15])) ** 2)
+    dem[size // 10:size // 5, size // 4:size // 2] = np.nan
+    return dem
+
+
+# --- Measurement ---
+
+def _max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == "darwin" else rss / 1024.0 # bytes on macOS, KiB on Linux
+
+
+def measure(fn, repeat=3):
+    """
+    Times fn() and records its peak Python/NumPy allocation.
+
+    Timing runs are separate from the tracemalloc run, which slows
+    allocation-heavy code down. Output printed by fn is discarded.
+
+    Args:
+        fn (callable): Zero-argument stage runner.
+        repeat (int): Number of timed runs.
+
+    Returns:
+        dict: wall_s (best), wall_s_median, cpu_s (best), peak_alloc_mb, max_rss_mb
+    """
+    walls, cpus = [], []
+    sink = io.StringIO()
+    for _ in range(repeat):
+        gc.collect()
+        wall0, cpu0 = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(sink):
+            fn()
+        walls.append(time.perf_counter() - wall0)
+        cpus.append(time.process_time() - cpu0)
+        sink.seek(0)
+        sink.truncate()
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        with contextlib.redirect_stdout(sink):
+            fn()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'wall_s': min(walls),
+        'wall_s_median': float(np.median(walls)),
+        'cpu_s': min(cpus),
+        'peak_alloc_mb': peak / 1e6,
+        'max_rss_mb': _max_rss_mb(),
+    }
+
+
+# --- Stage runners: each returns a zero-argument callable for one size ---
+
+def _stage_segment_river_network(size, workdir):
+    from define_river_corridor import segment_river_network
+    rivers = make_synthetic_rivers(size)
+    return lambda: segment_river_network(rivers, segment_length_m=1000, river_id_column='river_id')
+
+
+def _stage_get_laz_bounds_and_crs(size, workdir):
+    from match_lidar_to_segments import get_laz_bounds_and_crs
+    paths = make_synthetic_tiles(os.path.join(workdir, "tiles"), size)
+    return lambda: [get_laz_bounds_and_crs(p) for p in paths]
+
+
+def _stage_scan_lidar_tiles(size, workdir):
+    from match_lidar_to_segments import scan_lidar_tiles
+    tile_dir = os.path.join(workdir, "tiles")
+    names = [os.path.basename(p) for p in make_synthetic_tiles(tile_dir, size)]
+    # The header-less half of the grid takes its CRS from assumed_tile_crs, as real runs take it from the inventory
+    return lambda: scan_lidar_tiles(tile_dir, SYNTHETIC_CRS, use_catalog=False, tile_names=names,
+                                    assumed_tile_crs=SYNTHETIC_CRS)
+
+
+def _stage_aggregate_tiles_by_bbox(size, workdir):
+    from define_river_corridor import segment_river_network
+    from match_lidar_to_segments import aggregate_tiles_by_bbox
+    bounds = make_tile_grid(size)
+    lidar_gdf = gpd.GeoDataFrame({
+        'file_path': [f"SYN_T{i:06d}.laz" for i in range(size)],
+        'point_count': 10_000,
+    }, geometry=shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3]), crs=SYNTHETIC_CRS)
+    # Enough river to cross the whole grid several times
+    grid_km = np.sqrt(size) * TILE_SIZE_M / 1000.0
+    rivers = make_synthetic_rivers(grid_km * max(1, int(np.sqrt(size)) // 3),
+                                   n_rivers=max(1, int(np.sqrt(size)) // 3))
+    segments = segment_river_network(rivers, segment_length_m=1000, river_id_column='river_id')
+    return lambda: aggregate_tiles_by_bbox(segments, lidar_gdf)
+
+
+def _inventory_csv(size, workdir):
+    path = os.path.join(workdir, f"inventory_{size}.csv")
+    if not os.path.exists(path):
+        make_synthetic_inventory(size).to_csv(path, index=False)
+    return path
+
+
+def _stage_load_tile_inventory(size, workdir):
+    from lidar_inventory import load_tile_inventory
+    path = _inventory_csv(size, workdir)
+    return lambda: load_tile_inventory(path)
+
+
+def _stage_select_tiles_for_corridor(size, workdir):
+    from lidar_inventory import load_tile_inventory, select_tiles_for_corridor
+    inventory_gdf = load_tile_inventory(_inventory_csv(size, workdir))
+    corridor = make_synthetic_rivers(50).buffer(2500)
+    return lambda: select_tiles_for_corridor(corridor, inventory_gdf)
+
+
+def _synthetic_matched_segments(size):
+    from define_river_corridor import segment_river_network
+    segments = segment_river_network(make_synthetic_rivers(size), segment_length_m=1000, river_id_column='river_id')
+    segments['lidar_file_paths'] = [[f"SYN_T{i:06d}.laz", f"SYN_T{i + 1:06d}.laz"] for i in range(len(segments))]
+    return segments
+
+
+def _stage_write_geojson(size, workdir):
+    segments = _synthetic_matched_segments(size)
+    out_path = os.path.join(workdir, f"segments_{size}.geojson")
+    return lambda: segments.to_file(out_path, driver="GeoJSON")
+
+
+def _stage_write_geotable(size, workdir):
+    from geo_io import write_geotable
+    segments = _synthetic_matched_segments(size)
+    out_path = os.path.join(workdir, f"segments_{size}.parquet")
+    return lambda: write_geotable(segments, out_path)
+
+
+def _stage_write_geotable_partitioned(size, workdir):
+    from geo_io import write_geotable
+    segments = _synthetic_matched_segments(size)
+    out_path = os.path.join(workdir, f"segments_{size}_by_river.parquet")
+    return lambda: write_geotable(segments, out_path, partition_by='river_id')
+
+
+def _stage_iter_point_chunks(size, workdir):
+    from point_stream import iter_point_chunks
+    path = os.path.join(workdir, f"points_{size}.laz")
+    if not os.path.exists(path):
+        make_synthetic_laz(path, size, make_tile_grid(1)[0])
+    return lambda: sum(len(chunk['x']) for chunk in iter_point_chunks(path))
+
+
+def _stage_filter_block(size, workdir):
+    from morphometric_detector import DEFAULT_DETECTOR_PARAMS, filter_block
+    dem = make_synthetic_dem(size)
+    return lambda: filter_block(dem, DEFAULT_DETECTOR_PARAMS, 1.0)
+
+
+def _stage_render_coverage(size, workdir):
+    from coverage_render import render_coverage
+    from define_river_corridor import segment_river_network
+    bounds = make_tile_grid(size)
+    grid_km = np.sqrt(size) * TILE_SIZE_M / 1000.0
+    rivers = make_synthetic_rivers(grid_km * max(1, int(np.sqrt(size)) // 3),
+                                   n_rivers=max(1, int(np.sqrt(size)) // 3))
+    segments = segment_river_network(rivers, segment_length_m=1000, river_id_column='river_id')
+    out_path = os.path.join(workdir, f"coverage_{size}.png")
+    return lambda: render_coverage(segments.geometry.values, bounds, out_path)
+
+
+STAGES = {
+    'segment_river_network': _stage_segment_river_network,
+    'get_laz_bounds_and_crs': _stage_get_laz_bounds_and_crs,
+    'scan_lidar_tiles': _stage_scan_lidar_tiles,
+    'aggregate_tiles_by_bbox': _stage_aggregate_tiles_by_bbox,
+    'load_tile_inventory': _stage_load_tile_inventory,
+    'select_tiles_for_corridor': _stage_select_tiles_for_corridor,
+    'write_geojson': _stage_write_geojson,
+    'write_geotable': _stage_write_geotable,
+    'write_geotable_partitioned': _stage_write_geotable_partitioned,
+    'iter_point_chunks': _stage_iter_point_chunks,
+    'filter_block': _stage_filter_block,
+    'render_coverage': _stage_render_coverage,
+}
+
+
+def run_benchmarks(profile="quick", workdir=None, stages=None, repeat=3):
+    """
+    Runs every stage of a sweep profile and collects the measurements.
+
+    Args:
+        profile (str): Key of SWEEPS.
+        workdir (str, optional): Where synthetic inputs are written. A temporary
+            directory is used (and removed) if omitted.
+        stages (iterable, optional): Subset of stage names to run.
+        repeat (int): Timed runs per (stage, size).
+
+    Returns:
+        dict: {'created', 'profile', 'environment', 'results': [...]} ready for json.dump.
+    """
+    sweep = SWEEPS[profile]
+    stages = list(stages) if stages else list(sweep)
+    results = []
+    with contextlib.ExitStack() as stack:
+        if workdir is None:
+            workdir = stack.enter_context(tempfile.TemporaryDirectory(prefix="pipeline_bench_"))
+        os.makedirs(workdir, exist_ok=True)
+        for stage in stages:
+            for size in sweep[stage]:
+                with contextlib.redirect_stdout(io.StringIO()):
+                    fn = STAGES[stage](size, workdir)
+                metrics = measure(fn, repeat=repeat)
+                results.append({'stage': stage, 'size': size, 'unit': STAGE_UNITS[stage], **metrics})
+                print(f"{stage:<28} {size:>10,} {STAGE_UNITS[stage]:<15} "
+                      f"{metrics['wall_s']*1000:10.1f} ms  {metrics['peak_alloc_mb']:9.1f} MB peak")
+
+    return {
+        'created': datetime.now(timezone.utc).isoformat(),
+        'profile': profile,
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'numpy': np.__version__,
+            'shapely': shapely.__version__,
+            'geopandas': gpd.__version__,
+        },
+        'results': results,
+    }
+
+
+def check_regressions(results, baseline, tolerance=DEFAULT_TOLERANCE):
+    """
+    Compares two result sets and lists the (stage, size) pairs that got worse.
+
+    A pair regresses when its best wall time or its peak allocation exceeds
+    the baseline by more than `tolerance` (a fraction) and by more than the
+    absolute noise floors MIN_WALL_DELTA_S / MIN_PEAK_DELTA_MB.
+
+    Args:
+        results (dict): Output of run_benchmarks.
+        baseline (dict): An earlier output of run_benchmarks.
+        tolerance (float): Allowed relative growth, e.g. 0.25 for +25%.
+
+    Returns:
+        list: [{'stage', 'size', 'metric', 'baseline', 'current', 'ratio'}, ...]
+    """
+    previous = {(r['stage'], r['size']): r for r in baseline['results']}
+    regressions = []
+    for r in results['results']:
+        base = previous.get((r['stage'], r['size']))
+        if base is None:
+            continue
+        for metric, floor in (('wall_s', MIN_WALL_DELTA_S), ('peak_alloc_mb', MIN_PEAK_DELTA_MB)):
+            if r[metric] > base[metric] * (1 + tolerance) and r[metric] - base[metric] > floor:
+                regressions.append({
+                    'stage': r['stage'], 'size': r['size'], 'metric': metric,
+                    'baseline': base[metric], 'current': r[metric],
+                    'ratio': r[metric] / base[metric] if base[metric] else float('inf'),
+                })
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic inputs.")
+    parser.add_argument("--profile", choices=sorted(SWEEPS), default="quick")
+    parser.add_argument("--stages", nargs="*", choices=sorted(STAGES), help="Only run these stages.")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--workdir", help="Keep synthetic inputs here between runs.")
+    parser.add_argument("--output", help="Results JSON path. Defaults to gis_outputs/benchmarks/benchmark_<profile>.json.")
+    parser.add_argument("--baseline", help="Earlier results JSON to check for regressions.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    output_path = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "gis_outputs",
+                                              "benchmarks", f"benchmark_{args.profile}.json")
+    # Read the baseline first: it may be the file about to be overwritten
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    results = run_benchmarks(args.profile, workdir=args.workdir, stages=args.stages, repeat=args.repeat)
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    with open(output_path, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output_path}")
+
+    if baseline is not None:
+        regressions = check_regressions(results, baseline, args.tolerance)
+        for r in regressions:
+            print(f"REGRESSION: {r['stage']} @ {r['size']:,}: {r['metric']} {r['baseline']:.3f} -> {r['current']:.3f} ({r['ratio']:.2f}x)")
+        if regressions:
+            sys.exit(1)
+        print(f"No regressions beyond {args.tolerance:.0%} against {args.baseline}.")
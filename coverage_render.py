@@ -0,0 +1,271 @@
+import json
+import os
+import struct
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import shapely
+from instrumentation import span
+
+# Raster overview of LiDAR coverage: tile footprints and river segments burned
+# into a fixed pixel budget with NumPy, instead of drawing every polygon with
+# matplotlib (which takes minutes and GBs for the full 3,150-tile inventory).
+#
+# Footprints are accumulated as rectangles (their bounds) with a 2-D difference
+# array, so the cost is O(tiles + pixels): each pixel holds the number of tiles
+# covering it. Segments are densified to half a pixel and their vertices
+# binned. Segment pixels are drawn blue where some tile covers them and magenta
+# where none does, so coverage gaps along the river stand out at any scale.
+#
+# For large extents, render_coverage can also write a grid of zoomed-in tiles
+# (each rendered independently from the footprints and segment vertices that
+# fall inside it), listed with their bounds in a JSON sidecar.
+
+DEFAULT_MAX_PIXELS = 4_000_000
+DEFAULT_TILE_ZOOM = 8
+DEFAULT_TILE_PIXELS = 1024
+# Palette of the indexed images: background, 1, 2, 3, 4+ overlapping tiles, covered / uncovered segment
+PALETTE_RGB = np.array([
+    (255, 255, 255),
+    (253, 208, 162), (253, 174, 107), (241, 105, 19), (166, 54, 3),
+    (0, 90, 200), (220, 0, 120),
+], dtype=np.uint8)
+MAX_OVERLAP_CLASS = 4
+COVERED_SEGMENT_INDEX = 5
+UNCOVERED_SEGMENT_INDEX = 6
+
+
+def write_png(path, pixels, palette=None):
+    """
+    Writes an 8-bit PNG without a plotting library.
+
+    Args:
+        path (str): Output file.
+        pixels (numpy.ndarray): (H, W, 3) uint8 RGB, or (H, W) uint8 palette indices.
+        palette (numpy.ndarray, optional): (N, 3) uint8 colours for indexed pixels.
+    """
+    height = pixels.shape[0]
+    width = pixels.shape[1]
+    rows = np.concatenate([np.zeros((height, 1), dtype=np.uint8), pixels.reshape(height, -1)], axis=1)
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xFFFFFFFF)
+
+    color_type = 2 if palette is None else 3
+    with open(path, "wb") as f:
+        f.write(b"\x89PNG\r\n\x1a\n")
+        f.write(chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, color_type, 0, 0, 0)))
+        if palette is not None:
+            f.write(chunk(b"PLTE", np.asarray(palette, dtype=np.uint8).tobytes()))
+        f.write(chunk(b"IDAT", zlib.compress(rows.tobytes(), 6)))
+        f.write(chunk(b"IEND", b""))
+
+
+def grid_for_extent(bounds, max_pixels):
+    """
+    Square-pixel grid covering bounds with at most about max_pixels pixels.
+
+    Returns:
+        dict: 'x0', 'y_top', 'pixel_size', 'width', 'height' (row 0 is the northern edge).
+    """
+    minx, miny, maxx, maxy = bounds
+    span_x, span_y = max(maxx - minx, 1e-9), max(maxy - miny, 1e-9)
+    pixel_size = np.sqrt(span_x * span_y / max_pixels)
+    pixel_size = max(pixel_size, span_x / max_pixels, span_y / max_pixels) # Degenerate (line-like) extents
+    return {
+        'x0': float(minx), 'y_top': float(maxy), 'pixel_size': float(pixel_size),
+        'width': max(1, int(np.ceil(span_x / pixel_size))), 'height': max(1, int(np.ceil(span_y / pixel_size))),
+    }
+
+
+def rasterize_footprints(grid, footprint_bounds):
+    """
+    Number of footprints covering each pixel.
+
+    Args:
+        grid (dict): See grid_for_extent.
+        footprint_bounds (numpy.ndarray): (N, 4) minx, miny, maxx, maxy.
+
+    Returns:
+        numpy.ndarray: (height, width) int32 counts.
+    """
+    h, w, px = grid['height'], grid['width'], grid['pixel_size']
+    if len(footprint_bounds) == 0:
+        return np.zeros((h, w), dtype=np.int32)
+    # A pixel belongs to a footprint if its centre does, so abutting tiles do not double up along their edge
+    c0 = np.rint((footprint_bounds[:, 0] - grid['x0']) / px)
+    c1 = np.rint((footprint_bounds[:, 2] - grid['x0']) / px)
+    r0 = np.rint((grid['y_top'] - footprint_bounds[:, 3]) / px)
+    r1 = np.rint((grid['y_top'] - footprint_bounds[:, 1]) / px)
+    c0, r0 = np.clip(c0, 0, w - 1).astype(np.int64), np.clip(r0, 0, h - 1).astype(np.int64)
+    # Tiles smaller than a pixel still mark one
+    c1 = np.clip(np.maximum(c1, c0 + 1), 0, w).astype(np.int64)
+    r1 = np.clip(np.maximum(r1, r0 + 1), 0, h).astype(np.int64)
+    keep = (c1 > c0) & (r1 > r0)
+    c0, c1, r0, r1 = c0[keep], c1[keep], r0[keep], r1[keep]
+
+    # +1 at the top-left corner, -1 past each edge, +1 past the bottom-right; two cumsums fill the rectangles
+    stride = w + 1
+    corners = np.concatenate([r0 * stride + c0, r0 * stride + c1, r1 * stride + c0, r1 * stride + c1])
+    weights = np.concatenate([np.ones_like(c0), -np.ones_like(c0), -np.ones_like(c0), np.ones_like(c0)])
+    diff = np.bincount(corners, weights=weights, minlength=(h + 1) * stride).reshape(h + 1, stride)
+    return np.cumsum(np.cumsum(diff, axis=0), axis=1)[:h, :w].astype(np.int32)
+
+
+def rasterize_vertices(grid, xy):
+    """Pixels holding at least one of the (N, 2) vertices, as an (height, width) bool mask."""
+    h, w, px = grid['height'], grid['width'], grid['pixel_size']
+    if len(xy) == 0:
+        return np.zeros((h, w), dtype=bool)
+    cols = np.floor((xy[:, 0] - grid['x0']) / px).astype(np.int64)
+    rows = np.floor((grid['y_top'] - xy[:, 1]) / px).astype(np.int64)
+    inside = (cols >= 0) & (cols < w) & (rows >= 0) & (rows < h)
+    mask = np.zeros(h * w, dtype=bool)
+    mask[rows[inside] * w + cols[inside]] = True
+    return mask.reshape(h, w)
+
+
+def segment_vertices(segment_geometries, pixel_size):
+    """Segment coordinates densified to half a pixel, so consecutive vertices never skip a pixel."""
+    if len(segment_geometries) == 0:
+        return np.empty((0, 2))
+    return shapely.get_coordinates(shapely.segmentize(np.asarray(segment_geometries, dtype=object), pixel_size / 2.0))
+
+
+def compose_coverage_image(tile_counts, segment_mask):
+    """Classes a footprint-count grid and a segment mask into (H, W) uint8 indices into PALETTE_RGB."""
+    index = np.minimum(tile_counts, MAX_OVERLAP_CLASS).astype(np.uint8)
+    index[segment_mask] = np.where(tile_counts[segment_mask] > 0, COVERED_SEGMENT_INDEX, UNCOVERED_SEGMENT_INDEX)
+    return index
+
+
+def _render_grid(grid, footprint_bounds, segment_geometries, xy=None):
+    counts = rasterize_footprints(grid, footprint_bounds)
+    if xy is None:
+        xy = segment_vertices(segment_geometries, grid['pixel_size'])
+    segments = rasterize_vertices(grid, xy)
+    return counts, segments
+
+
+def _write_tiles(grid, footprint_bounds, segment_geometries, tile_dir, zoom, tile_pixels):
+    """Renders the extent at zoom x the overview resolution as tile_pixels-square PNGs, skipping empty tiles."""
+    os.makedirs(tile_dir, exist_ok=True)
+    px = grid['pixel_size'] / zoom
+    xy = segment_vertices(segment_geometries, px)
+    tile_m = tile_pixels * px
+    n_cols = int(np.ceil(grid['width'] * zoom / tile_pixels))
+    n_rows = int(np.ceil(grid['height'] * zoom / tile_pixels))
+    tiles = []
+    for row in range(n_rows):
+        for col in range(n_cols):
+            x0 = grid['x0'] + col * tile_m
+            y_top = grid['y_top'] - row * tile_m
+            minx, miny, maxx, maxy = x0, y_top - tile_m, x0 + tile_m, y_top
+            fp = footprint_bounds[(footprint_bounds[:, 0] < maxx) & (footprint_bounds[:, 2] > minx)
+                                  & (footprint_bounds[:, 1] < maxy) & (footprint_bounds[:, 3] > miny)]
+            pts = xy[(xy[:, 0] >= minx) & (xy[:, 0] < maxx) & (xy[:, 1] > miny) & (xy[:, 1] <= maxy)]
+            if len(fp) == 0 and len(pts) == 0:
+                continue
+            tile_grid = {'x0': x0, 'y_top': y_top, 'pixel_size': px, 'width': tile_pixels, 'height': tile_pixels}
+            counts, segments = _render_grid(tile_grid, fp, None, xy=pts)
+            name = f"{row}_{col}.png"
+            write_png(os.path.join(tile_dir, name), compose_coverage_image(counts, segments), PALETTE_RGB)
+            tiles.append({'file': name, 'row': row, 'col': col, 'bounds': [minx, miny, maxx, maxy]})
+    return {'pixel_size': px, 'tile_pixels': tile_pixels, 'rows': n_rows, 'cols': n_cols, 'tiles': tiles}
+
+
+def render_coverage(segment_geometries, footprint_bounds, output_path, crs=None, max_pixels=DEFAULT_MAX_PIXELS,
+                    tile_dir=None, tile_zoom=DEFAULT_TILE_ZOOM, tile_pixels=DEFAULT_TILE_PIXELS):
+    """
+    Renders a coverage overview PNG with a JSON georeferencing sidecar.
+
+    Args:
+        segment_geometries (array-like): Segment lines in the working CRS.
+        footprint_bounds (numpy.ndarray): (N, 4) tile bounds in the same CRS (non-rectangular
+            footprints are drawn as their bounding boxes).
+        output_path (str): Overview .png; the sidecar is written next to it as .json.
+        crs (str, optional): Recorded in the sidecar.
+        max_pixels (int): Pixel budget of the overview.
+        tile_dir (str, optional): Also write zoomed-in tiles here.
+        tile_zoom (int): Tile resolution relative to the overview.
+        tile_pixels (int): Tile edge in pixels.
+
+    Returns:
+        dict: The sidecar contents.
+    """
+    footprint_bounds = np.asarray(footprint_bounds, dtype=np.float64).reshape(-1, 4)
+    segment_geometries = np.asarray(segment_geometries, dtype=object)
+    extents = [footprint_bounds[:, :2].min(axis=0).tolist() + footprint_bounds[:, 2:].max(axis=0).tolist()] if len(footprint_bounds) else []
+    if len(segment_geometries):
+        extents.append(list(shapely.total_bounds(segment_geometries)))
+    if not extents:
+        print("Nothing to render: no segments and no tile footprints.")
+        return None
+    extents = np.asarray(extents)
+    bounds = (extents[:, 0].min(), extents[:, 1].min(), extents[:, 2].max(), extents[:, 3].max())
+
+    with span("render_coverage", tiles=len(footprint_bounds), segments=len(segment_geometries)):
+        grid = grid_for_extent(bounds, max_pixels)
+        counts, segments = _render_grid(grid, footprint_bounds, segment_geometries)
+        os.makedirs(os.path.dirname(os.path.abspath(output_path)), exist_ok=True)
+        write_png(output_path, compose_coverage_image(counts, segments), PALETTE_RGB)
+        meta = {
+            'crs': crs,
+            'bounds': [float(b) for b in bounds],
+            'transform': [grid['x0'], grid['pixel_size'], 0.0, grid['y_top'], 0.0, -grid['pixel_size']],
+            'width': grid['width'],
+            'height': grid['height'],
+            'tile_footprints': int(len(footprint_bounds)),
+            'segments': int(len(segment_geometries)),
+            'segment_pixels_covered': int((segments & (counts > 0)).sum()),
+            'segment_pixels_uncovered': int((segments & (counts == 0)).sum()),
+        }
+        if tile_dir:
+            with span("render_coverage_tiles"):
+                meta['tiles'] = _write_tiles(grid, footprint_bounds, segment_geometries, tile_dir, tile_zoom, tile_pixels)
+                meta['tiles']['dir'] = tile_dir
+
+    with open(os.path.splitext(output_path)[0] + ".json", "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Saved {grid['width']}x{grid['height']} coverage overview to {output_path}"
+          + (f" and {len(meta['tiles']['tiles'])} tile(s) to {tile_dir}" if tile_dir else ""))
+    return meta
+
+
+def render_coverage_in_background(segment_geometries, footprint_bounds, output_path, **kwargs):
+    """
+    Starts render_coverage on a background thread.
+
+    The inputs are copied to plain arrays first, so the caller can keep
+    modifying its GeoDataFrames while the render runs.
+
+    Returns:
+        concurrent.futures.Future: Resolves to render_coverage's result; exceptions are raised from result().
+    """
+    segment_geometries = np.array(segment_geometries, dtype=object)
+    footprint_bounds = np.array(footprint_bounds, dtype=np.float64)
+    executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="coverage_render")
+    future = executor.submit(render_coverage, segment_geometries, footprint_bounds, output_path, **kwargs)
+    executor.shutdown(wait=False)
+    return future
+
+
+if __name__ == "__main__":
+    from geo_io import read_geotable
+    from lidar_inventory import load_tile_inventory
+
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    segments_file = os.path.join(base_dir, "gis_outputs", "river_segments.parquet")
+    inventory_csv = os.path.join(base_dir, "LiDAR: northern Mato Grosso near the Upper Xingu region",
+                                 "cms_brazil_lidar_tile_inventory.csv")
+    output_file = os.path.join(base_dir, "gis_outputs", "coverage_overview.png")
+    tile_dir = os.path.join(base_dir, "gis_outputs", "coverage_tiles") # None to skip the zoom tiles
+
+    if not os.path.exists(segments_file) or not os.path.exists(inventory_csv):
+        print(f"ERROR: Need both {segments_file} and {inventory_csv}.")
+    else:
+        segments = read_geotable(segments_file)
+        inventory = load_tile_inventory(inventory_csv).to_crs(segments.crs)
+        render_coverage(segments.geometry.values, inventory.geometry.bounds.to_numpy(), output_file,
+                        crs=str(segments.crs), tile_dir=tile_dir)
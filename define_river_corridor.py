@@ -1,8 +1,103 @@
 import geopandas as gpd
+import shapely
 from shapely.geometry import LineString
-from shapely.ops import split
 import numpy as np
 import os
+from geo_io import write_geotable
+from instrumentation import span, profiled_run
+from reprojection import estimate_utm_crs
+
+# Manually defined Xingu centerline (lon, lat), used when no hydrography file is given
+DEFAULT_CENTERLINE_COORDS = [
+    (-53.446, -11.133), # Shifted eastward
+    (-53.416, -11.096)  # Shifted eastward
+]
+# DEFAULT_CENTERLINE_COORDS = [
+#     (-53.451, -11.133),
+#     (-53.421, -11.096)
+# ] # Previous attempt for core area
+# DEFAULT_CENTERLINE_COORDS = [
+#     (-53.5, -11.5),
+#     (-52.9, -10.9)
+# ] # Original longer river segment
+
+def segment_lines(lines, segment_length_m=1000):
+    """
+    Cuts many LineStrings into consecutive sub-linestrings of a given length.
+
+    Each piece keeps every original vertex between its start and end, so the
+    river's curvature is preserved. The last piece of each line holds the
+    remainder and may be shorter. Missing or empty lines and lines with fewer
+    than two coordinates are dropped with a warning. The work is done in a handful of vectorized
+    NumPy/Shapely 2 calls over all lines at once, with no per-segment Python loop.
+
+    Args:
+        lines (array-like of shapely.geometry.LineString): Lines in a projected (metre) CRS.
+        segment_length_m (float): Length of each segment in meters.
+
+    Returns:
+        tuple: (segments, line_index, start_m, end_m)
+               segments (numpy.ndarray): LineString pieces, ordered by line then distance.
+               line_index (numpy.ndarray): Position in `lines` each piece came from.
+               start_m, end_m (numpy.ndarray): Distance along the source line of each piece's ends.
+    """
+    lines = np.asarray(lines, dtype=object)
+    kept = np.flatnonzero(shapely.get_num_coordinates(lines) >= 2)
+    if len(kept) < len(lines):
+        print(f"Warning: dropping {len(lines) - len(kept)} empty or single-point line(s) before segmenting.")
+        lines = lines[kept]
+    if len(lines) == 0:
+        return np.empty(0, dtype=object), np.empty(0, dtype=np.int64), np.empty(0), np.empty(0)
+    coords, vertex_line = shapely.get_coordinates(lines, return_index=True)
+    n_lines = len(lines)
+    lengths = shapely.length(lines)
+
+    # Distance of every vertex along its own line
+    step = np.zeros(len(coords))
+    step[1:] = np.hypot(*np.diff(coords, axis=0).T)
+    first_vertex = np.searchsorted(vertex_line, np.arange(n_lines))
+    step[first_vertex[first_vertex < len(coords)]] = 0.0
+    along = np.cumsum(step)
+    along -= np.repeat(along[first_vertex], np.bincount(vertex_line, minlength=n_lines))
+
+    # A global, strictly increasing "station" lets one searchsorted serve every line
+    line_base = np.concatenate([[0.0], np.cumsum(lengths + 1.0)[:-1]])
+    station = line_base[vertex_line] + along
+
+    n_segments = np.maximum(1, np.ceil(lengths / segment_length_m).astype(np.int64))
+    line_index = np.repeat(np.arange(n_lines), n_segments)
+    k = np.arange(n_segments.sum()) - np.repeat(np.cumsum(n_segments) - n_segments, n_segments)
+    start_m = k * float(segment_length_m)
+    end_m = np.minimum(start_m + segment_length_m, lengths[line_index])
+
+    def interpolate(distances):
+        s = line_base[line_index] + distances
+        last_vertex = first_vertex[line_index] + np.bincount(vertex_line, minlength=n_lines)[line_index] - 1
+        j = np.clip(np.searchsorted(station, s, side="right") - 1, first_vertex[line_index], last_vertex - 1)
+        span = station[j + 1] - station[j]
+        t = np.divide(s - station[j], span, out=np.zeros_like(s), where=span > 0)
+        return coords[j] + t[:, None] * (coords[j + 1] - coords[j])
+
+    start_xy = interpolate(start_m)
+    end_xy = interpolate(end_m)
+
+    # Interior vertices strictly inside (start, end) of each piece
+    lo = np.searchsorted(station, line_base[line_index] + start_m, side="right")
+    hi = np.searchsorted(station, line_base[line_index] + end_m, side="left")
+    n_inner = np.maximum(hi - lo, 0)
+    n_coords = n_inner + 2
+
+    out_coords = np.empty((n_coords.sum(), 2))
+    out_index = np.repeat(np.arange(len(line_index)), n_coords)
+    offsets = np.cumsum(n_coords) - n_coords
+    out_coords[offsets] = start_xy
+    out_coords[offsets + n_coords - 1] = end_xy
+    inner_pos = np.arange(n_inner.sum()) - np.repeat(np.cumsum(n_inner) - n_inner, n_inner)
+    inner_segment = np.repeat(np.arange(len(line_index)), n_inner)
+    out_coords[offsets[inner_segment] + 1 + inner_pos] = coords[lo[inner_segment] + inner_pos]
+
+    segments = shapely.linestrings(out_coords, indices=out_index)
+    return segments, kept[line_index], start_m, end_m
 
 def segment_line(line, segment_length_m=1000):
     """
@@ -16,86 +111,150 @@ def segment_line(line, segment_length_m=1000):
     Returns:
         list: A list of Shapely LineString objects representing the segments.
     """
-    distances = np.arange(0, line.length, segment_length_m)
-    if line.length not in distances:
-        distances = np.append(distances, line.length)
-    
-    points = [line.interpolate(d) for d in distances]
-    
-    if len(points) < 2:
-        return [line]
+    segments, _, _, _ = segment_lines([line], segment_length_m=segment_length_m)
+    return list(segments)
+
+def segment_river_network(rivers_gdf, segment_length_m=1000, river_id_column=None):
+    """
+    Segments every river polyline in a GeoDataFrame into one segments table.
+
+    MultiLineStrings are exploded into their parts first; parts of the same
+    river keep its river_id and are numbered consecutively.
+
+    Args:
+        rivers_gdf (geopandas.GeoDataFrame): River centerlines in a projected (metre) CRS.
+        segment_length_m (float): Length of each segment in meters.
+        river_id_column (str, optional): Column identifying each river. Defaults to
+            the row position.
+
+    Returns:
+        geopandas.GeoDataFrame: One row per segment with 'segment_id' (unique across
+            the network), 'river_id', 'segment_index' (order along the river),
+            'start_m', 'end_m' and the sub-linestring geometry.
+    """
+    rivers = rivers_gdf.reset_index(drop=True)
+    river_ids = rivers[river_id_column].to_numpy() if river_id_column else np.arange(len(rivers))
+    parts = rivers.geometry.explode(index_parts=False)
+    part_river_ids = river_ids[parts.index.to_numpy()]
+
+    segments, line_index, start_m, end_m = segment_lines(parts.to_numpy(), segment_length_m)
+    segments_gdf = gpd.GeoDataFrame({
+        'river_id': part_river_ids[line_index],
+        'start_m': start_m,
+        'end_m': end_m,
+        'geometry': segments,
+    }, crs=rivers_gdf.crs)
+    segments_gdf.insert(0, 'segment_id', range(len(segments_gdf)))
+    segments_gdf.insert(2, 'segment_index', segments_gdf.groupby('river_id', sort=False).cumcount())
+    return segments_gdf
 
-    segments = [LineString([points[i], points[i+1]]) for i in range(len(points)-1)]
-    return segments
+def load_river_centerlines(river_lines_path, target_crs=None):
+    """
+    Loads river polylines from a local vector file (GeoPackage, Shapefile, GeoJSON, ...).
+
+    Args:
+        river_lines_path (str): Path to the hydrography file.
+        target_crs (str, optional): Projected CRS to reproject the lines into. Defaults to
+            the WGS 84 UTM zone of the lines' extent.
+
+    Returns:
+        geopandas.GeoDataFrame: Line geometries in target_crs.
+    """
+    rivers_gdf = gpd.read_file(river_lines_path)
+    if rivers_gdf.crs is None:
+        print(f"Warning: {river_lines_path} has no CRS. Assuming EPSG:4326.")
+        rivers_gdf = rivers_gdf.set_crs(epsg=4326)
+    rivers_gdf = rivers_gdf[rivers_gdf.geometry.geom_type.isin(['LineString', 'MultiLineString'])]
+    if target_crs is None:
+        target_crs = estimate_utm_crs(rivers_gdf)
+        print(f"Using UTM zone {target_crs} for the river network's extent.")
+    return rivers_gdf.to_crs(target_crs)
 
-def define_river_corridor_and_segments():
+def define_river_corridor_and_segments(river_lines_path=None, river_id_column=None,
+                                       buffer_distance_m=2500, segment_length_m=1000,
+                                       centerline_coords=None, output_dir="gis_outputs", export_geojson=False,
+                                       partition_by_river=False):
     """
     Defines a river corridor by buffering a centerline and segments the centerline
     for HMM analysis.
 
+    Args:
+        river_lines_path (str, optional): Local hydrography file with one or more river
+            polylines. If omitted, the manually defined Xingu centerline is used.
+        river_id_column (str, optional): Column of river_lines_path identifying each river.
+        buffer_distance_m (float): Half-width of the corridor in meters.
+        segment_length_m (float): Length of each segment in meters.
+        centerline_coords (list, optional): (lon, lat) vertices of the manual centerline.
+            Defaults to DEFAULT_CENTERLINE_COORDS.
+        output_dir (str): Directory river_segments.parquet and river_corridor_5km.parquet
+            (GeoParquet, in the projected CRS) are saved to.
+        export_geojson (bool): Also write EPSG:4326 GeoJSON copies next to them.
+        partition_by_river (bool): Write the segments as a directory partitioned by river_id.
+
     Returns:
         tuple: (segments_gdf, corridor_gdf)
     """
-    print("Step 1: Create the River Centerline (Manual Definition)")
-    river_centerline_coords = [
-        (-53.446, -11.133), # Shifted eastward
-        (-53.416, -11.096)  # Shifted eastward
-    ]
-    # river_centerline_coords = [
-    #     (-53.451, -11.133), 
-    #     (-53.421, -11.096)
-    # ] # Previous attempt for core area
-    # river_centerline_coords = [
-    #     (-53.5, -11.5), 
-    #     (-52.9, -10.9)
-    # ] # Original longer river segment
-
-    river_line = LineString(river_centerline_coords)
-    river_gdf = gpd.GeoDataFrame({'id': [1], 'geometry': [river_line]}, crs="EPSG:4326")
-    print(f"Initial river line length: {river_gdf.geometry.iloc[0].length:.4f} degrees")
-
-    print("\nStep 2: Reproject to Meters (UTM Zone 22S for this area of Brazil)")
-    # Corrected line: Use integer EPSG code
-    river_gdf_proj = river_gdf.to_crs(epsg=32722) 
-    projected_line = river_gdf_proj.geometry.iloc[0]
-    print(f"Projected river line length: {projected_line.length/1000:.2f} km")
-
-    print("\nStep 3: Buffer the River Line to Create 5km-Wide Corridor")
-    buffer_distance_m = 2500
-    corridor_polygon = projected_line.buffer(buffer_distance_m)
-    corridor_gdf = gpd.GeoDataFrame({'id': [1], 'geometry': [corridor_polygon]}, crs=river_gdf_proj.crs)
-    print(f"Corridor polygon created with area: {corridor_gdf.geometry.area.iloc[0]/1e6:.2f} sq km")
-
-    print("\nStep 4: Divide River Line Into ~1km Segments")
-    segment_length_m = 1000
-    segments = segment_line(projected_line, segment_length_m=segment_length_m)
-    segments_gdf = gpd.GeoDataFrame({'geometry': segments}, crs=river_gdf_proj.crs)
-    segments_gdf.insert(0, 'segment_id', range(len(segments_gdf)))
+    if river_lines_path:
+        print(f"Step 1: Load River Centerlines from {river_lines_path}")
+        with span("load_river_centerlines"):
+            river_gdf_proj = load_river_centerlines(river_lines_path)
+        print(f"Loaded {len(river_gdf_proj)} river polylines.")
+    else:
+        print("Step 1: Create the River Centerline (Manual Definition)")
+        river_line = LineString(centerline_coords or DEFAULT_CENTERLINE_COORDS)
+        river_gdf = gpd.GeoDataFrame({'id': [1], 'geometry': [river_line]}, crs="EPSG:4326")
+        print(f"Initial river line length: {river_gdf.geometry.iloc[0].length:.4f} degrees")
+
+        utm_crs = estimate_utm_crs(river_gdf)
+        print(f"\nStep 2: Reproject to Meters (UTM zone {utm_crs} for this area)")
+        with span("reproject_centerline"):
+            river_gdf_proj = river_gdf.to_crs(utm_crs)
+        river_id_column = 'id'
+    print(f"Projected river line length: {river_gdf_proj.geometry.length.sum()/1000:.2f} km")
+
+    river_ids = river_gdf_proj[river_id_column].to_numpy() if river_id_column else np.arange(len(river_gdf_proj))
+
+    print(f"\nStep 3: Buffer the River Line to Create {2*buffer_distance_m/1000:g}km-Wide Corridor")
+    with span("buffer_corridor"):
+        corridor_polygons = shapely.buffer(river_gdf_proj.geometry.values, buffer_distance_m)
+    corridor_gdf = gpd.GeoDataFrame({'id': river_ids, 'geometry': corridor_polygons}, crs=river_gdf_proj.crs)
+    print(f"Corridor polygon created with area: {corridor_gdf.geometry.area.sum()/1e6:.2f} sq km")
+
+    print(f"\nStep 4: Divide River Line Into ~{segment_length_m/1000:g}km Segments")
+    with span("segment_river_network"):
+        segments_gdf = segment_river_network(river_gdf_proj, segment_length_m=segment_length_m,
+                                             river_id_column=river_id_column)
     print(f"River line divided into {len(segments_gdf)} segments of ~{segment_length_m/1000}km.")
 
     print("\nStep 5: Tag Each Segment With Its Center Coordinates (Lat/Lon)")
-    segments_gdf['centroid_proj'] = segments_gdf.geometry.centroid
-    segments_gdf['centroid_latlon'] = segments_gdf['centroid_proj'].to_crs(epsg=4326)
-    segments_gdf['lat'] = segments_gdf['centroid_latlon'].y
-    segments_gdf['lon'] = segments_gdf['centroid_latlon'].x
+    # Midpoint along the segment, which stays on the river even where it bends
+    with span("segment_midpoints"):
+        midpoints = gpd.GeoSeries(
+            shapely.line_interpolate_point(segments_gdf.geometry.values, 0.5, normalized=True),
+            crs=segments_gdf.crs,
+        ).to_crs(epsg=4326)
+    segments_gdf['lat'] = midpoints.y.to_numpy()
+    segments_gdf['lon'] = midpoints.x.to_numpy()
     
-    segments_gdf = segments_gdf[['segment_id', 'geometry', 'lat', 'lon']]
+    segments_gdf = segments_gdf[['segment_id', 'river_id', 'segment_index', 'geometry', 'lat', 'lon']]
     print("Centroid coordinates (lat/lon) added to each segment.")
 
     # Ensure the output directory exists
-    # Path is now relative to the script's current location in the main project directory
-    output_dir = "gis_outputs"
     os.makedirs(output_dir, exist_ok=True)
 
-    # Save the corridor and segments to GeoJSON files
-    corridor_output_path = os.path.join(output_dir, "river_corridor_5km.geojson")
-    segments_output_path = os.path.join(output_dir, "river_segments.geojson")
+    # Save the corridor and segments as GeoParquet, with optional GeoJSON copies
+    corridor_output_path = os.path.join(output_dir, "river_corridor_5km.parquet")
+    segments_output_path = os.path.join(output_dir, "river_segments.parquet")
 
     try:
-        corridor_gdf.to_file(corridor_output_path, driver="GeoJSON")
-        segments_gdf.to_file(segments_output_path, driver="GeoJSON")
+        with span("write_geoparquet"):
+            write_geotable(corridor_gdf, corridor_output_path,
+                           geojson_path=os.path.join(output_dir, "river_corridor_5km.geojson") if export_geojson else None)
+            write_geotable(segments_gdf, segments_output_path,
+                           partition_by='river_id' if partition_by_river else None,
+                           geojson_path=os.path.join(output_dir, "river_segments.geojson") if export_geojson else None)
     except Exception as e:
-        print(f"Error saving GeoJSON files: {e}")
+        print(f"Error saving corridor/segment files: {e}")
 
     print(f"Corridor saved to {os.path.abspath(corridor_output_path)}")
     print(f"Segments saved to {os.path.abspath(segments_output_path)}")
@@ -104,34 +263,28 @@ def define_river_corridor_and_segments():
 
 
 if __name__ == "__main__":
-    script_dir = os.path.dirname(os.path.abspath(__file__)) 
-    project_root_dir = os.path.dirname(script_dir)
-    output_dir = os.path.join(project_root_dir, "gis_outputs")
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+    output_dir = os.path.join(script_dir, "gis_outputs") # Where the other stages look for their inputs
 
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
         print(f"Created output directory: {output_dir}")
 
-    segments_data, corridor_data = define_river_corridor_and_segments()
+    # Optional local hydrography file (GeoPackage/Shapefile/GeoJSON) with many river polylines.
+    # Leave as None to use the manually defined centerline.
+    river_lines_path = None
+    river_id_column = None
 
-    print("\n--- Final Segmented River Data (First 5 Rows) ---")
-    print(segments_data.head())
+    # GeoJSON copies (EPSG:4326) for desktop GIS; the pipeline itself reads the GeoParquet files
+    export_geojson = False
 
-    segments_output_path = os.path.join(output_dir, "river_segments.geojson")
-    corridor_output_path = os.path.join(output_dir, "river_corridor_5km.geojson")
-    
-    segments_data_4326 = segments_data.copy()
-    if segments_data_4326.crs.to_epsg() != 4326:
-        segments_data_4326['geometry'] = segments_data_4326['geometry'].to_crs(epsg=4326)
-    segments_data_4326.to_file(segments_output_path, driver="GeoJSON")
-    
-    corridor_data_4326 = corridor_data.copy()
-    if corridor_data_4326.crs.to_epsg() != 4326:
-        corridor_data_4326['geometry'] = corridor_data_4326['geometry'].to_crs(epsg=4326)
-    corridor_data_4326.to_file(corridor_output_path, driver="GeoJSON")
-    
-    print(f"\nSegments GeoDataFrame saved to: {segments_output_path}")
-    print(f"Corridor GeoDataFrame saved to: {corridor_output_path}")
+    with profiled_run(os.path.join(output_dir, "profiles"), "define_river_corridor"):
+        segments_data, corridor_data = define_river_corridor_and_segments(
+            river_lines_path, river_id_column, output_dir=output_dir, export_geojson=export_geojson
+        )
+
+        print("\n--- Final Segmented River Data (First 5 Rows) ---")
+        print(segments_data.head())
 
     print("\n--- Corridor Data ---")
     print(corridor_data.info())
@@ -0,0 +1,291 @@
+import hashlib
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from instrumentation import span, add_counter
+
+# Resumable, concurrent file download engine used by download_lidar.py.
+#
+# A "transfer" is any callable transfer(url, start_byte) -> (chunks, offset)
+# where `chunks` iterates over bytes objects and `offset` is the byte position
+# the stream actually starts at (0 if the source ignored the resume request).
+# make_https_transfer wraps an authenticated requests session; make_local_transfer
+# serves files from a local directory so the engine can run without network access.
+
+MANIFEST_FILENAME = ".download_manifest.json"
+PART_SUFFIX = ".part"
+CHUNK_SIZE = 1024 * 1024
+
+
+def make_https_transfer(session, timeout=60):
+    """
+    Builds a transfer over HTTP(S) using Range requests for resume.
+
+    Args:
+        session (requests.Session): Authenticated session, e.g.
+            earthaccess.get_requests_https_session().
+        timeout (float): Connect/read timeout in seconds.
+
+    Returns:
+        callable: transfer(url, start_byte) -> (chunks, offset)
+    """
+    def transfer(url, start_byte):
+        headers = {"Range": f"bytes={start_byte}-"} if start_byte else {}
+        response = session.get(url, headers=headers, stream=True, timeout=timeout)
+        if response.status_code == 416 and start_byte:
+            # "Range Not Satisfiable" with "Content-Range: bytes */<total>": if the
+            # .part already holds all <total> bytes there is nothing left to fetch
+            total = response.headers.get("Content-Range", "").rpartition("/")[2]
+            response.close()
+            if total.isdigit() and int(total) == start_byte:
+                return iter(()), start_byte
+        response.raise_for_status()
+        # 206 means the server honoured the Range header; 200 means it resent the whole file
+        offset = start_byte if response.status_code == 206 else 0
+        return response.iter_content(chunk_size=CHUNK_SIZE), offset
+    return transfer
+
+
+def make_local_transfer(source_dir):
+    """
+    Builds a transfer that serves files from a local directory by URL base name.
+
+    Stands in for the HTTPS transfer when testing the engine offline.
+
+    Args:
+        source_dir (str): Directory holding files named like the URL base names.
+
+    Returns:
+        callable: transfer(url, start_byte) -> (chunks, offset)
+    """
+    def transfer(url, start_byte):
+        source_path = os.path.join(source_dir, os.path.basename(url))
+        f = open(source_path, "rb")
+        f.seek(start_byte)
+
+        def chunks():
+            with f:
+                while True:
+                    data = f.read(CHUNK_SIZE)
+                    if not data:
+                        return
+                    yield data
+        return chunks(), start_byte
+    return transfer
+
+
+def _new_hasher(algorithm):
+    """Returns a hashlib object for a CMR checksum algorithm name (e.g. 'MD5', 'SHA-256'), or None."""
+    if not algorithm:
+        return None
+    try:
+        return hashlib.new(algorithm.replace("-", "").lower())
+    except ValueError:
+        print(f"Warning: Unsupported checksum algorithm '{algorithm}'. Checking size only.")
+        return None
+
+
+def _hash_file(path, hasher):
+    """Feeds an existing file into hasher."""
+    with open(path, "rb") as f:
+        for data in iter(lambda: f.read(CHUNK_SIZE), b""):
+            hasher.update(data)
+
+
+def verify_file(path, expected_size=None, checksum=None, checksum_algorithm=None):
+    """
+    Checks a local file against its expected size and checksum.
+
+    Args:
+        path (str): Local file.
+        expected_size (int, optional): Size in bytes.
+        checksum (str, optional): Expected hex digest.
+        checksum_algorithm (str, optional): e.g. 'MD5', 'SHA-256'.
+
+    Returns:
+        bool: True if the file exists and every available check passes.
+    """
+    if not os.path.isfile(path):
+        return False
+    if expected_size is not None and os.path.getsize(path) != expected_size:
+        return False
+    if checksum:
+        hasher = _new_hasher(checksum_algorithm)
+        if hasher is not None:
+            _hash_file(path, hasher)
+            return hasher.hexdigest().lower() == checksum.lower()
+    return True
+
+
+def load_manifest(download_dir):
+    """
+    Loads the download manifest (file_name -> entry) from download_dir.
+
+    Returns:
+        dict: Empty if the manifest does not exist or is unreadable.
+    """
+    manifest_path = os.path.join(download_dir, MANIFEST_FILENAME)
+    if not os.path.exists(manifest_path):
+        return {}
+    try:
+        with open(manifest_path) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Warning: Could not read download manifest {manifest_path} ({e}). Starting a new one.")
+        return {}
+
+
+def save_manifest(download_dir, manifest):
+    """Writes the manifest atomically so an interrupted run never leaves it half-written."""
+    manifest_path = os.path.join(download_dir, MANIFEST_FILENAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def _is_recorded_complete(job, manifest_entry, local_path):
+    """A manifest hit only counts if the job metadata and on-disk size still agree."""
+    if not manifest_entry or manifest_entry.get('status') != 'complete':
+        return False
+    if manifest_entry.get('checksum') != job.get('checksum'):
+        return False
+    expected_size = job.get('expected_size')
+    if expected_size is None:
+        expected_size = manifest_entry.get('size')
+    return os.path.isfile(local_path) and (expected_size is None or os.path.getsize(local_path) == expected_size)
+
+
+def download_file(job, download_dir, transfer):
+    """
+    Downloads a single file into download_dir, resuming from its .part file.
+
+    Args:
+        job (dict): {'url', 'file_name', 'expected_size', 'checksum', 'checksum_algorithm'};
+                    the last three may be None.
+        download_dir (str): Destination directory.
+        transfer (callable): See module notes.
+
+    Returns:
+        tuple: (local_path, bytes_transferred)
+
+    Raises:
+        IOError: If the downloaded file fails its size or checksum check.
+    """
+    with span("download_file", file=job['file_name']):
+        local_path, bytes_transferred = _download_file(job, download_dir, transfer)
+        add_counter('bytes_transferred', bytes_transferred)
+    return local_path, bytes_transferred
+
+
+def _download_file(job, download_dir, transfer):
+    """Does the work of download_file."""
+    local_path = os.path.join(download_dir, job['file_name'])
+    part_path = local_path + PART_SUFFIX
+    expected_size = job.get('expected_size')
+
+    start_byte = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    if expected_size is not None and start_byte > expected_size:
+        start_byte = 0 # Stale .part from a different version of the file
+
+    hasher = _new_hasher(job.get('checksum_algorithm')) if job.get('checksum') else None
+
+    bytes_transferred = 0
+    if expected_size is None or start_byte < expected_size:
+        chunks, offset = transfer(job['url'], start_byte)
+        if offset != start_byte:
+            start_byte = 0 # Source could not resume; restart from scratch
+        if start_byte and hasher is not None:
+            _hash_file(part_path, hasher)
+        with open(part_path, "ab" if start_byte else "wb") as f:
+            for data in chunks:
+                f.write(data)
+                bytes_transferred += len(data)
+                if hasher is not None:
+                    hasher.update(data)
+    elif hasher is not None:
+        _hash_file(part_path, hasher)
+
+    actual_size = os.path.getsize(part_path)
+    if expected_size is not None and actual_size != expected_size:
+        if actual_size > expected_size:
+            os.remove(part_path)
+        raise IOError(f"Size mismatch for {job['file_name']}: expected {expected_size} bytes, got {actual_size}.")
+    if hasher is not None and hasher.hexdigest().lower() != job['checksum'].lower():
+        os.remove(part_path) # A corrupt .part cannot be resumed
+        raise IOError(f"Checksum mismatch for {job['file_name']} ({job.get('checksum_algorithm')}).")
+
+    os.replace(part_path, local_path)
+    return local_path, bytes_transferred
+
+
+def download_files(jobs, download_dir, transfer, max_workers=4):
+    """
+    Downloads many files concurrently, skipping completed ones and resuming partial ones.
+
+    Completed files are recorded in a manifest in download_dir; on a rerun
+    those files are skipped after a size check, without re-hashing. Files that
+    already exist but are missing from the manifest are verified once against
+    the job's size/checksum and adopted if they pass.
+
+    Args:
+        jobs (list): Job dicts as accepted by download_file.
+        download_dir (str): Destination directory.
+        transfer (callable): See module notes.
+        max_workers (int): Maximum number of concurrent transfers.
+
+    Returns:
+        dict: {'downloaded': [paths], 'skipped': [paths], 'failed': [(file_name, reason)],
+               'bytes_transferred': int}
+    """
+    os.makedirs(download_dir, exist_ok=True)
+    manifest = load_manifest(download_dir)
+    manifest_lock = threading.Lock()
+    result = {'downloaded': [], 'skipped': [], 'failed': [], 'bytes_transferred': 0}
+
+    def record_complete(job, local_path):
+        with manifest_lock:
+            manifest[job['file_name']] = {
+                'url': job['url'],
+                'size': os.path.getsize(local_path),
+                'checksum': job.get('checksum'),
+                'checksum_algorithm': job.get('checksum_algorithm'),
+                'status': 'complete',
+            }
+            save_manifest(download_dir, manifest)
+
+    pending = []
+    for job in jobs:
+        local_path = os.path.join(download_dir, job['file_name'])
+        if _is_recorded_complete(job, manifest.get(job['file_name']), local_path):
+            result['skipped'].append(local_path)
+        elif os.path.isfile(local_path) and verify_file(
+                local_path, job.get('expected_size'), job.get('checksum'), job.get('checksum_algorithm')):
+            record_complete(job, local_path)
+            result['skipped'].append(local_path)
+        else:
+            pending.append(job)
+
+    print(f"{len(result['skipped'])} file(s) already present, {len(pending)} to download "
+          f"with up to {max_workers} concurrent transfer(s).")
+
+    if not pending:
+        return result
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        futures = {executor.submit(download_file, job, download_dir, transfer): job for job in pending}
+        for future in as_completed(futures):
+            job = futures[future]
+            try:
+                local_path, bytes_transferred = future.result()
+            except Exception as e:
+                print(f"Failed to download {job['file_name']}: {e}")
+                result['failed'].append((job['file_name'], str(e)))
+                continue
+            record_complete(job, local_path)
+            result['downloaded'].append(local_path)
+            result['bytes_transferred'] += bytes_transferred
+            print(f"Downloaded {job['file_name']} ({bytes_transferred/1e6:.1f} MB transferred)")
+
+    return result
@@ -1,5 +1,7 @@
 import earthaccess
 import os
+from download_engine import download_files, make_https_transfer
+from instrumentation import span, add_counter, profiled_run
 
 # --- Configuration ---
 # Dataset DOI
@@ -14,9 +16,105 @@ BOUNDING_BOX = (-53.5, -11.5, -52.9, -10.9)
 # Example: DOWNLOAD_DIR = "/Users/anyadecarlo/TuesdayAppointment/lidar_data"
 DOWNLOAD_DIR = "/Users/anyadecarlo/TuesdayAppointment/LiDAR: northern Mato Grosso near the Upper Xingu region" # <<< CHANGE THIS
 
+# Corridor produced by define_river_corridor.py. When it exists, only granules
+# whose tile (per cms_brazil_lidar_tile_inventory.csv) intersects the corridor
+# are downloaded. Set to None to download everything in BOUNDING_BOX.
+CORRIDOR_PATH = "/Users/anyadecarlo/TuesdayAppointment/gis_outputs/river_corridor_5km.parquet"
+INVENTORY_CSV_PATH = os.path.join(DOWNLOAD_DIR, "cms_brazil_lidar_tile_inventory.csv")
+
+# Number of files transferred at the same time
+MAX_CONCURRENT_DOWNLOADS = 8
+
+# Span/trace output when PIPELINE_PROFILE is set (see instrumentation.py)
+PROFILE_DIR = "/Users/anyadecarlo/TuesdayAppointment/gis_outputs/profiles"
+
+def granule_file_names(granule):
+    """Returns the base names of a granule's data links."""
+    return [os.path.basename(url) for url in granule.data_links()]
+
+def filter_granules_to_tiles(granules, tile_names):
+    """
+    Keeps only granules that contain at least one of the given tile files.
+
+    Args:
+        granules (list): earthaccess granule results.
+        tile_names (iterable): .laz base names to keep, e.g. from
+            lidar_inventory.select_tiles_for_corridor.
+
+    Returns:
+        list: The matching granules, in their original order.
+    """
+    wanted = set(tile_names)
+    return [g for g in granules if any(name in wanted for name in granule_file_names(g))]
+
+def corridor_tile_names(corridor_path, inventory_csv_path):
+    """
+    Lists the inventory tiles intersecting the corridor, or None if either file is missing.
+    """
+    if not corridor_path or not os.path.exists(corridor_path):
+        return None
+    if not os.path.exists(inventory_csv_path):
+        print(f"Tile inventory not found at {inventory_csv_path}. Not filtering by corridor.")
+        return None
+    from geo_io import read_geotable
+    from lidar_inventory import load_tile_inventory, select_tiles_for_corridor
+    selected = select_tiles_for_corridor(read_geotable(corridor_path), load_tile_inventory(inventory_csv_path))
+    return selected['filename'].tolist()
+
+def granule_download_jobs(granules):
+    """
+    Turns granules into download jobs with the expected size and checksum of each file.
+
+    Sizes and checksums come from the granule's UMM
+    DataGranule.ArchiveAndDistributionInformation entries, matched by file name.
+
+    Args:
+        granules (list): earthaccess granule results.
+
+    Returns:
+        list: [{'url', 'file_name', 'expected_size', 'checksum', 'checksum_algorithm'}, ...]
+    """
+    jobs = []
+    seen = set()
+    for granule in granules:
+        archive_info = {}
+        for entry in granule.get('umm', {}).get('DataGranule', {}).get('ArchiveAndDistributionInformation', []):
+            archive_info[entry.get('Name')] = entry
+
+        for url in granule.data_links():
+            file_name = os.path.basename(url)
+            if file_name in seen:
+                continue
+            seen.add(file_name)
+            entry = archive_info.get(file_name, {})
+            expected_size = entry.get('SizeInBytes')
+            if expected_size is None and entry.get('SizeUnit') == 'B' and entry.get('Size') is not None:
+                # Only exact byte counts are usable for verification; MB/GB sizes are rounded
+                expected_size = int(entry['Size'])
+            checksum = entry.get('Checksum', {})
+            jobs.append({
+                'url': url,
+                'file_name': file_name,
+                'expected_size': expected_size,
+                'checksum': checksum.get('Value'),
+                'checksum_algorithm': checksum.get('Algorithm'),
+            })
+    return jobs
+
 # --- Main script ---
-def main():
-    """Finds and downloads LiDAR data for the specified DOI and bounding box."""
+def main(download_dir=DOWNLOAD_DIR, bounding_box=BOUNDING_BOX, corridor_path=CORRIDOR_PATH,
+         inventory_csv_path=INVENTORY_CSV_PATH, max_workers=MAX_CONCURRENT_DOWNLOADS):
+    """
+    Finds and downloads LiDAR data for the specified DOI and bounding box.
+
+    Args:
+        download_dir (str): Destination directory.
+        bounding_box (tuple): (min_lon, min_lat, max_lon, max_lat) granule search box.
+        corridor_path (str, optional): Only download tiles intersecting this corridor
+            (GeoParquet or GeoJSON written by define_river_corridor.py).
+        inventory_csv_path (str): Tile inventory used to map the corridor to tiles.
+        max_workers (int): Number of files transferred at the same time.
+    """
 
     print("Authenticating with NASA Earthdata Login...")
     try:
@@ -31,22 +129,23 @@ def main():
         return
 
     # Create download directory if it doesn't exist
-    if not os.path.exists(DOWNLOAD_DIR):
-        print(f"Creating download directory: {DOWNLOAD_DIR}")
-        os.makedirs(DOWNLOAD_DIR)
-    elif not os.path.isdir(DOWNLOAD_DIR):
-        print(f"Error: {DOWNLOAD_DIR} exists but is not a directory.")
+    if not os.path.exists(download_dir):
+        print(f"Creating download directory: {download_dir}")
+        os.makedirs(download_dir)
+    elif not os.path.isdir(download_dir):
+        print(f"Error: {download_dir} exists but is not a directory.")
         return
 
     print(f"Searching for granules from DOI: {DATASET_DOI}")
-    print(f"Bounding box: {BOUNDING_BOX}")
+    print(f"Bounding box: {bounding_box}")
 
     try:
-        granules = earthaccess.search_data(
-            doi=DATASET_DOI,
-            bounding_box=BOUNDING_BOX,
-            count=-1 # Get all matching granules
-        )
+        with span("search_granules"):
+            granules = earthaccess.search_data(
+                doi=DATASET_DOI,
+                bounding_box=bounding_box,
+                count=-1 # Get all matching granules
+            )
     except Exception as e:
         print(f"An error occurred while searching for data: {e}")
         return
@@ -57,31 +156,33 @@ def main():
 
     print(f"Found {len(granules)} total granules for the dataset in the bounding box.")
 
-    # Filter for .laz files (primary format for this LiDAR dataset)
-    # Granule links are typically in 'RelatedUrls' or directly as download links.
-    # earthaccess.download() handles finding the correct download links.
-    # We can inspect granule metadata if we need to be more specific about file types before download,
-    # but earthaccess usually handles this well.
-
-    # For this dataset, the primary data files are .laz. earthaccess.download should pick them up.
-    # If we needed to filter by filename extension before download, we might do something like:
-    # laz_granules = [g for g in granules if any(url.endswith('.laz') for url in g.data_links())]
-    # However, let's rely on earthaccess.download() first.
+    with span("select_corridor_tiles"):
+        tile_names = corridor_tile_names(corridor_path, inventory_csv_path)
+    if tile_names is not None:
+        granules = filter_granules_to_tiles(granules, tile_names)
+        print(f"{len(granules)} granules intersect the corridor in {corridor_path}.")
+        if not granules:
+            print("No granules intersect the corridor.")
+            return
 
-    print(f"Attempting to download {len(granules)} granules to {DOWNLOAD_DIR}...")
+    jobs = granule_download_jobs(granules)
+    print(f"Attempting to download {len(jobs)} files from {len(granules)} granules to {download_dir}...")
 
     try:
-        # The earthaccess.download function takes the list of granule objects
-        # and the local path to download to.
-        downloaded_files = earthaccess.download(granules, local_path=DOWNLOAD_DIR)
-        
-        if downloaded_files:
-            print(f"\nSuccessfully downloaded {len(downloaded_files)} files:")
-            for f in downloaded_files:
-                print(f" - {f}")
-        else:
-            print("\nNo files were downloaded. This might happen if links were not accessible or files already existed and were not overwritten.")
-            print("Check for errors above or if files are already in the target directory.")
+        # Files recorded in the download manifest are skipped and partial .part files are resumed
+        transfer = make_https_transfer(earthaccess.get_requests_https_session())
+        with span("download_files", files=len(jobs)):
+            result = download_files(jobs, download_dir, transfer, max_workers=max_workers)
+            add_counter('bytes_transferred', result['bytes_transferred']) # Per-file spans run on pool threads
+
+        print(f"\nDownloaded {len(result['downloaded'])} files ({result['bytes_transferred']/1e6:.1f} MB), "
+              f"skipped {len(result['skipped'])} already present.")
+        for f in result['downloaded']:
+            print(f" - {f}")
+        if result['failed']:
+            print(f"{len(result['failed'])} files failed and will be resumed on the next run:")
+            for file_name, reason in result['failed']:
+                print(f" - {file_name}: {reason}")
 
     except Exception as e:
         print(f"\nAn error occurred during download: {e}")
@@ -96,4 +197,5 @@ if __name__ == "__main__":
         print("           to your desired download location before running!")
         print("---------------------------------------------------------------------")
     else:
-        main()
+        with profiled_run(PROFILE_DIR, "download_lidar"):
+            main()
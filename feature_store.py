@@ -0,0 +1,295 @@
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+from hmm_inference import (DEFAULT_FEATURE_COLUMNS, NO_ANCHOR, baum_welch, build_observation_batch,
+                           load_segment_table)
+
+# Segment observations packed for repeated model runs (HMM fits, sweeps).
+#
+# The store is one structured .npy file, one fixed-size record per segment:
+#
+#     segment_id int64 | order float64 | X float64[D] | sequence int32 | anchor int16 | observed bool
+#
+# with a JSON sidecar holding the feature names, the sequence (river) ids and
+# each sequence's row range. Records are sorted by sequence, then by order
+# along the river, so a river is a contiguous slice of the file. Opening the
+# store memory-maps it: slicing a river or a row range and taking a column
+# (records['X']) are views, and worker processes open the same file by path
+# and share the page cache instead of receiving pickled arrays.
+#
+# X and the observed mask are exactly what build_observation_batch produces,
+# so a batch cut from the store fits to the same parameters as one built from
+# the merged GeoDataFrame, without geometries or lidar_file_paths lists.
+
+FEATURE_STORE_FILENAME = "segment_store.npy"
+FEATURE_STORE_VERSION = 1
+
+_worker_store = {} # Store opened once per sweep worker process
+
+
+def _meta_path(store_path):
+    return os.path.splitext(store_path)[0] + ".json"
+
+
+def _json_ids(values):
+    """Sequence ids as JSON-safe scalars (numpy ints/floats to Python, anything else to str)."""
+    out = []
+    for v in values:
+        v = v.item() if isinstance(v, np.generic) else v
+        out.append(v if isinstance(v, (int, float, str)) else str(v))
+    return out
+
+
+def record_dtype(n_features):
+    """Structured dtype of one segment record with n_features emission columns."""
+    return np.dtype([
+        ('segment_id', np.int64),
+        ('order', np.float64),
+        ('X', np.float64, (n_features,)),
+        ('sequence', np.int32),
+        ('anchor', np.int16),
+        ('observed', np.bool_),
+    ], align=True)
+
+
+def build_feature_store(segments_df, store_path, feature_columns=DEFAULT_FEATURE_COLUMNS,
+                        sequence_column='river_id', order_column='segment_index', anchor_column='anchor_state'):
+    """
+    Writes a per-segment table to a memory-mappable feature store.
+
+    Args:
+        segments_df (pandas.DataFrame): Per-segment rows, e.g. from hmm_inference.load_segment_table.
+        store_path (str): Output .npy path; the sidecar goes next to it as .json.
+        feature_columns (list): Emission features, in order.
+        sequence_column, order_column, anchor_column: As for hmm_inference.build_observation_batch.
+
+    Returns:
+        dict: The store, opened (see open_feature_store).
+    """
+    df = segments_df.reset_index(drop=True)
+    batch = build_observation_batch(df, feature_columns, sequence_column=sequence_column,
+                                    order_column=order_column, anchor_column=anchor_column)
+    valid = batch['row_index'] >= 0 # Row-major over (B, T): sequence by sequence, in order
+    rows = batch['row_index'][valid]
+    order = df[order_column].to_numpy() if order_column in df.columns else df['segment_id'].to_numpy()
+
+    records = np.zeros(len(rows), dtype=record_dtype(len(feature_columns)))
+    records['segment_id'] = df['segment_id'].to_numpy(dtype=np.int64)[rows]
+    records['order'] = np.asarray(order, dtype=np.float64)[rows]
+    records['X'] = batch['X'][valid]
+    records['sequence'] = np.repeat(np.arange(len(batch['lengths']), dtype=np.int32), batch['lengths'])
+    records['anchor'] = batch['anchors'][valid]
+    records['observed'] = batch['mask'][valid]
+
+    meta = {
+        'version': FEATURE_STORE_VERSION,
+        'n_rows': int(len(records)),
+        'feature_columns': list(feature_columns),
+        'sequence_column': sequence_column,
+        'order_column': order_column,
+        'anchor_column': anchor_column,
+        'sequence_ids': _json_ids(batch['sequence_ids']),
+        'offsets': np.concatenate([[0], np.cumsum(batch['lengths'])]).astype(int).tolist(),
+    }
+    os.makedirs(os.path.dirname(os.path.abspath(store_path)), exist_ok=True)
+    tmp_path = store_path + ".tmp.npy"
+    np.save(tmp_path, records)
+    os.replace(tmp_path, store_path)
+    with open(_meta_path(store_path), "w") as f:
+        json.dump(meta, f, indent=2)
+    print(f"Wrote {len(records)} segments in {len(batch['lengths'])} sequence(s) to {store_path} "
+          f"({os.path.getsize(store_path) / 1e6:.2f} MB)")
+    return open_feature_store(store_path)
+
+
+def write_feature_store(features_file, store_path, matched_segments_file=None, morphometry_file=None,
+                        ndvi_file=None, feature_columns=DEFAULT_FEATURE_COLUMNS):
+    """
+    Builds the feature store from the pipeline's stage outputs.
+
+    Args:
+        features_file (str): Output of segment_features.extract_segment_features.
+        store_path (str): Output .npy path.
+        matched_segments_file, morphometry_file, ndvi_file (str, optional): See
+            hmm_inference.load_segment_table.
+        feature_columns (list): Emission features.
+
+    Returns:
+        dict: The opened store.
+    """
+    segments = load_segment_table(features_file, matched_segments_file, morphometry_file, ndvi_file)
+    return build_feature_store(segments, store_path, feature_columns)
+
+
+def open_feature_store(store_path):
+    """
+    Memory-maps a feature store read-only.
+
+    Returns:
+        dict: {
+            'records' (numpy.memmap): structured records, see record_dtype,
+            'feature_columns' (list), 'sequence_ids' (numpy.ndarray),
+            'offsets' (int64[B + 1]): rows offsets[b]:offsets[b + 1] hold sequence b,
+            'path' (str), 'meta' (dict): the sidecar
+        }
+    """
+    with open(_meta_path(store_path)) as f:
+        meta = json.load(f)
+    if meta.get('version') != FEATURE_STORE_VERSION:
+        raise ValueError(f"Unsupported feature store version {meta.get('version')} in {store_path}; rebuild it.")
+    records = np.load(store_path, mmap_mode="r")
+    if len(records) != meta['n_rows']:
+        raise ValueError(f"Feature store {store_path} has {len(records)} rows, sidecar says {meta['n_rows']}.")
+    return {
+        'records': records,
+        'feature_columns': meta['feature_columns'],
+        'sequence_ids': np.asarray(meta['sequence_ids']),
+        'offsets': np.asarray(meta['offsets'], dtype=np.int64),
+        'path': store_path,
+        'meta': meta,
+    }
+
+
+def _sequence_positions(store, sequence_ids):
+    positions = []
+    for sequence_id in sequence_ids:
+        found = np.flatnonzero(store['sequence_ids'] == sequence_id)
+        if len(found) == 0:
+            raise KeyError(f"Sequence {sequence_id!r} is not in the feature store.")
+        positions.append(int(found[0]))
+    return np.asarray(positions, dtype=np.int64)
+
+
+def sequence_records(store, sequence_id):
+    """Zero-copy view of one river's records, in order along the river."""
+    b = _sequence_positions(store, [sequence_id])[0]
+    return store['records'][store['offsets'][b]:store['offsets'][b + 1]]
+
+
+def row_records(store, start, stop):
+    """Zero-copy view of records start:stop (store order: by sequence, then along it)."""
+    return store['records'][start:stop]
+
+
+def batch_from_store(store, sequence_ids=None):
+    """
+    Cuts a padded HMM batch from the store.
+
+    The result has the same layout as hmm_inference.build_observation_batch,
+    except that 'row_index' refers to store rows (see unpack_to_segments with
+    n_rows=len(store['records'])).
+
+    Args:
+        store (dict): Output of open_feature_store.
+        sequence_ids (list, optional): Rivers to include, in batch order. Defaults to all.
+
+    Returns:
+        dict: 'X', 'mask', 'lengths', 'anchors', 'sequence_ids', 'row_index'.
+    """
+    offsets = store['offsets']
+    if sequence_ids is None:
+        positions = np.arange(len(offsets) - 1)
+    else:
+        positions = _sequence_positions(store, sequence_ids)
+    starts = offsets[positions]
+    lengths = offsets[positions + 1] - starts
+    B, T = len(positions), int(lengths.max()) if len(lengths) else 0
+    D = len(store['feature_columns'])
+
+    pos = np.arange(int(lengths.sum())) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    rows = np.repeat(starts, lengths) + pos
+    b = np.repeat(np.arange(B), lengths)
+    records = store['records']
+    if sequence_ids is None: # Rows are already in store order; read the file sequentially
+        selected = records
+    else:
+        selected = records[rows]
+
+    X = np.full((B, T, D), np.nan)
+    X[b, pos] = selected['X']
+    mask = np.zeros((B, T), dtype=bool)
+    mask[b, pos] = selected['observed']
+    anchors = np.full((B, T), NO_ANCHOR, dtype=np.int64)
+    anchors[b, pos] = selected['anchor']
+    row_index = np.full((B, T), -1, dtype=np.int64)
+    row_index[b, pos] = rows
+    return {'X': X, 'mask': mask, 'lengths': lengths, 'anchors': anchors,
+            'sequence_ids': store['sequence_ids'][positions], 'row_index': row_index}
+
+
+def _init_sweep_worker(store_path):
+    _worker_store.clear()
+    _worker_store.update(open_feature_store(store_path))
+
+
+def _fit_config(config):
+    """Worker: one EM fit on the shared store. config holds n_states, seed, covariance_type, sequence_ids."""
+    batch = batch_from_store(_worker_store, config.get('sequence_ids'))
+    params, history = baum_welch(batch, n_states=config['n_states'], seed=config.get('seed', 0),
+                                 covariance_type=config.get('covariance_type', 'diag'),
+                                 n_iter=config.get('n_iter', 50), verbose=False)
+    return {**config, 'log_likelihood': history[-1] if history else np.nan,
+            'n_iter': len(history), 'params': params}
+
+
+def sweep_hmm(store_path, configs, workers=None):
+    """
+    Fits one HMM per configuration, in parallel over a shared feature store.
+
+    Workers memory-map the store themselves; only the small config dicts and
+    the fitted parameters cross process boundaries.
+
+    Args:
+        store_path (str): Feature store .npy path.
+        configs (list): Dicts with 'n_states' and optionally 'seed', 'covariance_type',
+            'n_iter' and 'sequence_ids' (a subset of rivers).
+        workers (int, optional): Worker processes. 1 runs in-process; None uses os.cpu_count().
+
+    Returns:
+        list: One dict per successful fit (the config plus 'log_likelihood', 'n_iter', 'params'),
+            in the order of configs.
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    results = [None] * len(configs)
+    if workers == 1 or len(configs) <= 1:
+        _init_sweep_worker(store_path)
+        for i, config in enumerate(configs):
+            try:
+                results[i] = _fit_config(config)
+            except Exception as e:
+                print(f"Error fitting {config}: {e}. Skipping.")
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(configs)), initializer=_init_sweep_worker,
+                                 initargs=(store_path,)) as executor:
+            futures = {executor.submit(_fit_config, config): i for i, config in enumerate(configs)}
+            for future in as_completed(futures):
+                try:
+                    results[futures[future]] = future.result()
+                except Exception as e: # Includes BrokenProcessPool if a worker died
+                    print(f"Error fitting {configs[futures[future]]}: {e}. Skipping.")
+    return [r for r in results if r is not None]
+
+
+if __name__ == "__main__":
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    out_dir = os.path.join(base_dir, "gis_outputs")
+    features_file = os.path.join(out_dir, "river_segment_features.parquet")
+    store_file = os.path.join(out_dir, FEATURE_STORE_FILENAME)
+    state_counts = [2, 3, 4]
+    seeds = [0, 1, 2]
+
+    if not os.path.exists(features_file):
+        print(f"ERROR: Segment features file not found: {features_file}")
+        print("Please run segment_features.py first.")
+    else:
+        write_feature_store(features_file, store_file,
+                            matched_segments_file=os.path.join(out_dir, "river_segments_with_lidar.parquet"),
+                            morphometry_file=os.path.join(out_dir, "river_segment_morphometry.parquet"),
+                            ndvi_file=os.path.join(out_dir, "river_segment_ndvi.parquet"))
+        configs = [{'n_states': k, 'seed': s} for k in state_counts for s in seeds]
+        for result in sweep_hmm(store_file, configs):
+            print(f"n_states={result['n_states']} seed={result['seed']}: "
+                  f"log-likelihood {result['log_likelihood']:.3f} after {result['n_iter']} iterations")
@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import geopandas as gpd
+
+# Table I/O shared by the pipeline stages.
+#
+# GeoParquet is the primary format: list columns such as 'lidar_file_paths'
+# stay native Arrow lists, each file carries a per-row bbox covering column so
+# readers can skip row groups outside an area, and reads are memory-mapped with
+# column projection. GeoJSON is still available as an explicit export for GIS
+# tools and for inspecting small outputs by eye.
+#
+# A partitioned table is a directory of Hive-style subdirectories
+# (river_id=<value>/part-0.parquet) that read_geotable reads back as one table.
+
+PARQUET_COMPRESSION = "zstd"
+
+
+def is_parquet_path(path):
+    """True for .parquet files and partitioned GeoParquet directories."""
+    return path.endswith(".parquet") or os.path.isdir(path)
+
+
+def write_geotable(gdf, path, partition_by=None, geojson_path=None):
+    """
+    Writes a GeoDataFrame as GeoParquet, optionally partitioned, plus an opt-in GeoJSON copy.
+
+    Args:
+        gdf (geopandas.GeoDataFrame): Table to write; any CRS.
+        path (str): Output .parquet path. With partition_by this becomes a directory.
+        partition_by (str, optional): Column to partition on, e.g. 'river_id'.
+        geojson_path (str, optional): Also export to this GeoJSON path, reprojected to EPSG:4326.
+
+    Returns:
+        str: path
+    """
+    if partition_by is None:
+        if os.path.isdir(path): # Previously written partitioned
+            shutil.rmtree(path)
+        gdf.to_parquet(path, compression=PARQUET_COMPRESSION, write_covering_bbox=True, index=False)
+    else:
+        # Build the partitions in a sibling temporary directory and swap it in, so
+        # partitions of an earlier write that no longer exist never linger in path
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(dir=parent, prefix=os.path.basename(path) + ".tmp-")
+        try:
+            for value, part in gdf.groupby(partition_by, sort=True):
+                part_dir = os.path.join(tmp_dir, f"{partition_by}={value}")
+                os.makedirs(part_dir, exist_ok=True)
+                part.drop(columns=[partition_by]).to_parquet(
+                    os.path.join(part_dir, "part-0.parquet"),
+                    compression=PARQUET_COMPRESSION, write_covering_bbox=True, index=False,
+                )
+            _swap_in(tmp_dir, path)
+        except BaseException:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            raise
+    if geojson_path:
+        export_geojson(gdf, geojson_path)
+    return path
+
+
+def _swap_in(tmp_dir, path):
+    """Replaces path (a file, a directory or nothing) with tmp_dir."""
+    if not os.path.lexists(path):
+        os.rename(tmp_dir, path)
+        return
+    old = tmp_dir + ".old"
+    os.rename(path, old)
+    os.rename(tmp_dir, path)
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+    else:
+        os.remove(old)
+
+
+def export_geojson(gdf, path):
+    """Writes a GeoJSON copy in EPSG:4326 (the CRS GeoJSON readers expect)."""
+    if gdf.crs is not None and gdf.crs.to_epsg() != 4326:
+        gdf = gdf.to_crs(epsg=4326)
+    gdf.to_file(path, driver="GeoJSON")
+    return path
+
+
+def read_geotable(path, columns=None, bbox=None, filters=None):
+    """
+    Reads a table written by write_geotable, or a legacy GeoJSON output.
+
+    Parquet reads are memory-mapped and only decode the requested columns. If
+    columns leaves out the geometry, a plain pandas DataFrame is returned.
+
+    Args:
+        path (str): .parquet file, partitioned directory, or any file gpd.read_file accepts.
+        columns (list, optional): Columns to read. Defaults to all.
+        bbox (tuple, optional): (minx, miny, maxx, maxy) in the table's CRS; rows whose
+            bbox covering misses it are skipped (Parquet only).
+        filters (list, optional): pyarrow filters, e.g. [('river_id', '=', 3)] (Parquet only).
+
+    Returns:
+        geopandas.GeoDataFrame or pandas.DataFrame
+    """
+    if not is_parquet_path(path):
+        gdf = gpd.read_file(path, bbox=bbox)
+        return gdf[columns] if columns is not None else gdf
+
+    if columns is not None and 'geometry' not in columns:
+        import pyarrow.parquet as pq
+        return _restore_partition_dtypes(pq.read_table(path, columns=columns, filters=filters, memory_map=True).to_pandas())
+    gdf = gpd.read_parquet(path, columns=columns, bbox=bbox, filters=filters, memory_map=True)
+    if 'bbox' in gdf.columns and (columns is None or 'bbox' not in columns):
+        gdf = gdf.drop(columns=['bbox']) # Covering column, not data
+    return _restore_partition_dtypes(gdf)
+
+
+def _restore_partition_dtypes(df):
+    """Hive partition keys come back as categoricals; give them their plain dtype again."""
+    for column in df.select_dtypes("category").columns:
+        df[column] = df[column].astype(df[column].cat.categories.dtype)
+    return df
@@ -0,0 +1,459 @@
+import numpy as np
+import os
+from geo_io import read_geotable, write_geotable
+from segment_features import parse_lidar_file_paths
+
+# Batched, log-space HMM inference over ordered river segments.
+#
+# Each corridor (river) is one sequence and each segment one time step.
+# Sequences are padded to a common length T and processed together as
+# (B, T, ...) arrays: every recursion step is a single NumPy operation over
+# all B sequences, so the Python loop runs T times regardless of how many
+# corridors are modelled.
+#
+# Missing observations (segments without LiDAR, or NaN features) contribute
+# a log-likelihood of 0 and are bridged by the transition model. Anchor
+# states (e.g. IPHAN-labelled sites) clamp the posterior at their segment.
+#
+# Model parameters are a dict:
+#     {'startprob': (K,), 'transmat': (K, K), 'means': (K, D),
+#      'covars': (K, D) for 'diag' or (K, D, D) for 'full', 'covariance_type': str}
+
+NO_ANCHOR = -1
+MIN_COVAR = 1e-3
+DEFAULT_FEATURE_COLUMNS = ['canopy_stddev', 'terrain_variance', 'water_distance_m', 'anomaly_score']
+
+
+def _logsumexp(a, axis):
+    """log(sum(exp(a))) along axis, safe for all -inf slices."""
+    m = np.max(a, axis=axis, keepdims=True)
+    m = np.where(np.isfinite(m), m, 0.0)
+    with np.errstate(divide='ignore'):
+        out = np.log(np.sum(np.exp(a - m), axis=axis, keepdims=True)) + m
+    return np.squeeze(out, axis=axis)
+
+
+def _safe_log(p):
+    with np.errstate(divide='ignore'):
+        return np.log(p)
+
+
+def _finite_max(a):
+    """Row-wise max over the last axis, 0 where a row is all -inf."""
+    m = np.max(a, axis=-1, keepdims=True)
+    return np.where(np.isfinite(m), m, 0.0)
+
+
+def build_observation_batch(segments_df, feature_columns, sequence_column='river_id',
+                            order_column='segment_index', anchor_column=None):
+    """
+    Packs a per-segment table into padded (B, T, D) arrays, one row per corridor.
+
+    Args:
+        segments_df (pandas.DataFrame): Per-segment rows, e.g. segment features
+            merged with the output of match_lidar_to_segments.
+        feature_columns (list): Emission feature columns.
+        sequence_column (str): Column identifying the corridor. If absent, all
+            segments form a single sequence.
+        order_column (str): Column giving the order along the corridor. Falls back
+            to 'segment_id' if absent.
+        anchor_column (str, optional): Integer state labels; NaN or -1 means unlabelled.
+
+    Returns:
+        dict: {
+            'X' (B, T, D) float64 with NaN where missing,
+            'mask' (B, T) bool: step holds an observation,
+            'lengths' (B,) int, 'anchors' (B, T) int (NO_ANCHOR if unlabelled),
+            'sequence_ids' (B,), 'row_index' (B, T) int: position in segments_df or -1 for padding
+        }
+    """
+    df = segments_df.reset_index(drop=True)
+    seq = df[sequence_column].to_numpy() if sequence_column in df.columns else np.zeros(len(df), dtype=np.int64)
+    order = df[order_column].to_numpy() if order_column in df.columns else df['segment_id'].to_numpy()
+
+    sequence_ids, seq_codes = np.unique(seq, return_inverse=True)
+    rows = np.lexsort((order, seq_codes))
+    lengths = np.bincount(seq_codes, minlength=len(sequence_ids))
+    B, T = len(sequence_ids), int(lengths.max()) if len(lengths) else 0
+    pos = np.arange(len(rows)) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+
+    row_index = np.full((B, T), -1, dtype=np.int64)
+    row_index[seq_codes[rows], pos] = rows
+
+    features = df[feature_columns].to_numpy(dtype=np.float64)
+    X = np.full((B, T, len(feature_columns)), np.nan)
+    X[seq_codes[rows], pos] = features[rows]
+
+    observed = ~np.isnan(features).all(axis=1)
+    if 'lidar_file_paths' in df.columns:
+        observed &= df['lidar_file_paths'].apply(lambda v: len(parse_lidar_file_paths(v)) > 0).to_numpy()
+    mask = np.zeros((B, T), dtype=bool)
+    mask[seq_codes[rows], pos] = observed[rows]
+    X[~mask] = np.nan
+
+    anchors = np.full((B, T), NO_ANCHOR, dtype=np.int64)
+    if anchor_column and anchor_column in df.columns:
+        labels = df[anchor_column].to_numpy(dtype=np.float64)
+        labels = np.where(np.isnan(labels), NO_ANCHOR, labels).astype(np.int64)
+        anchors[seq_codes[rows], pos] = labels[rows]
+
+    return {'X': X, 'mask': mask, 'lengths': lengths, 'anchors': anchors,
+            'sequence_ids': sequence_ids, 'row_index': row_index}
+
+
+def emission_log_likelihood(X, mask, params):
+    """
+    Per-state Gaussian log-likelihood of every observation.
+
+    For 'diag' covariances, individual NaN features are marginalised out; for
+    'full', a step with any NaN feature is treated as missing.
+
+    Args:
+        X (numpy.ndarray): (B, T, D) observations.
+        mask (numpy.ndarray): (B, T) observed steps.
+        params (dict): Model parameters.
+
+    Returns:
+        numpy.ndarray: (B, T, K) log-likelihoods, 0 at missing steps.
+    """
+    means = params['means']
+    K, D = means.shape
+    B, T, _ = X.shape
+    flat = X.reshape(-1, D)
+
+    if params['covariance_type'] == 'diag':
+        var = params['covars']
+        dim_observed = ~np.isnan(flat) & mask.reshape(-1, 1)
+        x = np.where(dim_observed, flat, 0.0)
+        m = dim_observed.astype(np.float64)
+        # sum_d m_d * ((x_d - mu_kd)^2 / v_kd + log(2 pi v_kd)), expanded into three matmuls
+        ll = (x ** 2) @ (1.0 / var).T - 2.0 * x @ (means / var).T + m @ (means ** 2 / var + np.log(2 * np.pi * var)).T
+        ll = -0.5 * ll
+    else:
+        step_observed = mask.reshape(-1) & ~np.isnan(flat).any(axis=1)
+        x = np.where(step_observed[:, None], flat, 0.0)
+        ll = np.empty((len(flat), K))
+        for k in range(K):
+            chol = np.linalg.cholesky(params['covars'][k])
+            z = np.linalg.solve(chol, (x - means[k]).T)
+            log_det = 2.0 * np.log(np.diag(chol)).sum()
+            ll[:, k] = -0.5 * ((z ** 2).sum(axis=0) + log_det + D * np.log(2 * np.pi))
+        ll[~step_observed] = 0.0
+
+    return ll.reshape(B, T, K)
+
+
+def _clamp_anchors(log_lik, anchors):
+    """Forces anchored steps into their labelled state."""
+    anchored = anchors != NO_ANCHOR
+    if not anchored.any():
+        return log_lik
+    K = log_lik.shape[2]
+    allowed = np.arange(K)[None, None, :] == anchors[:, :, None]
+    return np.where(anchored[:, :, None] & ~allowed, -np.inf, log_lik)
+
+
+def forward_backward(params, log_lik, lengths):
+    """
+    Log-space forward-backward over a padded batch.
+
+    Args:
+        params (dict): Model parameters.
+        log_lik (numpy.ndarray): (B, T, K) emission log-likelihoods (anchors already clamped).
+        lengths (numpy.ndarray): (B,) valid length of each sequence.
+
+    Returns:
+        dict: {'log_alpha', 'log_beta', 'log_gamma' (B, T, K), 'log_likelihood' (B,)}.
+              Values at padded steps are meaningless.
+    """
+    B, T, K = log_lik.shape
+    log_start = _safe_log(params['startprob'])
+    transmat = params['transmat']
+    # Time-major copies so each step reads and writes one contiguous (B, K) block
+    log_lik_t = np.ascontiguousarray(log_lik.transpose(1, 0, 2))
+
+    # Each step is logsumexp over the previous states, computed as a max-shifted
+    # (B, K) @ (K, K) matmul: stable in log space without a (B, K, K) temporary.
+    log_alpha = np.empty((T, B, K))
+    log_alpha[0] = log_start + log_lik_t[0]
+    for t in range(1, T):
+        prev = log_alpha[t - 1]
+        shift = _finite_max(prev)
+        step = _safe_log(np.exp(prev - shift) @ transmat) + shift + log_lik_t[t]
+        log_alpha[t] = np.where((t < lengths)[:, None], step, prev)
+
+    log_beta = np.zeros((T, B, K))
+    for t in range(T - 2, -1, -1):
+        nxt = log_lik_t[t + 1] + log_beta[t + 1]
+        shift = _finite_max(nxt)
+        step = _safe_log(np.exp(nxt - shift) @ transmat.T) + shift
+        log_beta[t] = np.where((t + 1 < lengths)[:, None], step, 0.0)
+
+    log_alpha = log_alpha.transpose(1, 0, 2)
+    log_beta = log_beta.transpose(1, 0, 2)
+
+    log_likelihood = _logsumexp(log_alpha[:, -1], axis=1)
+    log_gamma = log_alpha + log_beta - log_likelihood[:, None, None]
+    return {'log_alpha': log_alpha, 'log_beta': log_beta, 'log_gamma': log_gamma,
+            'log_likelihood': log_likelihood}
+
+
+def viterbi(params, log_lik, lengths):
+    """
+    Most likely state path for every sequence in a padded batch.
+
+    Returns:
+        tuple: (paths, log_prob)
+               paths (numpy.ndarray): (B, T) int states, -1 at padded steps.
+               log_prob (numpy.ndarray): (B,) log probability of each path.
+    """
+    B, T, K = log_lik.shape
+    log_start = _safe_log(params['startprob'])
+    log_trans = _safe_log(params['transmat'])
+
+    log_lik_t = np.ascontiguousarray(log_lik.transpose(1, 0, 2))
+    delta = log_start + log_lik_t[0]
+    backpointers = np.empty((T, B, K), dtype=np.int64)
+    backpointers[0] = np.arange(K)
+    for t in range(1, T):
+        scores = delta[:, :, None] + log_trans[None]
+        best_prev = np.argmax(scores, axis=1)
+        step = np.take_along_axis(scores, best_prev[:, None, :], axis=1)[:, 0] + log_lik_t[t]
+        active = (t < lengths)[:, None]
+        delta = np.where(active, step, delta)
+        # Padded steps point to themselves so backtracking passes through unchanged
+        backpointers[t] = np.where(active, best_prev, np.arange(K)[None, :])
+
+    paths = np.empty((B, T), dtype=np.int64)
+    paths[:, -1] = np.argmax(delta, axis=1)
+    for t in range(T - 1, 0, -1):
+        paths[:, t - 1] = backpointers[t, np.arange(B), paths[:, t]]
+    paths[np.arange(T)[None, :] >= lengths[:, None]] = -1
+    return paths, delta.max(axis=1)
+
+
+def init_params(X, mask, n_states, covariance_type='diag', seed=0, self_transition=0.8):
+    """
+    Initial parameters: means drawn from observed steps, shared data covariance
+    and a "sticky" transition matrix (neighbouring segments tend to share a state).
+    """
+    rng = np.random.default_rng(seed)
+    observed = X[mask]
+    observed = observed[~np.isnan(observed).any(axis=1)]
+    D = X.shape[2]
+    if len(observed) < n_states:
+        raise ValueError(f"Need at least {n_states} fully observed segments to initialise the HMM, got {len(observed)}.")
+
+    means = observed[rng.choice(len(observed), size=n_states, replace=False)]
+    if covariance_type == 'diag':
+        covars = np.tile(np.maximum(observed.var(axis=0), MIN_COVAR), (n_states, 1))
+    else:
+        cov = np.atleast_2d(np.cov(observed, rowvar=False)) + MIN_COVAR * np.eye(D)
+        covars = np.tile(cov, (n_states, 1, 1))
+
+    transmat = np.full((n_states, n_states), (1.0 - self_transition) / max(n_states - 1, 1))
+    np.fill_diagonal(transmat, self_transition if n_states > 1 else 1.0)
+    return {'startprob': np.full(n_states, 1.0 / n_states), 'transmat': transmat,
+            'means': means, 'covars': covars, 'covariance_type': covariance_type}
+
+
+def _m_step(batch, params, posteriors, log_lik):
+    """Re-estimates parameters from the E-step posteriors."""
+    X, mask, lengths = batch['X'], batch['mask'], batch['lengths']
+    B, T, K = log_lik.shape
+    valid = np.arange(T)[None, :] < lengths[:, None]
+    gamma = np.where(valid[:, :, None], np.exp(posteriors['log_gamma']), 0.0)
+
+    startprob = gamma[:, 0].sum(axis=0)
+    startprob /= startprob.sum()
+
+    log_trans = _safe_log(params['transmat'])
+    xi_sum = np.zeros((K, K))
+    log_alpha, log_beta, ll_seq = posteriors['log_alpha'], posteriors['log_beta'], posteriors['log_likelihood']
+    for t in range(T - 1):
+        active = t + 1 < lengths
+        if not active.any():
+            break
+        log_xi = (log_alpha[active, t, :, None] + log_trans[None]
+                  + (log_lik[active, t + 1] + log_beta[active, t + 1])[:, None, :]
+                  - ll_seq[active, None, None])
+        xi_sum += np.exp(log_xi).sum(axis=0)
+    transmat = xi_sum / np.maximum(xi_sum.sum(axis=1, keepdims=True), np.finfo(float).tiny)
+
+    D = X.shape[2]
+    flat_x = X.reshape(-1, D)
+    flat_gamma = gamma.reshape(-1, K)
+    if params['covariance_type'] == 'diag':
+        dim_observed = ~np.isnan(flat_x) & mask.reshape(-1, 1)
+        x = np.where(dim_observed, flat_x, 0.0)
+        m = dim_observed.astype(np.float64)
+        weight = flat_gamma.T @ m                      # (K, D) posterior mass per feature
+        safe_weight = np.maximum(weight, np.finfo(float).tiny)
+        means = np.where(weight > 0, (flat_gamma.T @ x) / safe_weight, params['means'])
+        second = (flat_gamma.T @ (x ** 2)) / safe_weight
+        covars = np.where(weight > 0, np.maximum(second - means ** 2, MIN_COVAR), params['covars'])
+    else:
+        step_observed = mask.reshape(-1) & ~np.isnan(flat_x).any(axis=1)
+        x = flat_x[step_observed]
+        g = flat_gamma[step_observed]
+        weight = g.sum(axis=0)
+        means = params['means'].copy()
+        covars = params['covars'].copy()
+        for k in range(K):
+            if weight[k] <= 0:
+                continue
+            means[k] = g[:, k] @ x / weight[k]
+            diff = x - means[k]
+            covars[k] = (g[:, k, None] * diff).T @ diff / weight[k] + MIN_COVAR * np.eye(D)
+
+    return {'startprob': startprob, 'transmat': transmat, 'means': means, 'covars': covars,
+            'covariance_type': params['covariance_type']}
+
+
+def baum_welch(batch, n_states=None, params=None, covariance_type='diag', n_iter=50, tol=1e-4, seed=0, verbose=True):
+    """
+    Fits HMM parameters to a padded batch with EM.
+
+    Args:
+        batch (dict): Output of build_observation_batch.
+        n_states (int): Number of hidden states (ignored if params is given).
+        params (dict, optional): Starting parameters; initialised with init_params otherwise.
+        covariance_type (str): 'diag' or 'full'.
+        n_iter (int): Maximum EM iterations.
+        tol (float): Stop when the total log-likelihood improves by less than this.
+        seed (int): Seed for init_params.
+        verbose (bool): Print the log-likelihood after every iteration.
+
+    Returns:
+        tuple: (params, log_likelihood_history)
+    """
+    if params is None:
+        params = init_params(batch['X'], batch['mask'], n_states, covariance_type, seed=seed)
+
+    history = []
+    for i in range(n_iter):
+        log_lik = _clamp_anchors(emission_log_likelihood(batch['X'], batch['mask'], params), batch['anchors'])
+        posteriors = forward_backward(params, log_lik, batch['lengths'])
+        total = float(posteriors['log_likelihood'].sum())
+        history.append(total)
+        if verbose:
+            print(f"EM iteration {i + 1}: log-likelihood {total:.3f}")
+        if i > 0 and abs(total - history[-2]) < tol:
+            break
+        params = _m_step(batch, params, posteriors, log_lik)
+    return params, history
+
+
+def decode(batch, params):
+    """
+    Posterior state probabilities and Viterbi paths for a batch.
+
+    Returns:
+        dict: {'posteriors' (B, T, K), 'viterbi' (B, T), 'log_likelihood' (B,)}
+    """
+    log_lik = _clamp_anchors(emission_log_likelihood(batch['X'], batch['mask'], params), batch['anchors'])
+    posteriors = forward_backward(params, log_lik, batch['lengths'])
+    paths, _ = viterbi(params, log_lik, batch['lengths'])
+    return {'posteriors': np.exp(posteriors['log_gamma']), 'viterbi': paths,
+            'log_likelihood': posteriors['log_likelihood']}
+
+
+def unpack_to_segments(batch, values, n_rows):
+    """
+    Scatters (B, T, ...) results back to one row per segment in the original table order.
+    """
+    valid = batch['row_index'] >= 0
+    out = np.empty((n_rows,) + values.shape[2:], dtype=values.dtype)
+    out[batch['row_index'][valid]] = values[valid]
+    return out
+
+
+def load_segment_table(features_file, matched_segments_file=None, morphometry_file=None, ndvi_file=None):
+    """
+    Merges the per-segment stage outputs into the table the HMM is fitted to.
+
+    Args:
+        features_file (str): Output of segment_features.extract_segment_features.
+        matched_segments_file (str, optional): Output of match_lidar_to_segments, merged in for
+            its 'lidar_file_paths' column.
+        morphometry_file (str, optional): Output of morphometric_detector.detect_segment_anomalies,
+            merged in for its MORPHOMETRY_COLUMNS (usable as emission features).
+        ndvi_file (str, optional): Output of raster_sampling.sample_segment_ndvi, merged in
+            for its NDVI statistics (also usable as emission features).
+
+    Returns:
+        geopandas.GeoDataFrame: One row per segment.
+    """
+    segments = read_geotable(features_file)
+    if matched_segments_file and os.path.exists(matched_segments_file):
+        matched = read_geotable(matched_segments_file, columns=['segment_id', 'lidar_file_paths'])
+        segments = segments.merge(matched, on='segment_id', how='left')
+    if morphometry_file and os.path.exists(morphometry_file):
+        morphometry = read_geotable(morphometry_file, columns=['segment_id', 'morph_anomaly_score',
+                                                                'circularity', 'candidate_count'])
+        segments = segments.merge(morphometry, on='segment_id', how='left')
+    if ndvi_file and os.path.exists(ndvi_file):
+        ndvi = read_geotable(ndvi_file, columns=['segment_id', 'ndvi_mean', 'ndvi_std', 'ndvi_p10',
+                                                  'ndvi_p50', 'vegetation_gap_fraction'])
+        segments = segments.merge(ndvi, on='segment_id', how='left')
+    return segments
+
+
+def infer_segment_states(features_file, output_file, matched_segments_file=None, morphometry_file=None,
+                         ndvi_file=None, feature_columns=DEFAULT_FEATURE_COLUMNS, n_states=3):
+    """
+    Fits the HMM to a segment feature file and writes the decoded states.
+
+    With fewer fully observed segments than states the HMM can't be initialised;
+    the segments are then written with NaN state columns and a warning, so the
+    steps downstream still find their input.
+
+    Args:
+        features_file (str): Output of segment_features.extract_segment_features.
+        output_file (str): Where to write the segments with 'hmm_state' and 'p_state_<k>'.
+        matched_segments_file, morphometry_file, ndvi_file (str, optional): See load_segment_table.
+        feature_columns (list): Emission features.
+        n_states (int): Number of hidden states.
+
+    Returns:
+        geopandas.GeoDataFrame: The written segments.
+    """
+    segments = load_segment_table(features_file, matched_segments_file, morphometry_file, ndvi_file)
+    batch = build_observation_batch(segments, feature_columns, anchor_column='anchor_state')
+    complete = int((batch['mask'] & ~np.isnan(batch['X']).any(axis=2)).sum())
+    if complete < n_states:
+        print(f"Warning: only {complete} segment(s) have all of {feature_columns}; need at least {n_states} "
+              f"to fit a {n_states}-state HMM. Writing NaN states.")
+        segments['hmm_state'] = np.nan
+        for k in range(n_states):
+            segments[f'p_state_{k}'] = np.nan
+    else:
+        params, _ = baum_welch(batch, n_states=n_states)
+        result = decode(batch, params)
+        segments['hmm_state'] = unpack_to_segments(batch, result['viterbi'], len(segments))
+        posteriors = unpack_to_segments(batch, result['posteriors'], len(segments))
+        for k in range(n_states):
+            segments[f'p_state_{k}'] = posteriors[:, k]
+    segments = segments.drop(columns=['lidar_file_paths'], errors='ignore')
+    write_geotable(segments, output_file)
+    print(f"Saved HMM states to {output_file}")
+    return segments
+
+
+if __name__ == "__main__":
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    features_file = os.path.join(base_dir, "gis_outputs", "river_segment_features.parquet")
+    matched_segments_file = os.path.join(base_dir, "gis_outputs", "river_segments_with_lidar.parquet")
+    morphometry_file = os.path.join(base_dir, "gis_outputs", "river_segment_morphometry.parquet")
+    ndvi_file = os.path.join(base_dir, "gis_outputs", "river_segment_ndvi.parquet")
+    output_file = os.path.join(base_dir, "gis_outputs", "river_segments_hmm.parquet")
+    feature_columns = DEFAULT_FEATURE_COLUMNS
+    n_states = 3
+
+    if not os.path.exists(features_file):
+        print(f"ERROR: Segment features file not found: {features_file}")
+        print("Please run segment_features.py first.")
+    else:
+        infer_segment_states(features_file, output_file, matched_segments_file, morphometry_file,
+                             ndvi_file, feature_columns=feature_columns, n_states=n_states)
@@ -0,0 +1,284 @@
+import contextlib
+import json
+import os
+import resource
+import sys
+import threading
+import time
+
+# Lightweight span recorder for the pipeline scripts.
+#
+# Wrap a stage in `with span("name", tile=...)` to record its wall time, thread CPU
+# time, process peak RSS and any counters (bytes_read, points_decoded, ...)
+# added inside it with add_counter(). Counters roll up into enclosing spans.
+# Spans are kept per thread, so the download pool's per-file spans nest
+# correctly. Process pool workers record into worker_spans() and return the
+# records with their results; the parent adds them with merge_worker_spans().
+# Nothing is recorded until start_profiling() is called, and a disabled span
+# costs one attribute lookup.
+#
+# Scripts switch profiling on with the PIPELINE_PROFILE environment variable:
+#   PIPELINE_PROFILE=spans        span JSON + Chrome trace (chrome://tracing, Perfetto)
+#   PIPELINE_PROFILE=cprofile     the above plus a cProfile .prof dump
+#   PIPELINE_PROFILE=pyinstrument the above plus a pyinstrument HTML report
+
+PROFILE_ENV_VAR = "PIPELINE_PROFILE"
+PROFILE_MODES = ("spans", "cprofile", "pyinstrument")
+
+_state = {'enabled': False, 'mode': None, 'origin': 0.0, 'origin_wall': 0.0, 'hook': None}
+_spans = []
+_spans_lock = threading.Lock()
+_local = threading.local()
+
+
+def _peak_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1e6 if sys.platform == "darwin" else rss / 1024.0 # bytes on macOS, KiB on Linux
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+    return _local.stack
+
+
+def profiling_enabled():
+    """True between start_profiling() and stop_profiling()."""
+    return _state['enabled']
+
+
+def start_profiling(mode="spans"):
+    """
+    Starts recording spans, plus a cProfile or pyinstrument hook if requested.
+
+    Args:
+        mode (str): One of PROFILE_MODES.
+    """
+    if mode not in PROFILE_MODES:
+        raise ValueError(f"Unknown profiling mode {mode!r}; expected one of {PROFILE_MODES}.")
+    with _spans_lock:
+        _spans.clear()
+    _state.update(enabled=True, mode=mode, origin=time.perf_counter(), origin_wall=time.time(), hook=None)
+
+    if mode == "cprofile":
+        import cProfile
+        _state['hook'] = cProfile.Profile()
+        _state['hook'].enable()
+    elif mode == "pyinstrument":
+        try:
+            from pyinstrument import Profiler
+        except ImportError:
+            print("Warning: pyinstrument is not installed. Recording spans only.")
+        else:
+            _state['hook'] = Profiler()
+            _state['hook'].start()
+
+
+@contextlib.contextmanager
+def span(name, **attrs):
+    """
+    Records one timed span. A no-op unless profiling is enabled.
+
+    Args:
+        name (str): Stage name, e.g. "scan_lidar_tiles".
+        **attrs: Extra JSON-serialisable attributes, e.g. tile="ANA_A01_2017_laz_0.laz".
+    """
+    if not _state['enabled']:
+        yield
+        return
+
+    record = {'name': name, 'attrs': attrs, 'counters': {}}
+    stack = _stack()
+    record['depth'] = len(stack)
+    stack.append(record)
+    start_wall = time.perf_counter()
+    start_cpu = time.thread_time()
+    try:
+        yield
+    finally:
+        stack.pop()
+        record['start_s'] = start_wall - _state['origin']
+        record['wall_s'] = time.perf_counter() - start_wall
+        record['cpu_s'] = time.thread_time() - start_cpu
+        record['peak_rss_mb'] = _peak_rss_mb()
+        record['thread'] = threading.get_ident()
+        if stack: # Roll counters up into the enclosing span
+            parent = stack[-1]['counters']
+            for key, value in record['counters'].items():
+                parent[key] = parent.get(key, 0) + value
+        with _spans_lock:
+            _spans.append(record)
+
+
+def add_counter(name, value):
+    """Adds value to a counter (e.g. "bytes_read") on the innermost open span."""
+    if _state['enabled']:
+        stack = _stack()
+        if stack:
+            counters = stack[-1]['counters']
+            counters[name] = counters.get(name, 0) + value
+
+
+@contextlib.contextmanager
+def worker_spans(enabled):
+    """
+    Records the spans of one task in a process pool worker.
+
+    Pass profiling_enabled() from the parent as enabled. The yielded list is
+    filled with the task's span records when the block exits; return it with
+    the task's result and hand it to merge_worker_spans() in the parent.
+
+    Args:
+        enabled (bool): Whether the parent is profiling.
+    """
+    records = []
+    if not enabled:
+        yield records
+        return
+    with _spans_lock:
+        _spans.clear() # Drop any records inherited from a forked parent
+    _local.stack = []
+    _state.update(enabled=True, mode="spans", origin=time.perf_counter(), origin_wall=time.time(), hook=None)
+    try:
+        yield records
+    finally:
+        _state['enabled'] = False
+        with _spans_lock:
+            for record in _spans:
+                record['start_s'] += _state['origin_wall'] # Absolute time, comparable across processes
+                record['pid'] = os.getpid()
+            records.extend(_spans)
+            _spans.clear()
+
+
+def merge_worker_spans(records):
+    """
+    Adds span records returned by a worker (see worker_spans) to this run.
+
+    They are nested under the calling thread's innermost open span, whose
+    counters receive the workers' top-level counters.
+
+    Args:
+        records (list): Span records from worker_spans.
+    """
+    if not _state['enabled'] or not records:
+        return
+    stack = _stack()
+    for record in records:
+        if stack and record['depth'] == 0:
+            parent = stack[-1]['counters']
+            for key, value in record['counters'].items():
+                parent[key] = parent.get(key, 0) + value
+        record['start_s'] -= _state['origin_wall']
+        record['depth'] += len(stack)
+    with _spans_lock:
+        _spans.extend(records)
+
+
+def _chrome_trace(spans):
+    """Converts span records to Chrome trace-event JSON (complete 'X' events)."""
+    pid = os.getpid()
+    events = []
+    for s in sorted(spans, key=lambda s: s['start_s']):
+        events.append({
+            'name': s['name'],
+            'cat': 'pipeline',
+            'ph': 'X',
+            'ts': s['start_s'] * 1e6,
+            'dur': s['wall_s'] * 1e6,
+            'pid': s.get('pid', pid),
+            'tid': s['thread'],
+            'args': {**s['attrs'], **s['counters'], 'cpu_s': s['cpu_s'], 'peak_rss_mb': s['peak_rss_mb']},
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+def stop_profiling(output_dir, run_name):
+    """
+    Stops recording and writes the profile files for a run.
+
+    Files written to output_dir:
+        <run_name>_spans.json  span records, in start order
+        <run_name>_trace.json  Chrome trace of the same spans
+        <run_name>.prof        cProfile stats (mode "cprofile")
+        <run_name>_pyinstrument.html (mode "pyinstrument")
+
+    Args:
+        output_dir (str): Directory for the profile files.
+        run_name (str): File name prefix, e.g. "match_lidar_to_segments".
+
+    Returns:
+        list: Paths of the files written.
+    """
+    if not _state['enabled']:
+        return []
+    _state['enabled'] = False
+    hook, mode = _state['hook'], _state['mode']
+    with _spans_lock:
+        spans = sorted(_spans, key=lambda s: s['start_s'])
+        _spans.clear()
+
+    os.makedirs(output_dir, exist_ok=True)
+    written = []
+    spans_path = os.path.join(output_dir, f"{run_name}_spans.json")
+    with open(spans_path, "w") as f:
+        json.dump({'run': run_name, 'mode': mode, 'spans': spans}, f, indent=2, default=str)
+    written.append(spans_path)
+
+    trace_path = os.path.join(output_dir, f"{run_name}_trace.json")
+    with open(trace_path, "w") as f:
+        json.dump(_chrome_trace(spans), f, default=str)
+    written.append(trace_path)
+
+    if mode == "cprofile" and hook is not None:
+        hook.disable()
+        prof_path = os.path.join(output_dir, f"{run_name}.prof")
+        hook.dump_stats(prof_path)
+        written.append(prof_path)
+    elif mode == "pyinstrument" and hook is not None:
+        hook.stop()
+        html_path = os.path.join(output_dir, f"{run_name}_pyinstrument.html")
+        with open(html_path, "w") as f:
+            f.write(hook.output_html())
+        written.append(html_path)
+
+    return written
+
+
+def print_span_summary(spans_path, top=15):
+    """Prints the slowest spans (stages and tiles) of a written span file."""
+    with open(spans_path) as f:
+        spans = json.load(f)['spans']
+    print(f"\n--- Slowest spans ({os.path.basename(spans_path)}) ---")
+    for s in sorted(spans, key=lambda s: s['wall_s'], reverse=True)[:top]:
+        label = s['name'] + (f" [{', '.join(f'{k}={v}' for k, v in s['attrs'].items())}]" if s['attrs'] else "")
+        counters = ", ".join(f"{k}={v:,}" for k, v in s['counters'].items())
+        print(f"{s['wall_s']:9.3f} s wall {s['cpu_s']:9.3f} s cpu {s['peak_rss_mb']:8.1f} MB rss  {label}"
+              + (f"  ({counters})" if counters else ""))
+
+
+@contextlib.contextmanager
+def profiled_run(output_dir, run_name, mode=None):
+    """
+    Profiles the enclosed block if a mode is given or PIPELINE_PROFILE is set.
+
+    Args:
+        output_dir (str): Where stop_profiling writes its files.
+        run_name (str): File name prefix.
+        mode (str, optional): Overrides PIPELINE_PROFILE.
+    """
+    mode = mode or os.environ.get(PROFILE_ENV_VAR)
+    if not mode:
+        yield
+        return
+    start_profiling(mode)
+    try:
+        with span(run_name):
+            yield
+    finally:
+        written = stop_profiling(output_dir, run_name)
+        if written:
+            print_span_summary(written[0])
+            print("Profile written to:")
+            for path in written:
+                print(f" - {path}")
@@ -0,0 +1,262 @@
+import hashlib
+import os
+import numpy as np
+import pandas as pd
+import geopandas as gpd
+import shapely
+from geo_io import read_geotable, write_geotable
+from reprojection import get_transformer, estimate_utm_crs
+
+# Published site coordinates for the "negative evidence" cross-check: segments
+# and candidate detections are compared against known earthworks so we do not
+# report rediscoveries.
+#
+# The source is the 'sites' sheet of archaeogeodesy.xls (~8,000 sites worldwide,
+# WGS84 lat/lon). Parsing the workbook takes about half a second, so
+# load_known_sites converts it once into a GeoParquet table cached next to the
+# workbook, keyed by a hash of the .xls. build_site_index then projects the
+# sites around a study area into its metric CRS and puts them in an STRtree,
+# after which nearest-site and within-radius lookups cost microseconds each.
+
+KNOWN_SITES_XLS = os.path.join("Ancient Earthworks", "archaeogeodesy.xls")
+SITES_SHEET = "sites"
+SITES_CACHE_DIRNAME = ".known_sites_cache"
+USER_INPUT_CODES = ("user", "user2") # Editable input cells of the workbook, not sites
+DEFAULT_SEARCH_RADIUS_M = 300_000
+DEFAULT_COUNT_RADII_M = (1_000, 5_000, 10_000)
+EARTH_RADIUS_M = 6_371_008.8
+
+
+def _file_hash(path):
+    hasher = hashlib.blake2b(digest_size=8)
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _text_column(values):
+    """Spreadsheet text cells hold a mix of str, float and datetime; keep them as str or None."""
+    return [None if pd.isna(v) else str(v).strip() for v in values]
+
+
+def parse_sites_sheet(xls_path):
+    """
+    Reads the 'sites' sheet of archaeogeodesy.xls into a point table.
+
+    Rows without valid coordinates (notes, headers, the lookup helper at the
+    bottom of the sheet) and the workbook's user-input rows are dropped, as are
+    repeated site codes.
+
+    Args:
+        xls_path (str): Path to archaeogeodesy.xls.
+
+    Returns:
+        geopandas.GeoDataFrame: site_code, name, lat, lon, elevation_m, source; EPSG:4326 points.
+    """
+    raw = pd.read_excel(xls_path, sheet_name=SITES_SHEET, header=0)
+    sites = pd.DataFrame({
+        'site_code': _text_column(raw['aegeo']),
+        'name': _text_column(raw['location']),
+        'lat': pd.to_numeric(raw['lat'], errors='coerce'),
+        'lon': pd.to_numeric(raw['lon'], errors='coerce'),
+        'elevation_m': pd.to_numeric(raw['elevation m'], errors='coerce'),
+        'source': _text_column(raw['source']),
+    })
+    valid = (
+        sites['site_code'].notna()
+        & ~sites['site_code'].isin(USER_INPUT_CODES)
+        & sites['lat'].between(-90, 90)
+        & sites['lon'].between(-180, 180)
+    )
+    sites = sites[valid].drop_duplicates(subset='site_code', keep='first').reset_index(drop=True)
+    return gpd.GeoDataFrame(sites, geometry=gpd.points_from_xy(sites['lon'], sites['lat']), crs="EPSG:4326")
+
+
+def load_known_sites(xls_path, cache_dir=None):
+    """
+    Returns the known-site table, parsing the workbook only when it has changed.
+
+    Args:
+        xls_path (str): Path to archaeogeodesy.xls.
+        cache_dir (str, optional): Where the cached GeoParquet goes. Defaults to
+            .known_sites_cache next to the workbook.
+
+    Returns:
+        geopandas.GeoDataFrame: See parse_sites_sheet.
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(xls_path)), SITES_CACHE_DIRNAME)
+    stem = os.path.splitext(os.path.basename(xls_path))[0]
+    cache_path = os.path.join(cache_dir, f"{stem}_{_file_hash(xls_path)}.parquet")
+    if os.path.exists(cache_path):
+        return read_geotable(cache_path)
+
+    print(f"Parsing known sites from {xls_path}...")
+    sites = parse_sites_sheet(xls_path)
+    os.makedirs(cache_dir, exist_ok=True)
+    write_geotable(sites, cache_path)
+    print(f"Cached {len(sites)} known sites to {cache_path}")
+    return sites
+
+
+def build_site_index(sites_gdf, target_crs, extent=None, search_radius_m=DEFAULT_SEARCH_RADIUS_M):
+    """
+    Builds an STRtree over the known sites near a study area, in a metric CRS.
+
+    Only sites within search_radius_m of the extent are indexed, which keeps
+    the projection accurate (a UTM zone is not usable on the other side of the
+    globe). Lookups farther out than that fall back to a great-circle scan.
+
+    Args:
+        sites_gdf (geopandas.GeoDataFrame): Output of load_known_sites.
+        target_crs (str): Projected CRS the queries will be made in, e.g. "EPSG:32722".
+        extent (tuple, optional): (minx, miny, maxx, maxy) of the query geometries in
+            target_crs. Defaults to indexing every site.
+        search_radius_m (float): Margin around the extent.
+
+    Returns:
+        dict: 'tree', 'sites' (the indexed rows), 'crs', 'search_radius_m', plus the
+            lon/lat of every site for the great-circle fallback.
+    """
+    lon = sites_gdf['lon'].to_numpy(dtype=float)
+    lat = sites_gdf['lat'].to_numpy(dtype=float)
+    selected = np.ones(len(sites_gdf), dtype=bool)
+    if extent is not None:
+        minx, miny, maxx, maxy = get_transformer(target_crs, "EPSG:4326").transform_bounds(*extent, densify_pts=21)
+        dlat = np.degrees(search_radius_m / EARTH_RADIUS_M)
+        coslat = max(np.cos(np.radians(max(abs(miny - dlat), abs(maxy + dlat)))), 1e-6)
+        dlon = min(dlat / coslat, 180.0)
+        selected = (lat >= miny - dlat) & (lat <= maxy + dlat) & (lon >= minx - dlon) & (lon <= maxx + dlon)
+
+    x, y = get_transformer("EPSG:4326", target_crs).transform(lon[selected], lat[selected])
+    finite = np.isfinite(x) & np.isfinite(y)
+    indexed = sites_gdf.loc[selected].loc[finite].drop(columns='geometry').reset_index(drop=True)
+    return {
+        'tree': shapely.STRtree(shapely.points(x[finite], y[finite])),
+        'sites': indexed,
+        'crs': target_crs,
+        'search_radius_m': search_radius_m if extent is not None else np.inf,
+        'all_lon': lon,
+        'all_lat': lat,
+        'all_codes': sites_gdf['site_code'].to_numpy(),
+    }
+
+
+def _great_circle_nearest(index, geometries):
+    """Haversine scan over every site from each geometry's representative point."""
+    points = shapely.point_on_surface(geometries)
+    px, py = get_transformer(index['crs'], "EPSG:4326").transform(shapely.get_x(points), shapely.get_y(points))
+    site_lon, site_lat = np.radians(index['all_lon']), np.radians(index['all_lat'])
+    distances = np.full(len(points), np.nan)
+    codes = np.full(len(points), None, dtype=object)
+    for i, (qlon, qlat) in enumerate(zip(np.radians(px), np.radians(py))):
+        if not np.isfinite(qlon) or len(site_lon) == 0:
+            continue
+        h = (np.sin((site_lat - qlat) / 2) ** 2
+             + np.cos(qlat) * np.cos(site_lat) * np.sin((site_lon - qlon) / 2) ** 2)
+        nearest = int(np.argmin(h))
+        distances[i] = 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(min(h[nearest], 1.0)))
+        codes[i] = index['all_codes'][nearest]
+    return distances, codes
+
+
+def nearest_known_sites(index, geometries):
+    """
+    Distance from each geometry to its nearest known site.
+
+    Distances are planar in the index CRS (exact for lines and polygons, not
+    just their centroids). Geometries whose nearest indexed site is farther
+    than the index's search radius get a great-circle distance from their
+    representative point instead.
+
+    Args:
+        index (dict): Output of build_site_index.
+        geometries (array-like): Shapely geometries in the index CRS.
+
+    Returns:
+        tuple: (distances_m float array, site_codes object array), NaN/None for empty geometries.
+    """
+    geometries = np.asarray(geometries, dtype=object)
+    distances = np.full(len(geometries), np.nan)
+    codes = np.full(len(geometries), None, dtype=object)
+    if len(index['sites']) > 0 and len(geometries) > 0:
+        (query_idx, site_idx), found = index['tree'].query_nearest(geometries, return_distance=True, all_matches=False)
+        distances[query_idx] = found
+        codes[query_idx] = index['sites']['site_code'].to_numpy()[site_idx]
+
+    far = ~(distances <= index['search_radius_m']) & ~shapely.is_empty(geometries)
+    if far.any():
+        distances[far], codes[far] = _great_circle_nearest(index, geometries[far])
+    return distances, codes
+
+
+def count_known_sites_within(index, geometries, radius_m):
+    """
+    Number of known sites within radius_m of each geometry.
+
+    Args:
+        index (dict): Output of build_site_index.
+        geometries (array-like): Shapely geometries in the index CRS.
+        radius_m (float): Search radius; must not exceed the index's search radius.
+
+    Returns:
+        numpy.ndarray: int64 counts.
+    """
+    if radius_m > index['search_radius_m']:
+        raise ValueError(f"radius_m={radius_m} exceeds the index search radius of {index['search_radius_m']} m.")
+    geometries = np.asarray(geometries, dtype=object)
+    query_idx, _ = index['tree'].query(geometries, predicate="dwithin", distance=radius_m)
+    return np.bincount(query_idx, minlength=len(geometries)).astype(np.int64)
+
+
+def annotate_known_sites(gdf, sites_gdf, radii_m=DEFAULT_COUNT_RADII_M, search_radius_m=DEFAULT_SEARCH_RADIUS_M):
+    """
+    Adds known-site proximity columns to segments or candidate detections.
+
+    Columns added:
+        nearest_known_site_m: distance to the nearest published site.
+        nearest_known_site: its site code.
+        known_sites_<r>km: number of sites within each radius.
+
+    Args:
+        gdf (geopandas.GeoDataFrame): Geometries to annotate. Geographic CRSs are
+            measured in their UTM zone.
+        sites_gdf (geopandas.GeoDataFrame): Output of load_known_sites.
+        radii_m (tuple): Count radii in metres.
+        search_radius_m (float): Passed to build_site_index.
+
+    Returns:
+        geopandas.GeoDataFrame: A copy of gdf with the new columns.
+    """
+    if gdf.crs is None:
+        crs, geometries = "EPSG:32722", gdf.geometry.to_numpy()
+    elif gdf.crs.is_projected:
+        crs, geometries = gdf.crs.to_string(), gdf.geometry.to_numpy()
+    else:
+        crs = estimate_utm_crs(gdf)
+        geometries = gdf.geometry.to_crs(crs).to_numpy()
+    index = build_site_index(sites_gdf, crs, extent=shapely.total_bounds(geometries),
+                             search_radius_m=max(search_radius_m, *radii_m))
+
+    annotated = gdf.copy()
+    annotated['nearest_known_site_m'], annotated['nearest_known_site'] = nearest_known_sites(index, geometries)
+    for radius_m in radii_m:
+        annotated[f"known_sites_{radius_m / 1000:g}km"] = count_known_sites_within(index, geometries, radius_m)
+    return annotated
+
+
+if __name__ == "__main__":
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    known_sites_xls = os.path.join(base_dir, KNOWN_SITES_XLS)
+    segments_file = os.path.join(base_dir, "gis_outputs", "river_segments.parquet")
+
+    sites = load_known_sites(known_sites_xls)
+    print(f"Loaded {len(sites)} known sites.")
+    if os.path.exists(segments_file):
+        segments = annotate_known_sites(read_geotable(segments_file), sites)
+        print(segments[['segment_id', 'nearest_known_site_m', 'nearest_known_site']
+                       + [c for c in segments.columns if c.startswith("known_sites_")]].to_string())
+    else:
+        print(f"Segments file not found: {segments_file}. Run define_river_corridor.py to cross-check segments.")
@@ -0,0 +1,231 @@
+import struct
+import os
+import re
+
+# LAS public header block layout (ASPRS LAS 1.0 - 1.4). Only the fields needed
+# for bounds, point count and CRS discovery are decoded; the point records
+# themselves are never touched, so reading a multi-hundred-MB .laz costs a
+# few hundred bytes of I/O.
+LAS_SIGNATURE = b"LASF"
+PUBLIC_HEADER_MIN_SIZE = 227
+VLR_HEADER_SIZE = 54
+EVLR_HEADER_SIZE = 60
+
+PROJECTION_USER_ID = "LASF_Projection"
+GEOKEY_DIRECTORY_RECORD_ID = 34735
+OGC_WKT_RECORD_ID = 2112  # OGC coordinate system WKT
+
+# GeoTIFF keys that carry an EPSG code for the horizontal CRS. The model type
+# says which of the two describes the coordinates: a projected CRS also carries
+# the geographic CRS it is based on.
+GT_MODEL_TYPE_GEOKEY = 1024
+MODEL_TYPE_PROJECTED = 1
+MODEL_TYPE_GEOGRAPHIC = 2
+PROJECTED_CS_TYPE_GEOKEY = 3072
+GEOGRAPHIC_TYPE_GEOKEY = 2048
+USER_DEFINED_GEOKEY_VALUE = 32767
+
+# Matches WKT1 AUTHORITY["EPSG","32722"] and WKT2 ID["EPSG",32722]
+EPSG_WKT_ID_PATTERN = re.compile(r'(?:AUTHORITY|ID)\[\s*"EPSG"\s*,\s*"?(\d+)"?\s*\]')
+
+
+def _decode_text(raw_bytes):
+    """Decodes a fixed-width, NUL-padded header string."""
+    return raw_bytes.split(b"\x00", 1)[0].decode("utf-8", errors="replace").strip()
+
+
+def _epsg_from_geokeys(record_data):
+    """
+    Extracts a horizontal EPSG code from a GeoKeyDirectoryTag VLR payload.
+
+    Args:
+        record_data (bytes): Raw payload of the LASF_Projection/34735 record.
+
+    Returns:
+        str or None: EPSG code as string (e.g., "EPSG:32722") or None if the
+                     keys are absent or user-defined (callers then fall back to
+                     the WKT or the tile inventory).
+    """
+    if len(record_data) < 8:
+        return None
+    number_of_keys = struct.unpack_from("<4H", record_data, 0)[3]
+    keys = {}
+    for i in range(number_of_keys):
+        offset = 8 + i * 8
+        if offset + 8 > len(record_data):
+            break
+        key_id, tiff_tag_location, count, value_offset = struct.unpack_from("<4H", record_data, offset)
+        # A TIFFTagLocation of 0 means the value is stored inline in value_offset
+        if tiff_tag_location == 0:
+            keys[key_id] = value_offset
+
+    model_type = keys.get(GT_MODEL_TYPE_GEOKEY)
+    if model_type == MODEL_TYPE_PROJECTED:
+        key_id = PROJECTED_CS_TYPE_GEOKEY
+    elif model_type == MODEL_TYPE_GEOGRAPHIC:
+        key_id = GEOGRAPHIC_TYPE_GEOKEY
+    elif model_type is None: # Writers that omit the model type: a projected key wins if present
+        key_id = PROJECTED_CS_TYPE_GEOKEY if PROJECTED_CS_TYPE_GEOKEY in keys else GEOGRAPHIC_TYPE_GEOKEY
+    else: # Geocentric or user-defined model
+        return None
+    value = keys.get(key_id)
+    if not value or value == USER_DEFINED_GEOKEY_VALUE:
+        return None
+    return f"EPSG:{value}"
+
+
+def _horizontal_wkt(wkt):
+    """The first component of a COMPD_CS/COMPOUNDCRS (its horizontal CRS), else wkt itself."""
+    if not re.match(r"\s*(COMPD_CS|COMPOUNDCRS)\s*\[", wkt):
+        return wkt
+    start = re.search(r"\b(PROJCS|GEOGCS|PROJCRS|GEOGCRS|GEODCRS|BASEGEOGCRS)\s*\[", wkt[wkt.index("[") + 1:])
+    if start is None:
+        return wkt
+    begin = wkt.index("[") + 1 + start.start()
+    depth = 0
+    for i in range(begin, len(wkt)):
+        if wkt[i] == "[":
+            depth += 1
+        elif wkt[i] == "]":
+            depth -= 1
+            if depth == 0:
+                return wkt[begin:i + 1]
+    return wkt
+
+
+def epsg_from_wkt(wkt):
+    """
+    Extracts the EPSG code of the horizontal CRS from a WKT1 or WKT2 string.
+
+    The WKT is parsed with pyproj; for a compound CRS (horizontal + vertical)
+    the horizontal component is used, never the vertical datum. If pyproj
+    cannot parse or identify it, the identifier of the horizontal element is
+    read directly: it is written last within that element, after the nested
+    GEOGCS/DATUM/ELLIPSOID identifiers.
+
+    Args:
+        wkt (str): Well-known text CRS definition.
+
+    Returns:
+        str or None: EPSG code as string (e.g., "EPSG:32722") or None if not found.
+    """
+    if not wkt:
+        return None
+    try:
+        from pyproj import CRS
+
+        crs = CRS.from_wkt(wkt)
+        if crs.is_compound and crs.sub_crs_list:
+            crs = crs.sub_crs_list[0]
+        code = crs.to_epsg()
+        if code:
+            return f"EPSG:{code}"
+    except Exception: # Unparseable WKT; fall through to reading the identifier
+        pass
+    matches = EPSG_WKT_ID_PATTERN.findall(_horizontal_wkt(wkt))
+    if not matches:
+        return None
+    return f"EPSG:{matches[-1]}"
+
+
+def _scan_crs_records(records):
+    """
+    Looks through (user_id, record_id, data) tuples for CRS information.
+
+    Returns:
+        tuple: (crs_epsg_code, wkt, has_crs_record)
+    """
+    crs_epsg_code = None
+    wkt = None
+    has_crs_record = False
+    for user_id, record_id, data in records:
+        if user_id != PROJECTION_USER_ID:
+            continue
+        if record_id == OGC_WKT_RECORD_ID:
+            has_crs_record = True
+            wkt = _decode_text(data)
+            # WKT takes precedence over GeoKeys when both are present (LAS 1.4 rule)
+            crs_epsg_code = epsg_from_wkt(wkt) or crs_epsg_code
+        elif record_id == GEOKEY_DIRECTORY_RECORD_ID:
+            has_crs_record = True
+            if not crs_epsg_code:
+                crs_epsg_code = _epsg_from_geokeys(data)
+    return crs_epsg_code, wkt, has_crs_record
+
+
+def read_las_header(laz_file_path):
+    """
+    Reads the LAS/LAZ public header and projection VLRs without decoding points.
+
+    Args:
+        laz_file_path (str): Path to the .las/.laz file.
+
+    Returns:
+        dict: {
+            'version': "1.2", 'point_format': int, 'point_count': int,
+            'bounds': {'minx', 'miny', 'maxx', 'maxy', 'minz', 'maxz'},
+            'crs_epsg_code': str or None, 'wkt': str or None,
+            'has_crs_record': bool
+        }
+
+    Raises:
+        ValueError: If the file is not a LAS/LAZ file or its header is truncated.
+        OSError: If the file cannot be opened.
+    """
+    with open(laz_file_path, "rb") as f:
+        header = f.read(375)  # Largest public header (LAS 1.4)
+        if len(header) < PUBLIC_HEADER_MIN_SIZE or header[:4] != LAS_SIGNATURE:
+            raise ValueError(f"{laz_file_path} is not a LAS/LAZ file (missing LASF signature or truncated header)")
+
+        version_major, version_minor = struct.unpack_from("<2B", header, 24)
+        header_size = struct.unpack_from("<H", header, 94)[0]
+        number_of_vlrs = struct.unpack_from("<I", header, 100)[0]
+        point_format = struct.unpack_from("<B", header, 104)[0] & 0x3F  # LAZ sets the high bits
+        point_count = struct.unpack_from("<I", header, 107)[0]
+        max_x, min_x, max_y, min_y, max_z, min_z = struct.unpack_from("<6d", header, 179)
+
+        evlr_start, number_of_evlrs = 0, 0
+        if (version_major, version_minor) >= (1, 4) and len(header) >= 255:
+            evlr_start, number_of_evlrs, point_count_64 = struct.unpack_from("<QIQ", header, 235)
+            point_count = point_count_64 or point_count
+
+        records = []
+        f.seek(header_size)
+        for _ in range(number_of_vlrs):
+            vlr_header = f.read(VLR_HEADER_SIZE)
+            if len(vlr_header) < VLR_HEADER_SIZE:
+                break
+            user_id = _decode_text(vlr_header[2:18])
+            record_id, record_length = struct.unpack_from("<HH", vlr_header, 18)
+            if user_id == PROJECTION_USER_ID:
+                records.append((user_id, record_id, f.read(record_length)))
+            else:
+                f.seek(record_length, os.SEEK_CUR)
+
+        if evlr_start and number_of_evlrs:
+            f.seek(evlr_start)
+            for _ in range(number_of_evlrs):
+                evlr_header = f.read(EVLR_HEADER_SIZE)
+                if len(evlr_header) < EVLR_HEADER_SIZE:
+                    break
+                user_id = _decode_text(evlr_header[2:18])
+                record_id, record_length = struct.unpack_from("<HQ", evlr_header, 18)
+                if user_id == PROJECTION_USER_ID:
+                    records.append((user_id, record_id, f.read(record_length)))
+                else:
+                    f.seek(record_length, os.SEEK_CUR)
+
+    crs_epsg_code, wkt, has_crs_record = _scan_crs_records(records)
+
+    return {
+        'version': f"{version_major}.{version_minor}",
+        'point_format': point_format,
+        'point_count': point_count,
+        'bounds': {
+            'minx': min_x, 'miny': min_y, 'maxx': max_x, 'maxy': max_y,
+            'minz': min_z, 'maxz': max_z,
+        },
+        'crs_epsg_code': crs_epsg_code,
+        'wkt': wkt,
+        'has_crs_record': has_crs_record,
+    }
@@ -0,0 +1,128 @@
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+import os
+import re
+
+# The tile inventory published with the ORNL DAAC 1644 dataset: one row per
+# .laz tile with its lat/lon extent, size and native UTM SRS.
+INVENTORY_CSV_FILENAME = "cms_brazil_lidar_tile_inventory.csv"
+INVENTORY_CSV_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "LiDAR: northern Mato Grosso near the Upper Xingu region",
+    INVENTORY_CSV_FILENAME,
+)
+
+
+def load_tile_inventory(inventory_csv_path=INVENTORY_CSV_PATH):
+    """
+    Loads the LiDAR tile inventory CSV as footprints in EPSG:4326.
+
+    Args:
+        inventory_csv_path (str): Path to cms_brazil_lidar_tile_inventory.csv.
+
+    Returns:
+        geopandas.GeoDataFrame: One row per tile with 'filename', 'file_size_mb',
+                                'expected_bytes', 'utmzone', 'srs' and a bbox geometry.
+    """
+    df = pd.read_csv(inventory_csv_path)
+    footprints = shapely.box(
+        df['min_lon'].to_numpy(), df['min_lat'].to_numpy(),
+        df['max_lon'].to_numpy(), df['max_lat'].to_numpy(),
+    )
+    inventory_gdf = gpd.GeoDataFrame(df, geometry=footprints, crs="EPSG:4326")
+    inventory_gdf['srs'] = inventory_gdf['srs'].str.strip()
+    inventory_gdf['expected_bytes'] = np.round(inventory_gdf['file_size_mb'] * 1e6).astype("int64")
+    return inventory_gdf
+
+
+def utm_zone_crs(utmzone):
+    """
+    Converts an inventory 'utmzone' value such as "21S" into a CRS string.
+
+    The inventory's srs column is UTM on GRS80 with a null datum shift, which
+    matches WGS 84 UTM to well under a millimetre, so the WGS 84 EPSG codes
+    are used.
+
+    Returns:
+        str or None: e.g. "EPSG:32721", or None if utmzone cannot be parsed.
+    """
+    match = re.fullmatch(r"\s*(\d{1,2})\s*([A-Za-z])\s*", str(utmzone))
+    if not match or not 1 <= int(match.group(1)) <= 60:
+        return None
+    # The inventory writes hemispheres ("21S" is zone 21 south, as its srs says), so N and S
+    # are read as hemispheres, not as MGRS latitude bands; other bands C-M are south
+    letter = match.group(2).upper()
+    south = letter == "S" or (letter != "N" and letter < "N")
+    return f"EPSG:{(32700 if south else 32600) + int(match.group(1))}"
+
+
+def inventory_tile_crs(inventory_gdf):
+    """
+    Maps each inventory tile to its native CRS.
+
+    Used for tiles whose LAS header carries no CRS record. The CRS comes from
+    the 'utmzone' column, falling back to the proj4 'srs' string.
+
+    Args:
+        inventory_gdf (pandas.DataFrame): Output of load_tile_inventory.
+
+    Returns:
+        dict: {filename: CRS string}; tiles with neither column set are left out.
+    """
+    tile_crs = {}
+    for file_name, utmzone, srs in zip(inventory_gdf['filename'], inventory_gdf['utmzone'], inventory_gdf['srs']):
+        crs = utm_zone_crs(utmzone) if pd.notna(utmzone) else None
+        if crs is None and isinstance(srs, str) and srs.strip():
+            crs = srs.strip()
+        if crs is not None:
+            tile_crs[file_name] = crs
+    return tile_crs
+
+
+def build_inventory_index(inventory_gdf):
+    """
+    Builds an STRtree over the inventory footprints.
+
+    Args:
+        inventory_gdf (geopandas.GeoDataFrame): Output of load_tile_inventory.
+
+    Returns:
+        shapely.STRtree: Tree whose query indices are positions in inventory_gdf.
+    """
+    return shapely.STRtree(inventory_gdf.geometry.values)
+
+
+def select_tiles_for_corridor(corridor, inventory_gdf=None, tree=None):
+    """
+    Returns the inventory tiles whose footprint intersects a corridor.
+
+    Args:
+        corridor (geopandas.GeoDataFrame or GeoSeries): Corridor polygon(s) with a CRS,
+            e.g. the corridor_gdf returned by define_river_corridor_and_segments.
+        inventory_gdf (geopandas.GeoDataFrame, optional): Output of load_tile_inventory.
+            Loaded from INVENTORY_CSV_PATH if omitted.
+        tree (shapely.STRtree, optional): Prebuilt index over inventory_gdf, to reuse
+            across many queries.
+
+    Returns:
+        geopandas.GeoDataFrame: Matching inventory rows (EPSG:4326), sorted by filename.
+            The total expected download size is sum(selected['expected_bytes']).
+    """
+    if inventory_gdf is None:
+        inventory_gdf = load_tile_inventory()
+    if tree is None:
+        tree = build_inventory_index(inventory_gdf)
+
+    corridor_geoms = corridor.geometry if isinstance(corridor, gpd.GeoDataFrame) else corridor
+    if corridor_geoms.crs is None:
+        raise ValueError("Corridor geometry has no CRS; cannot compare with the tile inventory.")
+    corridor_4326 = corridor_geoms.to_crs(inventory_gdf.crs)
+
+    _, tile_idx = tree.query(corridor_4326.values, predicate="intersects")
+    selected = inventory_gdf.iloc[np.unique(tile_idx)].sort_values('filename')
+
+    print(f"Inventory pre-selection: {len(selected)} of {len(inventory_gdf)} tiles intersect the corridor "
+          f"({selected['expected_bytes'].sum()/1e6:.1f} MB of {inventory_gdf['expected_bytes'].sum()/1e6:.1f} MB).")
+    return selected
@@ -1,13 +1,150 @@
 import geopandas as gpd
-from shapely.geometry import box
-import pdal
+import shapely
 import json
 import os
 import glob
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import pandas as pd
+from geo_io import read_geotable, write_geotable
+from instrumentation import span, profiled_run, profiling_enabled, worker_spans, merge_worker_spans
+from las_header import read_las_header, epsg_from_wkt
+from point_index import iter_points_in_area
+from point_stream import DEFAULT_CHUNK_SIZE, assumed_tile_crs_for
+from reprojection import reproject_bounds, estimate_utm_crs, same_crs
+from segment_features import build_segment_cell_grid, points_to_cells
+from tile_catalog import (
+    open_tile_catalog, file_signature, load_tile_records, save_tile_records,
+    save_footprints, prune_tile_records,
+)
+
+def _crs_from_pdal_srs(srs_data, laz_file_path):
+    """
+    Resolves an EPSG code from the 'srs' block of PDAL reader metadata.
+
+    Args:
+        srs_data (dict): PDAL 'srs' metadata (wkt, proj4, horizontal, ...).
+        laz_file_path (str): Path of the file, used in log messages only.
+
+    Returns:
+        str or None: EPSG code as string (e.g., "EPSG:4326") or None if not parsable.
+    """
+    wkt = srs_data.get('wkt', None)
+    proj4 = srs_data.get('proj4', None)
+    crs_epsg_code = None
+
+    if wkt and wkt.strip():
+        crs_epsg_code = epsg_from_wkt(wkt)
+        if not crs_epsg_code and srs_data.get('authority') == 'EPSG' and srs_data.get('horizontal'):
+            crs_epsg_code = f"EPSG:{srs_data['horizontal']}"
+
+    if not crs_epsg_code and proj4 and "epsg" in proj4.lower():
+         # Attempt to extract from proj4 if it contains an EPSG code
+        try:
+            # Example: +init=epsg:4326
+            epsg_part = [p for p in proj4.split() if "epsg" in p.lower()][0]
+            crs_epsg_code = epsg_part.split(':')[1].upper()
+            if not crs_epsg_code.startswith("EPSG:"):
+                crs_epsg_code = f"EPSG:{crs_epsg_code}"
+        except Exception as e:
+            print(f"Could not parse EPSG from proj4 string '{proj4}' for {laz_file_path}: {e}")
+
+    if not crs_epsg_code:
+        print(f"Warning: No parsable EPSG code found for {laz_file_path}. WKT: {wkt[:100] if wkt else 'N/A'}, Proj4: {proj4 if proj4 else 'N/A'}")
+    return crs_epsg_code
+
+def get_laz_metadata_pdal(laz_file_path):
+    """
+    Reads bounds, CRS and point count through PDAL's quick-info (header-only) reader.
+
+    Used as a fallback when the native header reader cannot parse the file or
+    finds a CRS record it cannot resolve to an EPSG code.
+
+    Args:
+        laz_file_path (str): Path to the .laz file.
+
+    Returns:
+        dict or None: Same layout as get_laz_metadata, or None on failure.
+    """
+    try:
+        import pdal
+    except ImportError:
+        print(f"PDAL not found. Cannot fall back to PDAL quick-info for {laz_file_path}.")
+        return None
+
+    try:
+        pipeline_json = json.dumps({"pipeline": [{"type": "readers.las", "filename": laz_file_path}]})
+        pipeline = pdal.Pipeline(pipeline_json)
+        quickinfo = pipeline.quickinfo # Reads the header only; no points are decompressed
+
+        las_metadata = quickinfo.get('readers.las', {})
+        if isinstance(las_metadata, list):
+            las_metadata = las_metadata[0] if las_metadata else {}
+
+        b = las_metadata.get('bounds', {})
+        if not all(k in b for k in ['minx', 'miny', 'maxx', 'maxy']):
+            print(f"Warning: Could not extract bounds for {laz_file_path} from PDAL quick-info: {las_metadata}")
+            return None
+
+        return {
+            'bounds': {'minx': b['minx'], 'miny': b['miny'], 'maxx': b['maxx'], 'maxy': b['maxy']},
+            'crs_epsg_code': _crs_from_pdal_srs(las_metadata.get('srs', {}), laz_file_path),
+            'point_count': las_metadata.get('num_points'),
+        }
+
+    except Exception as e:
+        print(f"Error processing {laz_file_path} with PDAL. Exception Type: {type(e)}, Exception Repr: {repr(e)}, Exception Str: {str(e)}")
+        return None
+
+def get_laz_metadata(laz_file_path):
+    """
+    Reads a .laz file's bounding box, CRS and point count.
+
+    Only the LAS public header and the projection (GeoKey/WKT) VLRs are read,
+    so the cost is independent of the number of points in the tile. PDAL
+    quick-info is used only when the header cannot be parsed or carries a CRS
+    record that does not resolve to an EPSG code.
+
+    Args:
+        laz_file_path (str): Path to the .laz file.
+
+    Returns:
+        dict or None: {
+            'bounds': {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy},
+            'crs_epsg_code': EPSG code as string (e.g., "EPSG:4326") or None,
+            'point_count': int or None
+        }, or None if the file could not be read.
+    """
+    try:
+        header = read_las_header(laz_file_path)
+    except (OSError, ValueError) as e:
+        print(f"Could not read LAS header of {laz_file_path} ({e}). Falling back to PDAL quick-info.")
+        return get_laz_metadata_pdal(laz_file_path)
+
+    if header['has_crs_record'] and not header['crs_epsg_code']:
+        print(f"CRS record in {laz_file_path} has no EPSG code. Falling back to PDAL quick-info.")
+        pdal_metadata = get_laz_metadata_pdal(laz_file_path)
+        if pdal_metadata and pdal_metadata['crs_epsg_code']:
+            return pdal_metadata
+
+    b = header['bounds']
+    crs_epsg_code = header['crs_epsg_code']
+
+    if crs_epsg_code:
+        print(f"Found CRS {crs_epsg_code} for {laz_file_path}")
+    else:
+        print(f"Warning: No CRS record found in the header of {laz_file_path}.")
+
+    return {
+        'bounds': {'minx': b['minx'], 'miny': b['miny'], 'maxx': b['maxx'], 'maxy': b['maxy']},
+        'crs_epsg_code': crs_epsg_code,
+        'point_count': header['point_count'],
+    }
 
 def get_laz_bounds_and_crs(laz_file_path):
     """
-    Reads a .laz file to extract its bounding box and CRS information using PDAL.
+    Reads a .laz file to extract its bounding box and CRS information.
 
     Args:
         laz_file_path (str): Path to the .laz file.
@@ -17,174 +154,410 @@ def get_laz_bounds_and_crs(laz_file_path):
                bounds (dict): {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy}
                crs_epsg_code (str or None): EPSG code as string (e.g., "EPSG:4326") or None if not found/parsable.
     """
-    try:
-        # Create a PDAL pipeline to read metadata
-        pipeline_dict = {
-            "pipeline": [
-                {
-                    "type": "readers.las",
-                    "filename": laz_file_path
-                },
-                {
-                    "type": "filters.info" # Not strictly necessary for bounds/crs but good for general metadata
-                }
-            ]
-        }
-        pipeline_json = json.dumps(pipeline_dict)
-        
-        pipeline = pdal.Pipeline(pipeline_json)
-        # pipeline.validate() # Check if the pipeline is valid - REMOVED as it causes AttributeError
-        count = pipeline.execute() # Execute the pipeline to populate metadata
-        
-        metadata = pipeline.metadata # Directly use the metadata object, likely already a dict
-        
-        # Extract bounds
-        # PDAL metadata structure can vary slightly; common paths are checked.
-        if 'metadata' in metadata and 'readers.las' in metadata['metadata']: # PDAL 2.3+
-            reader_info_obj = metadata['metadata']['readers.las']
-
-            if isinstance(reader_info_obj, list):
-                if reader_info_obj: # Check if list is not empty
-                    las_metadata = reader_info_obj[0]
-                else:
-                    print(f"Warning: 'readers.las' metadata for {laz_file_path} is an empty list.")
-                    return None, None
-            elif isinstance(reader_info_obj, dict):
-                las_metadata = reader_info_obj # Use the dict directly
-            else:
-                print(f"Warning: 'readers.las' metadata for {laz_file_path} is neither a list nor a dict. Type: {type(reader_info_obj)}")
-                return None, None
-        elif 'stages' in metadata and 'readers.las' in metadata['stages']: # Older PDAL
-             # Find the readers.las stage metadata
-            las_info_list = [s for s in metadata['stages'] if s.get('type') == 'readers.las' or s.get('tag') == 'readers.las']
-            if not las_info_list:
-                 print(f"Warning: Could not find 'readers.las' metadata stage for {laz_file_path}")
-                 return None, None
-            las_metadata = las_info_list[0] # Take the first one
-        else: # Try root level for some PDAL versions or if only one reader
-            las_metadata = metadata
-
-        bounds_dict = {}
-        # Check for different ways bounds might be stored
-        if 'bbox' in las_metadata: # Common in recent PDAL versions
-            bbox_data = las_metadata['bbox']
-            if 'minx' in bbox_data and 'maxx' in bbox_data and 'miny' in bbox_data and 'maxy' in bbox_data:
-                 bounds_dict = {
-                    'minx': bbox_data['minx'], 'miny': bbox_data['miny'],
-                    'maxx': bbox_data['maxx'], 'maxy': bbox_data['maxy']
-                }
-        # Fallback to older/different metadata structures if 'bbox' isn't there or incomplete
-        if not bounds_dict and all(k in las_metadata for k in ['minx', 'miny', 'maxx', 'maxy']):
-            bounds_dict = {
-                'minx': las_metadata['minx'], 'miny': las_metadata['miny'],
-                'maxx': las_metadata['maxx'], 'maxy': las_metadata['maxy']
-            }
-        elif not bounds_dict and 'summary' in las_metadata and 'bounds' in las_metadata['summary']: # Another common place
-             b = las_metadata['summary']['bounds']
-             bounds_dict = {
-                'minx': b['minx'], 'miny': b['miny'],
-                'maxx': b['maxx'], 'maxy': b['maxy']
-            }
+    metadata = get_laz_metadata(laz_file_path)
+    if not metadata:
+        return None, None
+    return metadata['bounds'], metadata['crs_epsg_code']
+
+def _probe_laz_file(laz_file_path, profile=False):
+    """
+    Worker entry point for probe_laz_files: get_laz_metadata plus any exception text.
 
-        if not bounds_dict:
-            print(f"Warning: Could not extract bounds for {laz_file_path} from metadata: {las_metadata}")
-            return None, None
-
-        # Extract CRS
-        srs_data = las_metadata.get('srs', {})
-        wkt = srs_data.get('wkt', None)
-        proj4 = srs_data.get('proj4', None)
-        crs_epsg_code = None
-
-        if wkt and wkt.strip():
-            # Try to parse EPSG from WKT (this is a simplified approach)
-            # A more robust way would use pyproj or rasterio.crs.CRS.from_wkt(wkt).to_epsg()
-            # but that adds more dependencies if not already used.
-            # For now, let's see if PDAL gives an EPSG directly or if WKT contains it.
-            if "AUTHORITY[\"EPSG\"" in wkt:
+    Args:
+        laz_file_path (str): Path to the .laz file.
+        profile (bool): Record the probe's span in this worker process (see instrumentation.worker_spans).
+
+    Returns:
+        tuple: (laz_file_path, metadata or None, error message or None, span records)
+    """
+    metadata, error = None, None
+    with worker_spans(profile) as spans:
+        try:
+            with span("probe_tile", tile=os.path.basename(laz_file_path)):
+                metadata = get_laz_metadata(laz_file_path)
+        except Exception as e:
+            error = f"{type(e).__name__}: {e}"
+    return laz_file_path, metadata, error, spans
+
+def probe_laz_files(laz_files, workers=1):
+    """
+    Reads metadata for many .laz files, optionally across a process pool.
+
+    Files are scheduled largest first so the slowest tiles do not end up
+    running alone at the tail of the pool. A failure on one file is recorded
+    and never stops the others.
+
+    Args:
+        laz_files (list): Paths of the .laz files to probe.
+        workers (int): Number of worker processes. 1 probes in-process;
+                       None uses os.cpu_count().
+
+    Returns:
+        tuple: (metadata_by_path, failures)
+               metadata_by_path (dict): path -> metadata dict (see get_laz_metadata)
+               failures (list): [(path, reason), ...] in the order of laz_files
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(laz_files)))
+
+    if workers == 1:
+        results = [_probe_laz_file(f) for f in laz_files] # Spans go straight into this run
+    else:
+        largest_first = sorted(laz_files, key=lambda f: os.path.getsize(f), reverse=True)
+        print(f"Probing {len(laz_files)} LiDAR file(s) with {workers} worker processes...")
+        results = []
+        profile = profiling_enabled()
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {executor.submit(_probe_laz_file, f, profile): f for f in largest_first}
+            for future in as_completed(futures):
                 try:
-                    epsg_val = wkt.split("AUTHORITY[\"EPSG\",\"")[1].split("\"]")[0]
-                    crs_epsg_code = f"EPSG:{epsg_val}"
-                except IndexError:
-                    print(f"Could not parse EPSG from WKT for {laz_file_path}: {wkt[:100]}...") # Print start of WKT
-            if not crs_epsg_code and srs_data.get('authority') == 'EPSG' and srs_data.get('horizontal'):
-                crs_epsg_code = f"EPSG:{srs_data['horizontal']}"
-
-        if not crs_epsg_code and proj4 and "epsg" in proj4.lower():
-             # Attempt to extract from proj4 if it contains an EPSG code
-            try:
-                # Example: +init=epsg:4326
-                epsg_part = [p for p in proj4.split() if "epsg" in p.lower()][0]
-                crs_epsg_code = epsg_part.split(':')[1].upper()
-                if not crs_epsg_code.startswith("EPSG:"):
-                    crs_epsg_code = f"EPSG:{crs_epsg_code}"
-            except Exception as e:
-                print(f"Could not parse EPSG from proj4 string '{proj4}' for {laz_file_path}: {e}")
+                    results.append(future.result())
+                except Exception as e: # e.g. BrokenProcessPool if a worker died
+                    results.append((futures[future], None, f"{type(e).__name__}: {e}", []))
+
+    metadata_by_path = {}
+    failure_reasons = {}
+    for laz_file, metadata, error, spans in results:
+        merge_worker_spans(spans)
+        if metadata:
+            metadata_by_path[laz_file] = metadata
+        else:
+            failure_reasons[laz_file] = error or "missing bounds or read error"
+
+    failures = [(f, failure_reasons[f]) for f in laz_files if f in failure_reasons]
+    return metadata_by_path, failures
+
+def scan_lidar_tiles(lidar_data_dir, target_segment_crs, use_catalog=True, workers=1, tile_names=None,
+                     assumed_tile_crs=None):
+    """
+    Collects the footprint of every .laz tile in a directory.
 
+    With use_catalog, tile metadata and footprints are cached in a SQLite
+    sidecar (see tile_catalog.py) keyed by file name, size and mtime, so only
+    new or modified files are probed on reruns. Files that do need probing
+    are spread over `workers` processes (see probe_laz_files).
 
-        if crs_epsg_code:
-            print(f"Found CRS {crs_epsg_code} for {laz_file_path}")
+    Args:
+        lidar_data_dir (str): Directory containing .laz LiDAR files.
+        target_segment_crs (str): CRS the footprints are returned in.
+        use_catalog (bool): Read and update the on-disk tile catalog.
+        workers (int): Worker processes used to probe uncached files.
+        tile_names (iterable, optional): Only scan .laz files with these base names,
+            e.g. the 'filename' column of lidar_inventory.select_tiles_for_corridor.
+        assumed_tile_crs (str or dict, optional): CRS of tiles without a header CRS. Defaults to
+            the tile inventory next to the tiles (see point_stream.assumed_tile_crs_for); tiles
+            whose CRS is still unknown are skipped.
+
+    Returns:
+        tuple: (lidar_bounds_data, assumed_native_crs_count)
+               lidar_bounds_data (list): [{'file_path', 'geometry', 'point_count'}, ...]
+                                         in sorted file name order.
+               assumed_native_crs_count (int): Files without a header CRS whose CRS was taken
+                                               from assumed_tile_crs or the inventory.
+    """
+    laz_files = sorted(glob.glob(os.path.join(lidar_data_dir, "*.laz")))
+    if tile_names is not None:
+        wanted = set(tile_names)
+        all_files_count = len(laz_files)
+        laz_files = [f for f in laz_files if os.path.basename(f) in wanted]
+        print(f"Restricting scan to {len(laz_files)} of {all_files_count} .laz file(s) selected by the tile inventory.")
+
+    conn = None
+    cached_records = {}
+    if use_catalog:
+        try:
+            conn = open_tile_catalog(lidar_data_dir)
+            cached_records = load_tile_records(conn, target_segment_crs)
+        except sqlite3.Error as e:
+            print(f"Warning: Could not open tile catalog in {lidar_data_dir} ({e}). Probing all files.")
+            conn = None
+
+    signatures = {f: file_signature(f) for f in laz_files}
+    to_probe = []
+    for laz_file in laz_files:
+        record = cached_records.get(os.path.basename(laz_file))
+        if not (record and (record['file_size'], record['mtime_ns']) == signatures[laz_file]):
+            to_probe.append(laz_file)
+
+    with span("probe_laz_files", files=len(to_probe), workers=workers):
+        metadata_by_path, failures = probe_laz_files(to_probe, workers=workers)
+
+    # First pass: collect each tile's record; footprints missing from the catalog
+    # are then built in one batch, grouped by native CRS (see reprojection.py)
+    tiles = []
+    probed_records = {}
+    for laz_file in laz_files:
+        file_name = os.path.basename(laz_file)
+
+        if laz_file in metadata_by_path:
+            metadata = metadata_by_path[laz_file]
+            file_size, mtime_ns = signatures[laz_file]
+            record = {
+                'file_size': file_size,
+                'mtime_ns': mtime_ns,
+                'bounds': metadata['bounds'],
+                'native_crs': metadata['crs_epsg_code'],
+                'point_count': metadata['point_count'],
+                'footprint_wkb': None,
+            }
+            probed_records[file_name] = record
+        elif laz_file in to_probe:
+            continue # Failed to probe; reported below
         else:
-            print(f"Warning: No parsable EPSG code found for {laz_file_path}. WKT: {wkt[:100] if wkt else 'N/A'}, Proj4: {proj4 if proj4 else 'N/A'}")
-            
-        return bounds_dict, crs_epsg_code
+            record = cached_records[file_name]
+        tiles.append((laz_file, file_name, record))
+
+    # Header-less tiles take their CRS from assumed_tile_crs or the inventory, never from
+    # target_segment_crs. Their footprints are not cached: the assumption may change.
+    assumed_crs = {}
+    unknown_crs = []
+    for laz_file, file_name, record in tiles:
+        if not record['native_crs']:
+            crs = assumed_tile_crs_for(laz_file, assumed_tile_crs)
+            if crs:
+                assumed_crs[file_name] = crs
+            else:
+                unknown_crs.append(laz_file)
+    if unknown_crs:
+        unknown = set(unknown_crs)
+        tiles = [tile for tile in tiles if tile[0] not in unknown]
+
+    pending = [(file_name, record) for _, file_name, record in tiles
+               if record['footprint_wkb'] is None or file_name in assumed_crs]
+    new_footprints = {}
+    footprint_by_name = {}
+    if pending:
+        bounds = np.array([[r['bounds'][k] for k in ('minx', 'miny', 'maxx', 'maxy')] for _, r in pending])
+        native_crs = [r['native_crs'] or assumed_crs[file_name] for file_name, r in pending]
+        with span("reproject_footprints", tiles=len(pending)):
+            footprints = reproject_bounds(bounds, native_crs, target_segment_crs)
+        reprojected = [c for c in native_crs if not same_crs(c, target_segment_crs)]
+        if reprojected:
+            print(f"Reprojected {len(reprojected)} footprint(s) from {', '.join(sorted(set(reprojected)))} to {target_segment_crs}.")
+        for (file_name, record), footprint in zip(pending, footprints):
+            footprint_by_name[file_name] = footprint
+            if file_name in assumed_crs:
+                continue
+            record['footprint_wkb'] = shapely.to_wkb(footprint)
+            if file_name not in probed_records:
+                new_footprints[file_name] = record['footprint_wkb'] # Cached tile seen in a new target CRS
 
-    except Exception as e:
-        print(f"Error processing {laz_file_path} with PDAL. Exception Type: {type(e)}, Exception Repr: {repr(e)}, Exception Str: {str(e)}")
-        # Optionally, re-raise if you want to halt on first error or debug interactively
-        # raise
-        return None, None
+    lidar_bounds_data = []
+    for laz_file, file_name, record in tiles:
+        footprint = footprint_by_name.get(file_name)
+        lidar_bounds_data.append({
+            'file_path': laz_file,
+            'geometry': footprint if footprint is not None else shapely.from_wkb(record['footprint_wkb']),
+            'point_count': record['point_count'],
+        })
+    assumed_native_crs_count = len(assumed_crs)
+
+    for laz_file in unknown_crs:
+        print(f"Skipping {os.path.basename(laz_file)}: no CRS in its header and not in the tile inventory "
+              f"(pass its CRS as assumed_tile_crs).")
+    for laz_file, reason in failures:
+        print(f"Skipping {os.path.basename(laz_file)} due to {reason}.")
+
+    if conn is not None:
+        with span("update_tile_catalog"):
+            try:
+                save_tile_records(conn, probed_records, target_segment_crs)
+                save_footprints(conn, new_footprints, target_segment_crs)
+                removed = 0
+                if tile_names is None: # A restricted scan says nothing about files outside the selection
+                    removed = prune_tile_records(conn, [os.path.basename(f) for f in laz_files])
+                print(f"Tile catalog: {len(laz_files) - len(to_probe)} cached, {len(probed_records)} probed, {len(failures)} failed, {removed} removed.")
+            except sqlite3.Error as e:
+                print(f"Warning: Could not update tile catalog in {lidar_data_dir} ({e}).")
+            finally:
+                conn.close()
+
+    return lidar_bounds_data, assumed_native_crs_count
+
+def compute_point_coverage(segments_gdf, lidar_gdf, target_segment_crs, buffer_distance_m=250,
+                           cell_size_m=10, min_points_per_cell=1, chunk_size=DEFAULT_CHUNK_SIZE,
+                           assumed_tile_crs=None):
+    """
+    Measures how much of each segment's buffer is actually covered by LiDAR points.
 
-def match_lidar_to_segments(segments_geojson_path, lidar_data_dir, output_geojson_path, target_segment_crs="EPSG:32722"):
+    The segment buffers are rasterised into cells (see
+    segment_features.build_segment_cell_grid). Every tile whose footprint
+    touches a buffer is streamed once (only the chunks touching the buffers
+    if it has a point_index sidecar) and its points are binned into those
+    cells with a vectorised grid hash, giving a point-density occupancy grid.
+    A tile is only listed for a segment if it contributes points to it, so
+    bounding boxes that merely graze the corridor no longer count.
+
+    Args:
+        segments_gdf (geopandas.GeoDataFrame): Segments in target_segment_crs.
+        lidar_gdf (geopandas.GeoDataFrame): Tile footprints with a 'file_path' column.
+        target_segment_crs (str): Working CRS.
+        buffer_distance_m (float): Half-width of the area checked around each segment.
+        cell_size_m (float): Occupancy cell size in metres.
+        min_points_per_cell (int): Points needed for a cell to count as covered.
+        chunk_size (int): Points decoded per chunk.
+        assumed_tile_crs (str or dict, optional): CRS of tiles without a header CRS.
+
+    Returns:
+        pandas.DataFrame: Indexed like segments_gdf with 'lidar_file_paths' (list or None),
+            'covered_fraction' (0-1) and 'point_density_per_m2'.
+    """
+    segments = segments_gdf.reset_index(drop=True)
+    n_segments = len(segments)
+    grid = build_segment_cell_grid(segments, buffer_distance_m, cell_size_m)
+    cell_segment = grid['cell_segment']
+    cell_points = np.zeros(len(cell_segment), dtype=np.int64)
+    tiles_per_segment = [[] for _ in range(n_segments)]
+
+    buffers = shapely.buffer(segments.geometry.values, buffer_distance_m)
+    _, tile_idx = lidar_gdf.sindex.query(buffers, predicate="intersects")
+    candidates = lidar_gdf['file_path'].iloc[np.unique(tile_idx)].tolist()
+    print(f"Computing point coverage from {len(candidates)} of {len(lidar_gdf)} tile(s) touching the segment buffers...")
+
+    for laz_file in candidates:
+        tile_segment_points = np.zeros(n_segments, dtype=np.int64)
+        try:
+            with span("stream_tile_coverage", tile=os.path.basename(laz_file)):
+                for chunk in iter_points_in_area(laz_file, grid['area'], target_segment_crs, chunk_size=chunk_size,
+                                                 assumed_crs=assumed_tile_crs):
+                    cells = points_to_cells(grid, chunk['x'], chunk['y'])
+                    cells = cells[cells >= 0]
+                    np.add.at(cell_points, cells, 1)
+                    tile_segment_points += np.bincount(cell_segment[cells], minlength=n_segments)
+        except Exception as e:
+            print(f"Error streaming {laz_file}: {e}. Its coverage may be incomplete.")
+        for seg in np.flatnonzero(tile_segment_points):
+            tiles_per_segment[seg].append(laz_file)
+
+    cells_per_segment = np.bincount(cell_segment, minlength=n_segments)
+    occupied = cell_points >= min_points_per_cell
+    segment_points = np.bincount(cell_segment, weights=cell_points, minlength=n_segments)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        covered_fraction = np.bincount(cell_segment[occupied], minlength=n_segments) / cells_per_segment
+        point_density = segment_points / (cells_per_segment * cell_size_m ** 2)
+
+    return pd.DataFrame({
+        'lidar_file_paths': [files if files else None for files in tiles_per_segment],
+        'covered_fraction': covered_fraction,
+        'point_density_per_m2': point_density,
+    }, index=segments_gdf.index)
+
+def aggregate_tiles_by_bbox(segments_gdf, lidar_gdf):
+    """
+    Lists, for every segment, the LiDAR tiles whose footprint it intersects.
+
+    Args:
+        segments_gdf (geopandas.GeoDataFrame): Segments in the working CRS.
+        lidar_gdf (geopandas.GeoDataFrame): Tile footprints with a 'file_path' column, same CRS.
+
+    Returns:
+        geopandas.GeoDataFrame: segments_gdf plus a 'lidar_file_paths' column
+            (list of paths, or None for segments without tiles).
+    """
+    print("Performing spatial join between segments and LiDAR file bounds...")
+    # Use 'intersects' to find any overlap. Consider 'within' if segments should be fully within tiles.
+    joined_gdf = gpd.sjoin(segments_gdf, lidar_gdf, how="left", predicate="intersects")
+
+    print("Aggregating LiDAR file paths for each segment...")
+    # Handle cases where a segment might not intersect any LiDAR file (file_path will be NaN)
+    def aggregate_files(series):
+        # Filter out NaNs which occur if a segment has no intersecting LiDAR files
+        valid_files = series.dropna().unique().tolist()
+        return valid_files if valid_files else None
+
+    # Group by the original segment's index to ensure one row per original segment
+    aggregated_lidar_info = joined_gdf.groupby(joined_gdf.index)['file_path'].apply(aggregate_files).rename('lidar_file_paths')
+
+    # Merge the aggregated file paths back to the original segments_gdf
+    # This ensures segments without matches are still present
+    final_segments_gdf = segments_gdf.merge(aggregated_lidar_info, left_index=True, right_index=True, how='left')
+    final_segments_gdf['lidar_file_paths'] = final_segments_gdf['lidar_file_paths'].apply(lambda x: x if isinstance(x, list) else None)
+    return final_segments_gdf
+
+
+def plot_spatial_join_preview(segments_gdf, lidar_gdf, plot_filename, target_segment_crs):
+    """
+    Draws every segment and tile footprint with matplotlib (slow for thousands of tiles;
+    see coverage_render.py for the raster overview).
+    """
+    with span("debug_plot"):
+        try:
+            import matplotlib.pyplot as plt
+
+            print(f"Attempting to plot segments and LiDAR bounds to {plot_filename}...")
+            fig, ax = plt.subplots(1, 1, figsize=(12, 12))
+
+            segments_gdf.plot(ax=ax, color='blue', edgecolor='black', linewidth=0.5, label='River Segments', zorder=2)
+            lidar_gdf.plot(ax=ax, color='red', edgecolor='darkred', alpha=0.4, label='LiDAR Tiles', zorder=1)
+
+            ax.set_title(f"River Segments and LiDAR Tile Bounding Boxes ({target_segment_crs})")
+            ax.set_xlabel("Easting (meters)")
+            ax.set_ylabel("Northing (meters)")
+            ax.legend()
+            plt.savefig(plot_filename)
+            plt.close(fig)
+            print(f"Saved debug plot to {plot_filename}")
+        except ImportError:
+            print("Matplotlib not found. Skipping debug plot. Please install matplotlib to enable plotting.")
+        except Exception as e:
+            print(f"Error during plotting: {e}. Skipping debug plot.")
+
+
+def match_lidar_to_segments(segments_path, lidar_data_dir, output_path, target_segment_crs=None, use_catalog=True, scan_workers=1, tile_names=None,
+                            coverage_mode="bbox", coverage_buffer_m=250, coverage_cell_size_m=10, geojson_export_path=None,
+                            preview="coverage", preview_max_pixels=4_000_000, preview_tile_dir=None,
+                            assumed_tile_crs=None):
     """
     Matches LiDAR data files to river segments based on spatial intersection.
 
     Args:
-        segments_geojson_path (str): Path to the GeoJSON file containing river segments.
+        segments_path (str): River segments (GeoParquet from define_river_corridor, or legacy GeoJSON).
         lidar_data_dir (str): Directory containing .laz LiDAR files.
-        output_geojson_path (str): Path to save the augmented segments GeoJSON.
-        target_segment_crs (str): The CRS of the river segments (and the target CRS for LiDAR bounds).
+        output_path (str): Path of the augmented segments GeoParquet; 'lidar_file_paths' is a list column.
+        target_segment_crs (str, optional): Working CRS for segments and LiDAR footprints. Defaults to the
+            WGS 84 UTM zone of the segments' extent (see reprojection.estimate_utm_crs).
+        use_catalog (bool): Reuse tile metadata cached in the LiDAR directory's tile catalog.
+        scan_workers (int): Worker processes used to probe LiDAR files (None = all cores).
+        tile_names (iterable, optional): Only consider these .laz base names (see lidar_inventory.py).
+        coverage_mode (str): "bbox" matches segments to tiles whose bounding box they intersect.
+            "points" streams the candidate tiles and keeps only tiles with points inside the
+            segment's buffer, adding 'covered_fraction' and 'point_density_per_m2' columns.
+        coverage_buffer_m (float): Buffer half-width used by the "points" mode.
+        coverage_cell_size_m (float): Occupancy grid cell size used by the "points" mode.
+        geojson_export_path (str, optional): Also export the result as EPSG:4326 GeoJSON here.
+        preview (str, optional): debug_spatial_join_preview.png next to output_path. "coverage" renders
+            a raster overview in the background while the join runs (see coverage_render.py),
+            "vector" draws the matplotlib plot, None skips it.
+        preview_max_pixels (int): Pixel budget of the "coverage" overview.
+        preview_tile_dir (str, optional): Also write zoomable coverage tiles here ("coverage" only).
+        assumed_tile_crs (str or dict, optional): CRS of tiles without a header CRS, one for all
+            or {tile base name: CRS}. Defaults to the tile inventory in lidar_data_dir.
     """
-    print(f"Loading river segments from: {segments_geojson_path}")
-    segments_gdf = gpd.read_file(segments_geojson_path)
+    print(f"Loading river segments from: {segments_path}")
+    with span("load_segments"):
+        segments_gdf = read_geotable(segments_path)
     if segments_gdf.crs is None:
+        if target_segment_crs is None:
+            target_segment_crs = "EPSG:32722"
         print(f"Warning: Segments GeoDataFrame has no CRS. Assuming {target_segment_crs}.")
         segments_gdf.crs = target_segment_crs
-    elif segments_gdf.crs.to_string().upper() != target_segment_crs.upper():
+    else:
+        if target_segment_crs is None:
+            target_segment_crs = estimate_utm_crs(segments_gdf)
+            print(f"Using UTM zone {target_segment_crs} for the segments' extent.")
+    if segments_gdf.crs.to_string().upper() != target_segment_crs.upper():
         print(f"Reprojecting segments from {segments_gdf.crs} to {target_segment_crs}")
         segments_gdf = segments_gdf.to_crs(target_segment_crs)
     
     print(f"Scanning LiDAR files in {lidar_data_dir}...")
 
-    lidar_bounds_data = []
-    processed_files_count = 0
-    assumed_native_crs_count = 0 # Count files assumed to be in target_segment_crs
-
-    for laz_file in glob.glob(os.path.join(lidar_data_dir, "*.laz")):
-        print(f"Processing LiDAR file: {os.path.basename(laz_file)}")
-        bounds, laz_crs_epsg = get_laz_bounds_and_crs(laz_file)
-
-        if bounds:
-            bbox_polygon = box(bounds['minx'], bounds['miny'], bounds['maxx'], bounds['maxy'])
-            file_data = {'file_path': laz_file, 'geometry': bbox_polygon}
-
-            if laz_crs_epsg:
-                # If CRS is found in LAZ, create GeoSeries and reproject
-                gs_temp = gpd.GeoSeries([bbox_polygon], crs=laz_crs_epsg)
-                gs_reprojected = gs_temp.to_crs(target_segment_crs)
-                file_data['geometry'] = gs_reprojected.iloc[0]
-                print(f"Found CRS {laz_crs_epsg} for {os.path.basename(laz_file)}. Reprojected to {target_segment_crs}.")
-            else:
-                # If NO CRS is found, assume coordinates are ALREADY in target_segment_crs
-                # No reprojection needed, geometry is already in target_segment_crs
-                # The GeoDataFrame for lidar_gdf will be created with target_segment_crs later
-                print(f"WARNING: No CRS found for {os.path.basename(laz_file)}. Assuming coordinates are already in {target_segment_crs}.")
-                assumed_native_crs_count += 1
-            
-            lidar_bounds_data.append(file_data)
-            processed_files_count += 1
-        else:
-            print(f"Skipping {os.path.basename(laz_file)} due to missing bounds or read error.")
+    with span("scan_lidar_tiles"):
+        lidar_bounds_data, assumed_native_crs_count = scan_lidar_tiles(
+            lidar_data_dir, target_segment_crs, use_catalog=use_catalog, workers=scan_workers, tile_names=tile_names,
+            assumed_tile_crs=assumed_tile_crs,
+        )
+    processed_files_count = len(lidar_bounds_data)
 
     if not lidar_bounds_data:
         print("No LiDAR file bounds could be processed. Exiting.")
@@ -192,11 +565,11 @@ def match_lidar_to_segments(segments_geojson_path, lidar_data_dir, output_geojso
 
     print(f"\nSuccessfully processed {processed_files_count} LiDAR file(s).")
     if assumed_native_crs_count > 0:
-        print(f"IMPORTANT SUMMARY: Assumed coordinates for {assumed_native_crs_count} LiDAR file(s) were already in {target_segment_crs} due to missing embedded CRS information.")
+        # The pipeline passes the inventory's mapping as assumed_tile_crs, so the two sources can't be told apart here
+        print(f"IMPORTANT SUMMARY: {assumed_native_crs_count} LiDAR file(s) have no embedded CRS; their CRS was taken from the assumed_tile_crs / tile inventory mapping.")
 
-    # Create GeoDataFrame for LiDAR bounds, explicitly setting CRS to target_segment_crs
-    # This is correct because if laz_crs_epsg was found, we reprojected to target_segment_crs.
-    # If laz_crs_epsg was NOT found, we are now assuming the coordinates were already in target_segment_crs.
+    # Every footprint was reprojected from its tile's native CRS (header, assumed_tile_crs
+    # or inventory) to target_segment_crs, so the GeoDataFrame is in target_segment_crs.
     lidar_gdf = gpd.GeoDataFrame(lidar_bounds_data, crs=target_segment_crs)
 
     print("\n--- Pre-Join Diagnostics ---")
@@ -206,69 +579,40 @@ def match_lidar_to_segments(segments_geojson_path, lidar_data_dir, output_geojso
     print(f"LiDAR GDF total bounds: {lidar_gdf.total_bounds}")
     print("---------------------------\n")
 
-    # --- Add Plotting for Debugging ---
-    try:
-        import matplotlib.pyplot as plt
-        output_dir_for_plot = os.path.dirname(output_geojson_path)
-        plot_filename = os.path.join(output_dir_for_plot, "debug_spatial_join_preview.png")
-        
-        print(f"Attempting to plot segments and LiDAR bounds to {plot_filename}...")
-        fig, ax = plt.subplots(1, 1, figsize=(12, 12))
-        
-        segments_gdf.plot(ax=ax, color='blue', edgecolor='black', linewidth=0.5, label='River Segments', zorder=2)
-        lidar_gdf.plot(ax=ax, color='red', edgecolor='darkred', alpha=0.4, label='LiDAR Tiles', zorder=1)
-        
-        # Optionally, set plot limits to the union of both total bounds for a better view
-        # Or, focus on the area of the LiDAR data if segments are much larger
-        # For now, let geopandas/matplotlib decide the extent based on data
-
-        ax.set_title("River Segments and LiDAR Tile Bounding Boxes (EPSG:32722)")
-        ax.set_xlabel("Easting (meters)")
-        ax.set_ylabel("Northing (meters)")
-        ax.legend()
-        plt.savefig(plot_filename)
-        print(f"Saved debug plot to {plot_filename}")
-        # plt.show() # Uncomment for interactive display if running locally and not on a headless server
-    except ImportError:
-        print("Matplotlib not found. Skipping debug plot. Please install matplotlib to enable plotting.")
-    except Exception as e:
-        print(f"Error during plotting: {e}. Skipping debug plot.")
-    # --- End Plotting ---
-
-    print("Performing spatial join between segments and LiDAR file bounds...")
-    # Use 'intersects' to find any overlap. Consider 'within' if segments should be fully within tiles.
-    # op='intersects' is generally good for finding relevant tiles.
-    joined_gdf = gpd.sjoin(segments_gdf, lidar_gdf, how="left", predicate="intersects") 
-
-    print("Aggregating LiDAR file paths for each segment...")
-    # Group by segment attributes (use index if segment_id is unique and index)
-    # Ensure all original segment columns are preserved
-    segment_cols = segments_gdf.columns.tolist()
-    if 'index_right' in joined_gdf.columns: # Column added by sjoin
-        segment_cols_for_grouping = [col for col in segment_cols if col in joined_gdf.columns]
-    else: # Should not happen if join occurred
-        segment_cols_for_grouping = segment_cols
-
-    # Handle cases where a segment might not intersect any LiDAR file (file_path will be NaN)
-    def aggregate_files(series):
-        # Filter out NaNs which occur if a segment has no intersecting LiDAR files
-        valid_files = series.dropna().unique().tolist()
-        return valid_files if valid_files else None # Return None or [] as preferred
-
-    # Group by the original segment's index to ensure one row per original segment
-    aggregated_lidar_info = joined_gdf.groupby(joined_gdf.index)['file_path'].apply(aggregate_files).rename('lidar_file_paths')
-    
-    # Merge the aggregated file paths back to the original segments_gdf
-    # This ensures segments without matches are still present
-    final_segments_gdf = segments_gdf.merge(aggregated_lidar_info, left_index=True, right_index=True, how='left')
-    
-    # Fill NaN in 'lidar_file_paths' with None or empty list if preferred after merge
-    final_segments_gdf['lidar_file_paths'] = final_segments_gdf['lidar_file_paths'].apply(lambda x: x if isinstance(x, list) else None)
-
+    preview_path = os.path.join(os.path.dirname(output_path), "debug_spatial_join_preview.png")
+    preview_future = None
+    if preview == "coverage":
+        from coverage_render import render_coverage_in_background
+        print(f"Rendering coverage overview to {preview_path} in the background...")
+        preview_future = render_coverage_in_background(
+            segments_gdf.geometry.values, shapely.bounds(lidar_gdf.geometry.values), preview_path,
+            crs=target_segment_crs, max_pixels=preview_max_pixels, tile_dir=preview_tile_dir,
+        )
+    elif preview == "vector":
+        plot_spatial_join_preview(segments_gdf, lidar_gdf, preview_path, target_segment_crs)
+    elif preview is not None:
+        print(f"Warning: Unknown preview mode '{preview}'. Skipping the preview.")
+
+    if coverage_mode == "points":
+        with span("compute_point_coverage"):
+            coverage = compute_point_coverage(segments_gdf, lidar_gdf, target_segment_crs,
+                                              buffer_distance_m=coverage_buffer_m, cell_size_m=coverage_cell_size_m,
+                                              assumed_tile_crs=assumed_tile_crs)
+        final_segments_gdf = segments_gdf.join(coverage)
+    else:
+        with span("aggregate_tiles_by_bbox"):
+            final_segments_gdf = aggregate_tiles_by_bbox(segments_gdf, lidar_gdf)
 
-    print(f"\nSaving augmented segments to: {output_geojson_path}")
-    final_segments_gdf.to_file(output_geojson_path, driver="GeoJSON")
+    print(f"\nSaving augmented segments to: {output_path}")
+    with span("write_geoparquet"):
+        write_geotable(final_segments_gdf, output_path, geojson_path=geojson_export_path)
     print("Matching process complete.")
+
+    if preview_future is not None:
+        try:
+            preview_future.result()
+        except Exception as e:
+            print(f"Error rendering the coverage overview: {e}. Skipping it.")
     
     # Print a summary of matches
     matches_found = final_segments_gdf['lidar_file_paths'].notna().sum()
@@ -281,10 +625,12 @@ def match_lidar_to_segments(segments_geojson_path, lidar_data_dir, output_geojso
 if __name__ == "__main__":
     # Configuration
     base_dir = "/Users/anyadecarlo/TuesdayAppointment"
-    segments_input_file = os.path.join(base_dir, "gis_outputs", "river_segments.geojson")
+    segments_input_file = os.path.join(base_dir, "gis_outputs", "river_segments.parquet")
     # This is the directory specified in your download_lidar.py
     lidar_dir = os.path.join(base_dir, "LiDAR: northern Mato Grosso near the Upper Xingu region") 
-    output_segments_file = os.path.join(base_dir, "gis_outputs", "river_segments_with_lidar.geojson")
+    output_segments_file = os.path.join(base_dir, "gis_outputs", "river_segments_with_lidar.parquet")
+    corridor_input_file = os.path.join(base_dir, "gis_outputs", "river_corridor_5km.parquet")
+    inventory_csv = os.path.join(lidar_dir, "cms_brazil_lidar_tile_inventory.csv")
     
     # Ensure input files/dirs exist
     if not os.path.exists(segments_input_file):
@@ -294,4 +640,12 @@ if __name__ == "__main__":
         print(f"ERROR: LiDAR data directory not found: {lidar_dir}")
         print("Please ensure LiDAR data is downloaded and the path is correct.")
     else:
-        match_lidar_to_segments(segments_input_file, lidar_dir, output_segments_file)
+        with profiled_run(os.path.join(base_dir, "gis_outputs", "profiles"), "match_lidar_to_segments"):
+            # Only open the tiles the inventory says intersect the corridor
+            corridor_tile_names = None
+            if os.path.exists(corridor_input_file) and os.path.exists(inventory_csv):
+                from lidar_inventory import load_tile_inventory, select_tiles_for_corridor
+                with span("select_corridor_tiles"):
+                    selected_tiles = select_tiles_for_corridor(read_geotable(corridor_input_file), load_tile_inventory(inventory_csv))
+                corridor_tile_names = selected_tiles['filename'].tolist()
+            match_lidar_to_segments(segments_input_file, lidar_dir, output_segments_file, tile_names=corridor_tile_names)
@@ -0,0 +1,695 @@
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import lru_cache
+import numpy as np
+import geopandas as gpd
+import pandas as pd
+import shapely
+from geo_io import read_geotable, write_geotable
+from instrumentation import span, add_counter
+from known_sites import annotate_known_sites, load_known_sites, KNOWN_SITES_XLS
+from raster_cache import get_tile_rasters
+from reprojection import estimate_utm_crs
+from segment_features import build_segment_cell_grid, parse_lidar_file_paths, points_to_cells
+
+# Multi-scale morphometric anomaly detection on the cached tile DTMs.
+#
+# Each DTM is cut into square blocks that are filtered independently with an
+# overlap halo wide enough for the largest kernel, so results do not depend on
+# block boundaries. A block is gap-filled by normalised convolution, turned
+# into a local relief model (DTM minus a Gaussian trend surface) and filtered
+# with scale-normalised Laplacian-of-Gaussian kernels (mounds) and ring
+# kernels (inner disc minus surrounding annulus: ditched enclosures and
+# geoglyphs). Every filter is a product in the Fourier domain, so one forward
+# FFT per block serves all scales. Responses are robust z-scores; the anomaly
+# raster holds the strongest one per cell and local maxima above the threshold
+# become candidate footprints.
+#
+# The z-score median and MAD of each filter are estimated once per DEM, from
+# core cells on a fixed lattice of the DEM grid, in a sampling pass over the
+# blocks before the detection pass; gaps too wide to interpolate are filled
+# with the DEM's median elevation. Block size and halo padding therefore do
+# not change the normalisation, at the cost of filtering every block twice.
+#
+# Blocks are spread over a process pool. Workers read the DTM through a
+# memory map and write their block's core into shared output memory maps, so
+# no raster crosses a process boundary. Outputs are cached next to the DTM,
+# keyed by the detector parameters.
+
+DEFAULT_BLOCK_SIZE = 1024
+DEFAULT_DETECTOR_PARAMS = {
+    'lrm_sigma_m': 20.0,
+    'log_sigmas_m': [2.0, 4.0, 8.0, 16.0],
+    'ring_radii_m': [15.0, 30.0, 60.0],
+    'ring_width_m': 5.0,
+    'fill_sigma_m': 3.0,
+    'threshold': 4.0, # Robust z-score of the strongest filter response
+}
+CANDIDATE_KINDS = ("mound", "ring")
+MAX_PEAKS_PER_BLOCK = 2000
+MIN_CIRCULARITY_RADIUS_PX = 4.0 # Smaller candidates get NaN circularity
+CIRCULARITY_STEP_PX = 0.25
+DETECTOR_VERSION = 2 # Bump when a change to the detector invalidates its cached outputs
+NORMALISATION_STRIDE = 4 # The robust z-scores are estimated on 1 in 16 cells
+MORPHOMETRY_COLUMNS = ['morph_anomaly_score', 'circularity', 'candidate_count']
+
+
+def fft_size(n):
+    """Smallest 5-smooth (2^a 3^b 5^c) length >= n; pocketfft is several times slower on lengths with large prime factors."""
+    best = 2 * n
+    p2 = 1
+    while p2 < best:
+        p3 = p2
+        while p3 < best:
+            p5 = p3
+            while p5 < n:
+                p5 *= 5
+            best = min(best, p5)
+            p3 *= 3
+        p2 *= 2
+    return best
+
+
+@lru_cache(maxsize=4)
+def _frequency_radius2(shape):
+    """Squared spatial frequency (cycles per cell) of each rfft2 coefficient."""
+    fy = np.fft.fftfreq(shape[0])[:, None]
+    fx = np.fft.rfftfreq(shape[1])[None, :]
+    return (fx ** 2 + fy ** 2).astype(np.float32)
+
+
+@lru_cache(maxsize=32)
+def _gaussian_transfer(shape, sigma_px):
+    return np.exp(-2.0 * np.pi ** 2 * sigma_px ** 2 * _frequency_radius2(shape)).astype(np.float32)
+
+
+@lru_cache(maxsize=32)
+def _log_transfer(shape, sigma_px):
+    """Scale-normalised, sign-flipped LoG (-sigma^2 * LoG): positive over mounds of radius ~sigma*sqrt(2)."""
+    return 4.0 * np.pi ** 2 * sigma_px ** 2 * _frequency_radius2(shape) * _gaussian_transfer(shape, sigma_px)
+
+
+@lru_cache(maxsize=32)
+def _ring_transfer(shape, radius_px, width_px):
+    """Mean of the inner disc minus mean of the annulus around radius_px: positive inside a ditch ring."""
+    dy = np.minimum(np.arange(shape[0]), shape[0] - np.arange(shape[0]))[:, None]
+    dx = np.minimum(np.arange(shape[1]), shape[1] - np.arange(shape[1]))[None, :]
+    distance = np.hypot(dy, dx)
+    inner = distance <= max(radius_px - width_px, 0.0)
+    ring = (distance > max(radius_px - width_px, 0.0)) & (distance <= radius_px + width_px)
+    kernel = inner / inner.sum() - ring / max(ring.sum(), 1)
+    return np.fft.rfft2(kernel).real.astype(np.float32) # Even kernel, so the transfer is real
+
+
+def detector_halo_px(params, resolution_m):
+    """Halo (cells) that covers the widest kernel and the widest candidate window."""
+    # Every filter runs on the local relief model, so its reach adds to the trend surface's
+    widest_m = max(
+        3.0 * params['lrm_sigma_m'] + max(4.0 * max(params['log_sigmas_m']),
+                                          max(params['ring_radii_m']) + params['ring_width_m']),
+        1.5 * (max(params['ring_radii_m']) + params['ring_width_m']),
+    )
+    return int(np.ceil(widest_m / resolution_m)) + 1
+
+
+def fill_gaps(dem, sigma_px, fill_value=None):
+    """
+    Fills NaN cells by normalised Gaussian convolution of the valid cells.
+
+    Cells too far from any data to be interpolated get fill_value, by default
+    the median elevation of dem.
+
+    Returns:
+        tuple: (filled array, valid bool mask of the original cells)
+    """
+    valid = np.isfinite(dem)
+    if valid.all():
+        return dem, valid
+    transfer = _gaussian_transfer(dem.shape, sigma_px)
+    weighted = np.fft.irfft2(np.fft.rfft2(np.where(valid, dem, 0.0)) * transfer, s=dem.shape)
+    weight = np.fft.irfft2(np.fft.rfft2(valid.astype(dem.dtype)) * transfer, s=dem.shape)
+    filled = np.where(valid, dem, weighted / np.maximum(weight, 1e-12))
+    filled[~valid & (weight < 1e-3)] = np.median(dem[valid]) if fill_value is None else fill_value
+    return filled, valid
+
+
+def _robust_stats(sample):
+    """(median, 1.4826 * MAD) of a response sample; (0, 1) if it is empty."""
+    if sample.size == 0:
+        return 0.0, 1.0
+    median = float(np.median(sample))
+    return median, max(1.4826 * float(np.median(np.abs(sample - median))), 1e-9)
+
+
+@lru_cache(maxsize=4)
+def _filter_bank(shape, lrm_sigma_m, log_sigmas_m, ring_radii_m, ring_width_m, resolution_m):
+    """(kind, radius_m, transfer) for every filter, all applied to the local relief model."""
+    relief = 1.0 - _gaussian_transfer(shape, lrm_sigma_m / resolution_m)
+    bank = []
+    for sigma_m in log_sigmas_m:
+        bank.append(("mound", sigma_m * np.sqrt(2.0), relief * _log_transfer(shape, sigma_m / resolution_m)))
+    for radius_m in ring_radii_m:
+        transfer = _ring_transfer(shape, radius_m / resolution_m, ring_width_m / resolution_m)
+        bank.append(("ring", radius_m, relief * transfer))
+    return relief, bank
+
+
+def _filter_responses(dem, params, resolution_m, fill_value=None):
+    """Gap-filled spectrum of a block and its raw response to every filter of the bank, in bank order."""
+    filled, valid = fill_gaps(dem, params['fill_sigma_m'] / resolution_m, fill_value)
+    spectrum = np.fft.rfft2(filled)
+    relief_transfer, bank = _filter_bank(dem.shape, params['lrm_sigma_m'], tuple(params['log_sigmas_m']),
+                                         tuple(params['ring_radii_m']), params['ring_width_m'], resolution_m)
+    responses = ((kind_name, radius_m, np.fft.irfft2(spectrum * transfer, s=dem.shape))
+                 for kind_name, radius_m, transfer in bank)
+    return spectrum, relief_transfer, valid, responses
+
+
+def filter_block(dem, params, resolution_m, normalisation=None, fill_value=None):
+    """
+    Runs the filter bank over one (halo-padded) DEM block.
+
+    Args:
+        dem (numpy.ndarray): 2-D elevations, NaN where unobserved.
+        params (dict): See DEFAULT_DETECTOR_PARAMS.
+        resolution_m (float): Cell size.
+        normalisation (list, optional): (median, scale) of each filter's response over the
+            whole DEM (see detect_dem_anomalies). Without it they are estimated from this
+            block's valid cells, halo included.
+        fill_value (float, optional): Elevation of cells too far from data to interpolate
+            (see fill_gaps), e.g. the median of the whole DEM.
+
+    Returns:
+        dict: 'anomaly' (float32, NaN where unobserved), 'radius_m' (float32) and
+            'kind' (int8 index into CANDIDATE_KINDS) of the strongest response per cell,
+            plus the (lightly smoothed) local relief model 'relief'.
+    """
+    spectrum, relief_transfer, valid, responses = _filter_responses(dem, params, resolution_m, fill_value)
+    # The relief kept for shape measures is lightly smoothed so single noisy cells don't move edges
+    relief_transfer = relief_transfer * _gaussian_transfer(dem.shape, params['fill_sigma_m'] / resolution_m)
+    anomaly = np.full(dem.shape, -np.inf, dtype=np.float32)
+    radius = np.zeros(dem.shape, dtype=np.float32)
+    kind = np.zeros(dem.shape, dtype=np.int8)
+    for f, (kind_name, radius_m, response) in enumerate(responses):
+        if normalisation is None:
+            median, scale = _robust_stats(response[::4, ::4][valid[::4, ::4]])
+        else:
+            median, scale = normalisation[f]
+        z = (response - median) / scale
+        stronger = z > anomaly
+        anomaly[stronger] = z[stronger]
+        radius[stronger] = radius_m
+        kind[stronger] = CANDIDATE_KINDS.index(kind_name)
+    anomaly[~valid] = np.nan
+    relief = np.fft.irfft2(spectrum * relief_transfer, s=dem.shape)
+    return {'anomaly': anomaly, 'radius_m': radius, 'kind': kind, 'relief': relief}
+
+
+def _bilinear(image, rows, cols):
+    """Bilinear samples of image at fractional (rows, cols), clamped to the grid."""
+    rows = np.clip(rows, 0.0, image.shape[0] - 1.0)
+    cols = np.clip(cols, 0.0, image.shape[1] - 1.0)
+    r0 = np.minimum(np.floor(rows).astype(np.int64), image.shape[0] - 2) if image.shape[0] > 1 else np.zeros(rows.shape, np.int64)
+    c0 = np.minimum(np.floor(cols).astype(np.int64), image.shape[1] - 2) if image.shape[1] > 1 else np.zeros(cols.shape, np.int64)
+    r1, c1 = np.minimum(r0 + 1, image.shape[0] - 1), np.minimum(c0 + 1, image.shape[1] - 1)
+    fr, fc = rows - r0, cols - c0
+    top = image[r0, c0] * (1.0 - fc) + image[r0, c1] * fc
+    bottom = image[r1, c0] * (1.0 - fc) + image[r1, c1] * fc
+    return top * (1.0 - fr) + bottom * fr
+
+
+def _circularity(relief, row, col, radius_px, kind):
+    """
+    Roundness of a candidate: 10th / 90th percentile of its edge radius over 72 bearings.
+
+    Profiles are sampled bilinearly every CIRCULARITY_STEP_PX. The edge along a
+    bearing is where the relief first falls below half the centre height
+    (mounds), interpolated between the two samples around the crossing, or the
+    lowest point of the ditch between 0.5 and 1.5 times the detected radius
+    (rings), refined with a parabola through the minimum and its neighbours.
+    A circle scores ~1, a square ring ~0.7 and a 2:1 ellipse ~0.5. Candidates
+    narrower than MIN_CIRCULARITY_RADIUS_PX cells have too few cells on their
+    edge for the ratio to mean anything and get NaN.
+    """
+    if radius_px < MIN_CIRCULARITY_RADIUS_PX:
+        return np.nan
+    bearings = np.linspace(0.0, 2.0 * np.pi, 72, endpoint=False)[:, None]
+    steps = np.arange(CIRCULARITY_STEP_PX, 1.5 * radius_px + 1.0, CIRCULARITY_STEP_PX)
+    profiles = _bilinear(relief, row - steps[None, :] * np.sin(bearings), col + steps[None, :] * np.cos(bearings))
+    if kind == "mound":
+        centre = relief[row, col]
+        if not centre > 0:
+            return 0.0
+        level = 0.5 * centre
+        below = profiles < level
+        first = np.argmax(below, axis=1)
+        crossed = below.any(axis=1) & (first > 0)
+        k = np.maximum(first, 1)
+        before = profiles[np.arange(len(k)), k - 1]
+        after = profiles[np.arange(len(k)), k]
+        with np.errstate(invalid='ignore', divide='ignore'):
+            fraction = np.clip((before - level) / (before - after), 0.0, 1.0)
+        edge = np.where(crossed, steps[k - 1] + fraction * CIRCULARITY_STEP_PX,
+                        np.where(below[:, 0], steps[0], steps[-1]))
+    else:
+        band = np.flatnonzero((steps >= 0.5 * radius_px) & (steps <= 1.5 * radius_px))
+        if len(band) < 3:
+            return 0.0
+        k = band[np.argmin(profiles[:, band], axis=1)]
+        k = np.clip(k, 1, len(steps) - 2)
+        left, mid, right = (profiles[np.arange(len(k)), k + d] for d in (-1, 0, 1))
+        curvature = left - 2.0 * mid + right
+        with np.errstate(invalid='ignore', divide='ignore'):
+            offset = np.where(curvature > 0, 0.5 * (left - right) / curvature, 0.0)
+        edge = steps[k] + np.clip(offset, -0.5, 0.5) * CIRCULARITY_STEP_PX
+    lo, hi = np.percentile(edge, [10, 90])
+    return float(lo / hi) if hi > 0 else 0.0
+
+
+def _block_peaks(result, core, threshold, resolution_m):
+    """Local maxima above threshold inside the block core, thinned by non-maximum suppression."""
+    a = np.where(np.isfinite(result['anomaly']), result['anomaly'], -np.inf)
+    rows, cols = core
+    centre = a[rows, cols]
+    peak = centre >= threshold
+    for dy in (-1, 0, 1):
+        for dx in (-1, 0, 1):
+            if dy or dx:
+                peak &= centre >= a[rows.start + dy:rows.stop + dy, cols.start + dx:cols.stop + dx]
+    pr, pc = np.nonzero(peak)
+    pr, pc = pr + rows.start, pc + cols.start
+    order = np.argsort(-a[pr, pc])[:MAX_PEAKS_PER_BLOCK]
+    pr, pc = pr[order], pc[order]
+
+    kept = []
+    for r, c in zip(pr, pc):
+        radius_px = result['radius_m'][r, c] / resolution_m
+        if any((r - kr) ** 2 + (c - kc) ** 2 < max(radius_px, kradius) ** 2 for kr, kc, kradius in kept):
+            continue
+        kept.append((r, c, radius_px))
+    return [(r, c, radius_px, _circularity(result['relief'], r, c, radius_px, CANDIDATE_KINDS[result['kind'][r, c]]))
+            for r, c, radius_px in kept]
+
+
+def _load_block(dtm_path, window, block_shape, halo):
+    """A block with its halo, mirror-padded to block_shape; None if it holds no data."""
+    r0, r1, c0, c1 = window
+    dtm = np.load(dtm_path, mmap_mode="r")
+    height, width = dtm.shape
+    pr0, pr1 = max(r0 - halo, 0), min(r1 + halo, height)
+    pc0, pc1 = max(c0 - halo, 0), min(c1 + halo, width)
+    block = np.asarray(dtm[pr0:pr1, pc0:pc1], dtype=np.float32)
+    if not np.isfinite(block).any():
+        return None
+
+    # Mirror-pad to a fixed shape: grid edges get a halo too and every block reuses the same transfers
+    top, left = pr0 - (r0 - halo), pc0 - (c0 - halo)
+    bottom = block_shape[0] - block.shape[0] - top
+    right = block_shape[1] - block.shape[1] - left
+    return np.pad(block, ((top, bottom), (left, right)), mode="symmetric")
+
+
+def _sample_block(dtm_path, window, block_shape, halo, transform, params, fill_value):
+    """
+    Worker: raw filter responses of a block's valid core cells on the DEM's sampling lattice.
+
+    The lattice is every NORMALISATION_STRIDE-th row and column of the DEM grid,
+    so the union of the samples over all blocks does not depend on block_size.
+
+    Returns:
+        list: One float32 array per filter of the bank, in bank order (empty if the block has no data).
+    """
+    block = _load_block(dtm_path, window, block_shape, halo)
+    if block is None:
+        return []
+    r0, r1, c0, c1 = window
+    rows = slice(halo + (-r0) % NORMALISATION_STRIDE, halo + r1 - r0, NORMALISATION_STRIDE)
+    cols = slice(halo + (-c0) % NORMALISATION_STRIDE, halo + c1 - c0, NORMALISATION_STRIDE)
+    _, _, valid, responses = _filter_responses(block, params, transform[1], fill_value)
+    core_valid = valid[rows, cols]
+    return [response[rows, cols][core_valid].astype(np.float32) for _, _, response in responses]
+
+
+def _detect_block(dtm_path, output_paths, window, block_shape, halo, transform, params, fill_value, normalisation):
+    """
+    Worker: filters one block of a DTM and writes its core into the output memory maps.
+
+    Returns:
+        list: Candidate dicts found in the block core.
+    """
+    block = _load_block(dtm_path, window, block_shape, halo)
+    if block is None:
+        return []
+    r0, r1, c0, c1 = window
+    x0, res, _, y_top, _, _ = transform
+    result = filter_block(block, params, res, normalisation, fill_value)
+    core = (slice(halo, halo + r1 - r0), slice(halo, halo + c1 - c0))
+    for name in ('anomaly', 'radius_m'):
+        out = np.load(output_paths[name], mmap_mode="r+")
+        out[r0:r1, c0:c1] = result[name][core]
+        out.flush()
+        del out
+
+    candidates = []
+    for r, c, radius_px, circularity in _block_peaks(result, core, params['threshold'], res):
+        row, col = r - halo + r0, c - halo + c0
+        candidates.append({
+            'x': x0 + (col + 0.5) * res,
+            'y': y_top - (row + 0.5) * res,
+            'score': float(result['anomaly'][r, c]),
+            'radius_m': float(result['radius_m'][r, c]),
+            'kind': CANDIDATE_KINDS[result['kind'][r, c]],
+            'circularity': circularity,
+        })
+    return candidates
+
+
+def _block_windows(shape, block_size):
+    height, width = shape
+    return [(r0, min(r0 + block_size, height), c0, min(c0 + block_size, width))
+            for r0 in range(0, height, block_size) for c0 in range(0, width, block_size)]
+
+
+def _output_paths(dtm_path, params):
+    key = hashlib.blake2b(json.dumps({**params, 'version': DETECTOR_VERSION}, sort_keys=True).encode(),
+                          digest_size=4).hexdigest()
+    base = dtm_path[:-len("_dtm.npy")] if dtm_path.endswith("_dtm.npy") else os.path.splitext(dtm_path)[0]
+    base = f"{base}_morph_{key}"
+    return {'anomaly': base + "_anomaly.npy", 'radius_m': base + "_radius.npy", 'candidates': base + "_candidates.json"}
+
+
+def _run_blocks(worker, tasks, workers, on_result, dems):
+    """
+    Runs worker(*args) for every (dem index, window, args) task, in-process or over a process pool.
+
+    Returns:
+        set: Indices of the DEMs with at least one failed block.
+    """
+    failed = set()
+
+    def report(i, window, e):
+        print(f"Warning: block {window} of {dems[i][0]} failed: {type(e).__name__}: {e}")
+        failed.add(i)
+
+    if workers == 1 or len(tasks) == 1:
+        for i, window, args in tasks:
+            try:
+                on_result(i, worker(*args))
+            except Exception as e:
+                report(i, window, e)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+            futures = {executor.submit(worker, *args): (i, window) for i, window, args in tasks}
+            for future in as_completed(futures):
+                i, window = futures[future]
+                try:
+                    on_result(i, future.result())
+                except Exception as e: # e.g. BrokenProcessPool if a worker died
+                    report(i, window, e)
+    return failed
+
+
+def detect_dem_anomalies(dems, params=None, block_size=DEFAULT_BLOCK_SIZE, workers=None):
+    """
+    Runs the detector over a set of DEM rasters, reusing cached results.
+
+    Blocks of all DEMs share one process pool, largest DEMs first. A DEM is
+    filtered twice: a sampling pass estimates each filter's robust z-score
+    normalisation over the whole DEM, then the detection pass writes the
+    outputs. Outputs are only cached once every block of a DEM succeeded.
+
+    Args:
+        dems (list): (dtm_path, meta) pairs; dtm_path is a 2-D float .npy file and
+            meta holds 'transform' and 'shape' as written by raster_cache.
+        params (dict, optional): Overrides for DEFAULT_DETECTOR_PARAMS.
+        block_size (int): Core block edge in cells.
+        workers (int): Worker processes. 1 runs in-process; None uses os.cpu_count().
+
+    Returns:
+        list: Per DEM, {'anomaly': memmap, 'radius_m': memmap, 'candidates': list, 'meta': dict},
+            or None if a block of that DEM failed (nothing is cached; a rerun retries it).
+    """
+    params = {**DEFAULT_DETECTOR_PARAMS, **(params or {})}
+    if workers is None:
+        workers = os.cpu_count() or 1
+    n_filters = len(params['log_sigmas_m']) + len(params['ring_radii_m'])
+
+    blocks = []
+    pending = {}
+    for i, (dtm_path, meta) in enumerate(dems):
+        paths = _output_paths(dtm_path, params)
+        if all(os.path.exists(p) for p in paths.values()):
+            continue
+        halo = detector_halo_px(params, meta['transform'][1])
+        sample = np.load(dtm_path, mmap_mode="r")[::NORMALISATION_STRIDE, ::NORMALISATION_STRIDE]
+        sample = sample[np.isfinite(sample)]
+        fill_value = float(np.median(sample)) if sample.size else 0.0 # An empty DTM is filled flat
+        pending[i] = {
+            'paths': paths, 'candidates': [], 'samples': [], 'cells': meta['shape'][0] * meta['shape'][1],
+            'halo': halo, 'block_shape': (fft_size(block_size + 2 * halo),) * 2,
+            'fill_value': fill_value,
+        }
+        blocks.extend((i, window) for window in _block_windows(tuple(meta['shape']), block_size))
+
+    failed = set()
+    if blocks:
+        print(f"Filtering {len(blocks)} DEM block(s) from {len(pending)} raster(s)...")
+        blocks.sort(key=lambda b: pending[b[0]]['cells'], reverse=True)
+
+        def block_args(i, window):
+            entry = pending[i]
+            return (dems[i][0], window, entry['block_shape'], entry['halo'], tuple(dems[i][1]['transform']), params,
+                    entry['fill_value'])
+
+        with span("sample_responses", blocks=len(blocks)):
+            failed |= _run_blocks(_sample_block, [(i, window, block_args(i, window)) for i, window in blocks],
+                                  workers, lambda i, samples: pending[i]['samples'].append(samples), dems)
+
+        for i, entry in pending.items():
+            samples = [sample for sample in entry.pop('samples') if sample]
+            entry['normalisation'] = [_robust_stats(np.concatenate([sample[f] for sample in samples]))
+                                      for f in range(n_filters)] if samples else [(0.0, 1.0)] * n_filters
+            if i in failed:
+                continue
+            entry['tmp_paths'] = {name: entry['paths'][name] + ".tmp" for name in ('anomaly', 'radius_m')}
+            for name, tmp_path in entry['tmp_paths'].items():
+                out = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=tuple(dems[i][1]['shape']))
+                out[:] = np.nan
+                out.flush()
+                del out
+
+        tasks = []
+        for i, window in blocks:
+            if i not in failed:
+                dtm_path, window, block_shape, halo, transform, _, fill_value = block_args(i, window)
+                tasks.append((i, window, (dtm_path, pending[i]['tmp_paths'], window, block_shape, halo, transform,
+                                          params, fill_value, pending[i]['normalisation'])))
+        with span("detect_blocks", blocks=len(tasks)):
+            if tasks:
+                failed |= _run_blocks(_detect_block, tasks, workers,
+                                      lambda i, candidates: pending[i]['candidates'].extend(candidates), dems)
+            add_counter('cells_filtered', sum(entry['cells'] for i, entry in pending.items() if i not in failed))
+
+        for i, entry in pending.items():
+            paths = entry['paths']
+            if i in failed: # Never cache a DEM with a hole where a block failed
+                for tmp_path in entry.get('tmp_paths', {}).values():
+                    if os.path.exists(tmp_path):
+                        os.remove(tmp_path)
+                print(f"Warning: detector outputs for {dems[i][0]} were not saved because a block failed.")
+                continue
+            for name in ('anomaly', 'radius_m'):
+                os.replace(entry['tmp_paths'][name], paths[name])
+            with open(paths['candidates'] + ".tmp", "w") as f:
+                json.dump(entry['candidates'], f)
+            os.replace(paths['candidates'] + ".tmp", paths['candidates'])
+
+    results = []
+    for i, (dtm_path, meta) in enumerate(dems):
+        if i in failed:
+            results.append(None)
+            continue
+        paths = _output_paths(dtm_path, params)
+        with open(paths['candidates']) as f:
+            candidates = json.load(f)
+        results.append({
+            'anomaly': np.load(paths['anomaly'], mmap_mode="r"),
+            'radius_m': np.load(paths['radius_m'], mmap_mode="r"),
+            'candidates': candidates,
+            'meta': meta,
+        })
+    return results
+
+
+def suppress_overlapping_candidates(candidates_gdf):
+    """
+    Keeps the strongest of any candidates whose centres lie inside each other's radius.
+
+    Needed where tiles overlap; within a DEM the blocks already do this.
+    """
+    if candidates_gdf.empty:
+        return candidates_gdf
+    candidates_gdf = candidates_gdf.sort_values('score', ascending=False).reset_index(drop=True)
+    centres = shapely.points(candidates_gdf['x'].to_numpy(), candidates_gdf['y'].to_numpy())
+    radii = candidates_gdf['radius_m'].to_numpy()
+    tree = shapely.STRtree(centres)
+    keep = np.ones(len(candidates_gdf), dtype=bool)
+    for i in range(len(candidates_gdf)):
+        if keep[i]:
+            neighbours = tree.query(centres[i], predicate="dwithin", distance=radii.max())
+            close = neighbours[(neighbours > i) & (shapely.distance(centres[i], centres[neighbours]) < np.maximum(radii[i], radii[neighbours]))]
+            keep[close] = False
+    return candidates_gdf[keep].reset_index(drop=True)
+
+
+def _accumulate_segment_hits(rasters, grid, n_segments, threshold, rows_per_chunk=512):
+    """Counts observed and anomalous raster cells per segment, a band of rows at a time."""
+    observed = np.zeros(n_segments, dtype=np.int64)
+    hits = np.zeros(n_segments, dtype=np.int64)
+    anomaly = rasters['anomaly']
+    x0, res, _, y_top, _, _ = rasters['meta']['transform']
+    height, width = anomaly.shape
+    cx = x0 + (np.arange(width) + 0.5) * res
+    for r0 in range(0, height, rows_per_chunk):
+        r1 = min(r0 + rows_per_chunk, height)
+        values = np.asarray(anomaly[r0:r1]).ravel()
+        cy = y_top - (np.arange(r0, r1) + 0.5) * res
+        cell_ids = points_to_cells(grid, np.tile(cx, r1 - r0), np.repeat(cy, width))
+        inside = (cell_ids >= 0) & np.isfinite(values)
+        segment = grid['cell_segment'][cell_ids[inside]]
+        observed += np.bincount(segment, minlength=n_segments)
+        hits += np.bincount(segment[values[inside] >= threshold], minlength=n_segments)
+    return observed, hits
+
+
+def detect_segment_anomalies(segments_with_lidar_path, output_path, candidates_path, target_crs=None,
+                             resolution_m=1.0, buffer_distance_m=250, cell_size_m=10, params=None,
+                             block_size=DEFAULT_BLOCK_SIZE, workers=None, known_sites_path=None,
+                             assumed_tile_crs=None):
+    """
+    Scores every segment with the DEM detector and writes the candidate footprints.
+
+    Segment columns:
+        morph_anomaly_score: share of observed DTM cells in the segment's buffer at or above the threshold.
+        circularity: circularity of the segment's highest-scoring candidate wide enough to measure (0 if none).
+        candidate_count: number of candidates centred in the segment's buffer.
+    Segments without a DTM cell keep NaN scores.
+
+    Args:
+        segments_with_lidar_path (str): Output of match_lidar_to_segments.
+        output_path (str): GeoParquet of the segments with MORPHOMETRY_COLUMNS.
+        candidates_path (str): GeoParquet of candidate footprints (circles of the detected radius).
+        target_crs (str, optional): Projected CRS. Defaults to the segments' UTM zone.
+        resolution_m (float): DTM cell size (see raster_cache).
+        buffer_distance_m (float): Half-width of the area scored around each segment.
+        cell_size_m (float): Cell size of the segment ownership grid.
+        params (dict, optional): Overrides for DEFAULT_DETECTOR_PARAMS.
+        block_size (int): Core block edge in cells.
+        workers (int, optional): Worker processes; None uses os.cpu_count().
+        known_sites_path (str, optional): archaeogeodesy.xls; adds known-site proximity to the candidates.
+        assumed_tile_crs (str or dict, optional): CRS of tiles without a header CRS; defaults
+            to the tile inventory (see point_stream.assumed_tile_crs_for).
+
+    Returns:
+        tuple: (segments GeoDataFrame, candidates GeoDataFrame)
+    """
+    params = {**DEFAULT_DETECTOR_PARAMS, **(params or {})}
+    print(f"Loading matched segments from: {segments_with_lidar_path}")
+    segments_gdf = read_geotable(segments_with_lidar_path)
+    if segments_gdf.crs is None:
+        target_crs = target_crs or "EPSG:32722"
+        segments_gdf = segments_gdf.set_crs(target_crs)
+    elif target_crs is None:
+        target_crs = estimate_utm_crs(segments_gdf)
+    if segments_gdf.crs.to_string().upper() != target_crs.upper():
+        segments_gdf = segments_gdf.to_crs(target_crs)
+    segments_gdf = segments_gdf.reset_index(drop=True)
+    tiles = sorted({f for v in segments_gdf['lidar_file_paths'] for f in parse_lidar_file_paths(v)})
+
+    dems = []
+    with span("load_dtms", tiles=len(tiles)):
+        for laz_file in tiles:
+            if not os.path.exists(laz_file):
+                print(f"Warning: LiDAR file {laz_file} not found. Skipping.")
+                continue
+            try:
+                rasters = get_tile_rasters(laz_file, resolution_m=resolution_m, target_crs=target_crs,
+                                           assumed_crs=assumed_tile_crs)
+                dems.append((rasters['dtm'].filename, rasters['meta']))
+            except Exception as e:
+                print(f"Error rasterising {laz_file}: {e}. Skipping.")
+
+    results = detect_dem_anomalies(dems, params=params, block_size=block_size, workers=workers)
+
+    n_segments = len(segments_gdf)
+    observed = np.zeros(n_segments, dtype=np.int64)
+    hits = np.zeros(n_segments, dtype=np.int64)
+    records = []
+    with span("score_segments"):
+        grid = build_segment_cell_grid(segments_gdf, buffer_distance_m, cell_size_m)
+        for (dtm_path, meta), result in zip(dems, results):
+            if result is None: # A block failed; the tile is left unscored
+                continue
+            tile_observed, tile_hits = _accumulate_segment_hits(result, grid, n_segments, params['threshold'])
+            observed += tile_observed
+            hits += tile_hits
+            source = meta.get('source', dtm_path)
+            records.extend({**c, 'tile': os.path.basename(source)} for c in result['candidates'])
+
+    columns = ['x', 'y', 'score', 'radius_m', 'kind', 'circularity', 'tile']
+    candidates = pd.DataFrame(records, columns=columns).astype(
+        {'x': float, 'y': float, 'score': float, 'radius_m': float, 'circularity': float})
+    candidates = suppress_overlapping_candidates(candidates)
+    cell_ids = points_to_cells(grid, candidates['x'].to_numpy(dtype=float), candidates['y'].to_numpy(dtype=float))
+    candidates = candidates[cell_ids >= 0].reset_index(drop=True)
+    owner = grid['cell_segment'][cell_ids[cell_ids >= 0]]
+    candidates.insert(0, 'candidate_id', np.arange(len(candidates)))
+    candidates['segment_id'] = segments_gdf['segment_id'].to_numpy()[owner] if 'segment_id' in segments_gdf else owner
+    candidates_gdf = gpd.GeoDataFrame(
+        candidates,
+        geometry=shapely.buffer(shapely.points(candidates['x'].to_numpy(), candidates['y'].to_numpy()),
+                                candidates['radius_m'].to_numpy()),
+        crs=target_crs,
+    )
+    if known_sites_path and not candidates_gdf.empty:
+        candidates_gdf = annotate_known_sites(candidates_gdf, load_known_sites(known_sites_path))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        score = np.where(observed > 0, hits / observed, np.nan)
+    circularity = np.zeros(n_segments)
+    measured = np.isfinite(candidates['circularity'].to_numpy(dtype=float))
+    top = candidates[measured].assign(owner=owner[measured]).sort_values('score').drop_duplicates('owner', keep='last')
+    circularity[top['owner'].to_numpy()] = top['circularity'].to_numpy(dtype=float)
+    segments_out = segments_gdf.drop(columns=['lidar_file_paths'])
+    segments_out['morph_anomaly_score'] = score
+    segments_out['circularity'] = np.where(observed > 0, circularity, np.nan)
+    segments_out['candidate_count'] = np.bincount(owner, minlength=n_segments)
+
+    with span("write_geoparquet"):
+        print(f"Saving segment morphometry to: {output_path}")
+        write_geotable(segments_out, output_path)
+        print(f"Saving {len(candidates_gdf)} candidate footprint(s) to: {candidates_path}")
+        write_geotable(candidates_gdf, candidates_path)
+    print(f"Scored {int((observed > 0).sum())} out of {n_segments} segments from {len(dems)} DTM(s).")
+    return segments_out, candidates_gdf
+
+
+if __name__ == "__main__":
+    from instrumentation import profiled_run
+
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    matched_segments_file = os.path.join(base_dir, "gis_outputs", "river_segments_with_lidar.parquet")
+    morphometry_output_file = os.path.join(base_dir, "gis_outputs", "river_segment_morphometry.parquet")
+    candidates_output_file = os.path.join(base_dir, "gis_outputs", "anomaly_candidates.parquet")
+    known_sites_xls = os.path.join(base_dir, KNOWN_SITES_XLS)
+
+    if not os.path.exists(matched_segments_file):
+        print(f"ERROR: Matched segments file not found: {matched_segments_file}")
+        print("Please run match_lidar_to_segments.py first.")
+    else:
+        with profiled_run(os.path.join(base_dir, "gis_outputs", "profiles"), "morphometric_detector"):
+            detect_segment_anomalies(matched_segments_file, morphometry_output_file, candidates_output_file,
+                                     known_sites_path=known_sites_xls if os.path.exists(known_sites_xls) else None)
@@ -0,0 +1,526 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from instrumentation import span, profiled_run
+
+# Incremental runner for the whole workflow:
+#
+#   corridor -> download -> index -> match -> features ------> hmm, store
+#       |                                \-> rasters -> morphometry -/ /
+#       \-> ndvi ---------------------------------------------------- /
+#
+# store packs the HMM inputs into a memory-mapped file for repeated fits and
+# sweeps (see feature_store.py); hmm itself still reads the GeoParquet tables.
+#
+# Each stage declares its upstream stages, its parameters, any external input
+# files and the files it produces. A stage's cache key hashes its parameters,
+# the contents of its input files and the content hashes of its upstream
+# outputs, so a stage reruns only when something it reads has really changed:
+# editing a centerline coordinate reruns the corridor, and everything below it
+# reruns only if the corridor files come out different. Stages whose upstream
+# stages are done run concurrently on a thread pool.
+#
+# Keys and output hashes are kept in .pipeline_state.json in the output directory.
+
+PIPELINE_STATE_FILENAME = ".pipeline_state.json"
+HASH_BLOCK_BYTES = 1024 * 1024
+
+
+def hash_path(path):
+    """
+    Hashes a file's contents, or a directory's listing.
+
+    Directories (e.g. the LiDAR download directory) are hashed by the relative
+    path, size and mtime of their files, skipping hidden files and directories
+    and .part downloads, so multi-GB tiles are never read just to check freshness.
+
+    Returns:
+        str or None: Hex digest, or None if path does not exist.
+    """
+    if not path or not os.path.exists(path):
+        return None
+    hasher = hashlib.blake2b(digest_size=16)
+    if os.path.isdir(path):
+        for root, dirs, files in os.walk(path):
+            dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+            for name in sorted(files):
+                if name.startswith(".") or name.endswith(".part"):
+                    continue
+                full_path = os.path.join(root, name)
+                st = os.stat(full_path)
+                rel_path = os.path.relpath(full_path, path)
+                hasher.update(f"{rel_path}\0{st.st_size}\0{st.st_mtime_ns}\n".encode())
+    else:
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_BYTES), b""):
+                hasher.update(block)
+    return hasher.hexdigest()
+
+
+def _hash_json(value):
+    return hashlib.blake2b(json.dumps(value, sort_keys=True, default=str).encode(), digest_size=16).hexdigest()
+
+
+def hash_outputs(stage):
+    """Combined content hash of a stage's outputs, or None if any is missing."""
+    hashes = [hash_path(p) for p in stage['outputs']]
+    return None if None in hashes else _hash_json(hashes)
+
+
+def stage_key(name, stage, state):
+    """
+    Cache key of a stage: its parameters, input file contents and upstream output hashes.
+
+    Args:
+        name (str): Stage name.
+        stage (dict): Stage definition (see build_pipeline).
+        state (dict): Pipeline state holding the upstream stages' output hashes.
+
+    Returns:
+        str: Hex digest.
+    """
+    return _hash_json({
+        'stage': name,
+        'version': stage.get('version', 1),
+        'params': stage.get('params', {}),
+        'inputs': {p: hash_path(p) for p in stage.get('inputs', [])},
+        'deps': {d: state.get(d, {}).get('outputs_hash') for d in stage['deps']},
+    })
+
+
+def load_pipeline_state(output_dir):
+    """Reads .pipeline_state.json; an unreadable file is treated as empty."""
+    path = os.path.join(output_dir, PIPELINE_STATE_FILENAME)
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError) as e:
+        print(f"Warning: Could not read pipeline state {path} ({e}). Rerunning all stages.")
+        return {}
+
+
+def save_pipeline_state(output_dir, state):
+    """Writes .pipeline_state.json atomically."""
+    os.makedirs(output_dir, exist_ok=True)
+    path = os.path.join(output_dir, PIPELINE_STATE_FILENAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(state, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def topological_order(stages):
+    """
+    Orders stages so that every stage comes after its upstream stages.
+
+    Raises:
+        ValueError: On an unknown upstream stage or a cycle.
+    """
+    order, visiting, done = [], set(), set()
+
+    def visit(name):
+        if name in done:
+            return
+        if name in visiting:
+            raise ValueError(f"Pipeline has a cycle through stage '{name}'.")
+        if name not in stages:
+            raise ValueError(f"Unknown pipeline stage '{name}'.")
+        visiting.add(name)
+        for dep in stages[name]['deps']:
+            visit(dep)
+        visiting.discard(name)
+        done.add(name)
+        order.append(name)
+
+    for name in stages:
+        visit(name)
+    return order
+
+
+def _run_stage(name, stage):
+    """Runs one stage and checks that it produced all of its outputs."""
+    print(f"\n[{name}] Running...")
+    start = time.perf_counter()
+    with span(f"stage:{name}"):
+        stage['run']()
+    missing = [p for p in stage['outputs'] if not os.path.exists(p)]
+    if missing:
+        raise RuntimeError(f"stage finished without writing {', '.join(missing)}")
+    return time.perf_counter() - start
+
+
+def run_pipeline(stages, output_dir, force=(), max_workers=2, dry_run=False):
+    """
+    Runs the stages whose cache keys changed, in dependency order.
+
+    A stage is skipped when its key matches the recorded one and its outputs
+    still hash to what it wrote last time. A failed stage blocks everything
+    downstream of it; independent branches keep going.
+
+    Args:
+        stages (dict): Stage definitions, e.g. from build_pipeline.
+        output_dir (str): Where the pipeline state file lives.
+        force (iterable): Stage names to rerun regardless of their key.
+        max_workers (int): Stages run at the same time.
+        dry_run (bool): Only report which stages would run.
+
+    Returns:
+        dict: stage name -> 'fresh', 'ran', 'stale' (dry run), 'failed' or 'blocked'.
+    """
+    order = topological_order(stages)
+    unknown = set(force) - set(stages)
+    if unknown:
+        raise ValueError(f"Unknown stage(s) to force: {', '.join(sorted(unknown))}")
+    state = load_pipeline_state(output_dir)
+    status = {}
+    pending = list(order)
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        while pending or running:
+            for name in list(pending):
+                deps = stages[name]['deps']
+                if any(status.get(d) in ('failed', 'blocked') for d in deps):
+                    pending.remove(name)
+                    status[name] = 'blocked'
+                    print(f"[{name}] Blocked by a failed upstream stage.")
+                    continue
+                if not all(status.get(d) in ('fresh', 'ran', 'stale') for d in deps):
+                    continue
+                pending.remove(name)
+
+                key = stage_key(name, stages[name], state)
+                record = state.get(name, {})
+                upstream_stale = any(status[d] == 'stale' for d in deps)
+                if (name not in force and not upstream_stale and record.get('key') == key
+                        and record.get('outputs_hash') is not None
+                        and hash_outputs(stages[name]) == record['outputs_hash']):
+                    status[name] = 'fresh'
+                    print(f"[{name}] Up to date.")
+                elif dry_run:
+                    status[name] = 'stale'
+                    print(f"[{name}] " + ("Would run if its upstream outputs change." if upstream_stale else "Would run."))
+                else:
+                    running[executor.submit(_run_stage, name, stages[name])] = (name, key)
+
+            if not running:
+                if pending: # Nothing runnable and nothing in flight; should not happen with a valid DAG
+                    raise RuntimeError(f"Pipeline stalled with pending stages: {', '.join(pending)}")
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name, key = running.pop(future)
+                try:
+                    elapsed = future.result()
+                except Exception as e:
+                    status[name] = 'failed'
+                    state.pop(name, None)
+                    print(f"[{name}] FAILED: {type(e).__name__}: {e}")
+                else:
+                    status[name] = 'ran'
+                    state[name] = {
+                        'key': key,
+                        'outputs_hash': hash_outputs(stages[name]),
+                        'completed': time.strftime("%Y-%m-%dT%H:%M:%S"),
+                        'elapsed_s': round(elapsed, 3),
+                    }
+                    print(f"[{name}] Done in {elapsed:.1f} s.")
+                save_pipeline_state(output_dir, state)
+
+    return status
+
+
+# --- The river/LiDAR workflow ---
+
+def default_pipeline_config(base_dir):
+    """
+    Returns the pipeline configuration for a project directory.
+
+    Everything that changes a stage's output lives here, so it can be hashed.
+    """
+    from hmm_inference import DEFAULT_FEATURE_COLUMNS
+
+    lidar_dir = os.path.join(base_dir, "LiDAR: northern Mato Grosso near the Upper Xingu region")
+    return {
+        'output_dir': os.path.join(base_dir, "gis_outputs"),
+        'lidar_dir': lidar_dir,
+        'inventory_csv': os.path.join(lidar_dir, "cms_brazil_lidar_tile_inventory.csv"),
+        # corridor
+        'river_lines_path': None,
+        'river_id_column': None,
+        'centerline_coords': None, # None = define_river_corridor.DEFAULT_CENTERLINE_COORDS
+        'buffer_distance_m': 2500,
+        'segment_length_m': 1000,
+        'partition_by_river': False,
+        # download
+        'download': True,
+        'bounding_box': (-53.5, -11.5, -52.9, -10.9),
+        # index: chunk index sidecars for windowed point reads (see point_index.py)
+        'point_index': True,
+        # match / features / rasters
+        'target_crs': None, # None = UTM zone of the segments
+        'assumed_tile_crs': None, # CRS of tiles without a header CRS, or {tile name: CRS}; None = inventory_csv's utmzone
+        'coverage_mode': "bbox",
+        'match_preview': "coverage", # "coverage" (raster, in the background), "vector" (matplotlib) or None
+        'match_preview_tiles': False, # Also write zoomable coverage tiles (see coverage_render.py)
+        'feature_buffer_m': 250,
+        'feature_cell_size_m': 10,
+        'raster_resolution_m': 1.0,
+        # morphometry
+        'detector_params': {}, # Overrides for morphometric_detector.DEFAULT_DETECTOR_PARAMS
+        'detector_workers': None, # None = os.cpu_count()
+        'known_sites_xls': os.path.join(base_dir, "Ancient Earthworks", "archaeogeodesy.xls"), # None to skip
+        'known_site_radii_m': [1000, 5000, 10000],
+        # ndvi: Sentinel-2 B04/B08 pairs or NDVI rasters (see raster_sampling.py); skipped if missing
+        'scene_dir': os.path.join(base_dir, "Sentinel-2"),
+        'ndvi_resolution_m': None, # None = full resolution; e.g. 20 reads the first overview of 10 m bands
+        'ndvi_dn_offset': 0, # -1000 for Sentinel-2 L2A from processing baseline 04.00 on
+        # hmm
+        'hmm_feature_columns': list(DEFAULT_FEATURE_COLUMNS),
+        'hmm_n_states': 3,
+        # EPSG:4326 GeoJSON copies of the corridor, segments and matches, for desktop GIS
+        'export_geojson': False,
+    }
+
+
+def build_pipeline(config):
+    """
+    Builds the stage definitions for the river/LiDAR workflow.
+
+    Each stage is a dict with 'deps' (upstream stage names), 'params',
+    'inputs' (external files whose contents matter), 'outputs' and 'run'
+    (a zero-argument callable). Imports are deferred to the run callables so
+    stages that are up to date never import their dependencies (e.g.
+    earthaccess for the download).
+
+    Args:
+        config (dict): See default_pipeline_config.
+
+    Returns:
+        dict: stage name -> stage definition.
+    """
+    out = config['output_dir']
+    paths = {
+        'segments': os.path.join(out, "river_segments.parquet"),
+        'corridor': os.path.join(out, "river_corridor_5km.parquet"),
+        'matched': os.path.join(out, "river_segments_with_lidar.parquet"),
+        'features': os.path.join(out, "river_segment_features.parquet"),
+        'rasters': os.path.join(out, "tile_rasters.json"),
+        'morphometry': os.path.join(out, "river_segment_morphometry.parquet"),
+        'candidates': os.path.join(out, "anomaly_candidates.parquet"),
+        'ndvi': os.path.join(out, "river_segment_ndvi.parquet"),
+        'store': os.path.join(out, "segment_store.npy"),
+        'hmm': os.path.join(out, "river_segments_hmm.parquet"),
+    }
+
+    def tile_crs():
+        # CRS of header-less tiles: the configured one, else the inventory's (never target_crs)
+        if config['assumed_tile_crs'] or not os.path.exists(config['inventory_csv']):
+            return config['assumed_tile_crs']
+        from lidar_inventory import inventory_tile_crs, load_tile_inventory
+        return inventory_tile_crs(load_tile_inventory(config['inventory_csv']))
+
+    def run_corridor():
+        from define_river_corridor import define_river_corridor_and_segments
+        define_river_corridor_and_segments(
+            config['river_lines_path'], config['river_id_column'],
+            buffer_distance_m=config['buffer_distance_m'], segment_length_m=config['segment_length_m'],
+            centerline_coords=config['centerline_coords'], output_dir=out,
+            export_geojson=config['export_geojson'], partition_by_river=config['partition_by_river'],
+        )
+
+    def run_download():
+        if not config['download']:
+            print(f"Download disabled; using the tiles already in {config['lidar_dir']}.")
+            return
+        import download_lidar
+        download_lidar.main(download_dir=config['lidar_dir'], bounding_box=config['bounding_box'],
+                            corridor_path=paths['corridor'], inventory_csv_path=config['inventory_csv'])
+
+    def run_index():
+        if not config['point_index']:
+            print("Point indexing disabled; point stages will read whole tiles.")
+            return
+        import glob
+        from point_index import build_point_indexes
+        laz_files = sorted(glob.glob(os.path.join(config['lidar_dir'], "*.laz")))
+        built, failures = build_point_indexes(laz_files)
+        print(f"Indexed {len(built)} tile(s); {len(laz_files) - len(built) - len(failures)} already up to date.")
+        for laz_file, reason in failures:
+            print(f"Warning: could not index {os.path.basename(laz_file)}: {reason}")
+
+    def run_match():
+        from match_lidar_to_segments import match_lidar_to_segments
+        tile_names = None
+        if os.path.exists(config['inventory_csv']): # Only open the tiles the inventory puts in the corridor
+            from geo_io import read_geotable
+            from lidar_inventory import load_tile_inventory, select_tiles_for_corridor
+            selected = select_tiles_for_corridor(read_geotable(paths['corridor']), load_tile_inventory(config['inventory_csv']))
+            tile_names = selected['filename'].tolist()
+        match_lidar_to_segments(paths['segments'], config['lidar_dir'], paths['matched'],
+                                target_segment_crs=config['target_crs'], tile_names=tile_names,
+                                coverage_mode=config['coverage_mode'],
+                                geojson_export_path=os.path.join(out, "river_segments_with_lidar.geojson") if config['export_geojson'] else None,
+                                preview=config['match_preview'],
+                                preview_tile_dir=os.path.join(out, "debug_spatial_join_preview_tiles") if config['match_preview_tiles'] else None,
+                                assumed_tile_crs=tile_crs())
+
+    def run_features():
+        from segment_features import extract_segment_features
+        extract_segment_features(paths['matched'], paths['features'], target_crs=config['target_crs'],
+                                 buffer_distance_m=config['feature_buffer_m'],
+                                 cell_size_m=config['feature_cell_size_m'],
+                                 known_sites_path=config['known_sites_xls'],
+                                 known_site_radii_m=tuple(config['known_site_radii_m']),
+                                 assumed_tile_crs=tile_crs())
+
+    def run_rasters():
+        from geo_io import read_geotable
+        from raster_cache import get_tile_rasters
+        from reprojection import estimate_utm_crs
+        from segment_features import parse_lidar_file_paths
+        matched = read_geotable(paths['matched'], columns=['lidar_file_paths', 'geometry'])
+        target_crs = config['target_crs'] or estimate_utm_crs(matched)
+        tiles = sorted({f for v in matched['lidar_file_paths'] for f in parse_lidar_file_paths(v)})
+        assumed_crs = tile_crs()
+        entries = {}
+        for laz_file in tiles:
+            rasters = get_tile_rasters(laz_file, resolution_m=config['raster_resolution_m'], target_crs=target_crs,
+                                       assumed_crs=assumed_crs)
+            entries[laz_file] = rasters['meta']
+        with open(paths['rasters'], "w") as f:
+            json.dump(entries, f, indent=2)
+
+    def run_morphometry():
+        from morphometric_detector import detect_segment_anomalies
+        detect_segment_anomalies(paths['matched'], paths['morphometry'], paths['candidates'],
+                                 target_crs=config['target_crs'], resolution_m=config['raster_resolution_m'],
+                                 buffer_distance_m=config['feature_buffer_m'], cell_size_m=config['feature_cell_size_m'],
+                                 params=config['detector_params'], workers=config['detector_workers'],
+                                 known_sites_path=config['known_sites_xls'], assumed_tile_crs=tile_crs())
+
+    def run_ndvi():
+        from raster_sampling import find_scenes, sample_segment_ndvi
+        scenes = []
+        if config['scene_dir'] and os.path.isdir(config['scene_dir']):
+            scenes = find_scenes(config['scene_dir'])
+        else:
+            print(f"Scene directory not found: {config['scene_dir']}. NDVI columns will be empty.")
+        sample_segment_ndvi(paths['segments'], scenes, paths['ndvi'], target_crs=config['target_crs'],
+                            buffer_distance_m=config['feature_buffer_m'], cell_size_m=config['feature_cell_size_m'],
+                            target_resolution=config['ndvi_resolution_m'], dn_offset=config['ndvi_dn_offset'])
+
+    def run_store():
+        from feature_store import write_feature_store
+        write_feature_store(paths['features'], paths['store'], paths['matched'], paths['morphometry'], paths['ndvi'],
+                            feature_columns=config['hmm_feature_columns'])
+
+    def run_hmm():
+        from hmm_inference import infer_segment_states
+        infer_segment_states(paths['features'], paths['hmm'], paths['matched'], paths['morphometry'], paths['ndvi'],
+                             feature_columns=config['hmm_feature_columns'], n_states=config['hmm_n_states'])
+
+    return {
+        'corridor': {
+            'deps': [],
+            'params': {k: config[k] for k in ('river_lines_path', 'river_id_column', 'centerline_coords',
+                                              'buffer_distance_m', 'segment_length_m', 'partition_by_river',
+                                              'export_geojson')},
+            'inputs': [config['river_lines_path']] if config['river_lines_path'] else [],
+            'outputs': [paths['segments'], paths['corridor']],
+            'run': run_corridor,
+        },
+        'download': {
+            'deps': ['corridor'],
+            'params': {k: config[k] for k in ('download', 'bounding_box')},
+            'inputs': [config['inventory_csv']],
+            'outputs': [config['lidar_dir']],
+            'run': run_download,
+        },
+        'index': {
+            'deps': ['download'],
+            'params': {'point_index': config['point_index']},
+            # Disabled indexing writes nothing; an empty output list still hashes, so match is not blocked
+            'outputs': [os.path.join(config['lidar_dir'], ".point_index")] if config['point_index'] else [],
+            'run': run_index,
+        },
+        'match': {
+            'deps': ['corridor', 'download', 'index'],
+            'params': {k: config[k] for k in ('target_crs', 'assumed_tile_crs', 'coverage_mode', 'export_geojson',
+                                              'match_preview', 'match_preview_tiles')},
+            'outputs': [paths['matched']],
+            'run': run_match,
+        },
+        'features': {
+            'deps': ['match'],
+            'params': {k: config[k] for k in ('target_crs', 'assumed_tile_crs', 'feature_buffer_m', 'feature_cell_size_m',
+                                              'known_sites_xls', 'known_site_radii_m')},
+            'inputs': [config['known_sites_xls']] if config['known_sites_xls'] else [],
+            'outputs': [paths['features']],
+            'run': run_features,
+        },
+        'rasters': {
+            'deps': ['match'],
+            'params': {k: config[k] for k in ('target_crs', 'assumed_tile_crs', 'raster_resolution_m')},
+            'outputs': [paths['rasters']],
+            'run': run_rasters,
+        },
+        'morphometry': {
+            'deps': ['match', 'rasters'],
+            'params': {k: config[k] for k in ('target_crs', 'assumed_tile_crs', 'raster_resolution_m', 'feature_buffer_m',
+                                              'feature_cell_size_m', 'detector_params', 'known_sites_xls')},
+            'inputs': [config['known_sites_xls']] if config['known_sites_xls'] else [],
+            'outputs': [paths['morphometry'], paths['candidates']],
+            'run': run_morphometry,
+        },
+        'ndvi': {
+            'deps': ['corridor'],
+            'params': {k: config[k] for k in ('target_crs', 'feature_buffer_m', 'feature_cell_size_m',
+                                              'ndvi_resolution_m', 'ndvi_dn_offset')},
+            'inputs': [config['scene_dir']] if config['scene_dir'] else [],
+            'outputs': [paths['ndvi']],
+            'run': run_ndvi,
+        },
+        'store': {
+            'deps': ['features', 'match', 'morphometry', 'ndvi'],
+            'params': {'hmm_feature_columns': config['hmm_feature_columns']},
+            'outputs': [paths['store'], os.path.splitext(paths['store'])[0] + ".json"],
+            'run': run_store,
+        },
+        'hmm': {
+            'deps': ['features', 'match', 'morphometry', 'ndvi'],
+            'params': {k: config[k] for k in ('hmm_feature_columns', 'hmm_n_states')},
+            'outputs': [paths['hmm']],
+            'run': run_hmm,
+        },
+    }
+
+
+if __name__ == "__main__":
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    config = default_pipeline_config(base_dir)
+
+    parser = argparse.ArgumentParser(description="Run the river/LiDAR pipeline, skipping up-to-date stages.")
+    parser.add_argument("--force", nargs="*", default=[], help="Stages to rerun regardless of their cache key.")
+    parser.add_argument("--jobs", type=int, default=2, help="Stages run at the same time.")
+    parser.add_argument("--dry-run", action="store_true", help="Only report which stages would run.")
+    parser.add_argument("--no-download", action="store_true", help="Use the tiles already on disk.")
+    args = parser.parse_args()
+    if args.no_download:
+        config['download'] = False
+
+    # Stages run on worker threads, where interactive matplotlib backends cannot draw
+    os.environ.setdefault("MPLBACKEND", "Agg")
+
+    with profiled_run(os.path.join(config['output_dir'], "profiles"), "pipeline"):
+        status = run_pipeline(build_pipeline(config), config['output_dir'], force=args.force,
+                              max_workers=args.jobs, dry_run=args.dry_run)
+    print("\n--- Pipeline summary ---")
+    for name, stage_status in status.items():
+        print(f"{name:<10} {stage_status}")
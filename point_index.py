@@ -0,0 +1,354 @@
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import shapely
+from instrumentation import span, add_counter
+from las_header import read_las_header
+from point_stream import iter_point_chunks, tile_native_crs, tile_transformer, DEFAULT_CHUNK_SIZE
+from tile_catalog import file_signature
+
+# Sub-tile spatial index sidecars for windowed point reads.
+#
+# A LAZ 1.4 file is compressed in independent chunks (usually 50,000 points)
+# listed in a chunk table, so any chunk can be decoded on its own. The index
+# records, per chunk, its point range, its compressed size, its bounding box
+# and which cells of a coarse occupancy grid over the tile it touches. A
+# polygon query rasterises the polygon onto the same grid and decodes only the
+# chunks that share a cell with it. Flight-line ordered tiles have long thin
+# chunks, which is why the occupancy bits matter more than the bboxes.
+#
+# Uncompressed .las files are indexed in fixed blocks of LAS_BLOCK_POINTS.
+# Sidecars are .npz files in .point_index next to the tiles. Each records the
+# tile's size, mtime and chunk table offset and is ignored when any of them
+# changes, so a rewritten tile is reindexed automatically without hashing it.
+
+POINT_INDEX_DIRNAME = ".point_index"
+INDEX_GRID_SIZE = 32 # Occupancy cells per side of the tile
+LAS_BLOCK_POINTS = 50_000
+
+
+def _index_path(laz_file_path, index_dir):
+    stem = os.path.splitext(os.path.basename(laz_file_path))[0]
+    return os.path.join(index_dir, f"{stem}.npz")
+
+
+def _tile_signature(laz_file_path):
+    """
+    (size, mtime_ns, chunk table offset) of a tile, read from its header alone.
+
+    The chunk table offset is the int64 a LAZ file stores at the start of its
+    point data; for an uncompressed .las file the same 8 bytes are simply the
+    start of the first point record.
+    """
+    file_size, mtime_ns = file_signature(laz_file_path)
+    with open(laz_file_path, "rb") as f:
+        f.seek(96) # offset_to_point_data in the public header
+        point_data_offset = int.from_bytes(f.read(4), "little")
+        f.seek(point_data_offset)
+        chunk_table_offset = int.from_bytes(f.read(8), "little", signed=True)
+    return file_size, mtime_ns, chunk_table_offset
+
+
+def _default_index_dir(laz_file_path):
+    return os.path.join(os.path.dirname(os.path.abspath(laz_file_path)), POINT_INDEX_DIRNAME)
+
+
+def read_chunk_table(laz_file_path):
+    """
+    Reads the point and byte counts of every compressed chunk of a .laz file.
+
+    Returns:
+        list or None: [(point_count, byte_count), ...], or None for uncompressed
+            .las files and LAZ files without a usable chunk table.
+    """
+    import laspy
+    import lazrs
+
+    with laspy.open(laz_file_path) as reader:
+        vlr = getattr(reader.point_source, "vlr", None)
+        offset = reader.header.offset_to_point_data
+    if vlr is None:
+        return None
+    with open(laz_file_path, "rb") as f:
+        f.seek(offset)
+        try:
+            return [(int(n), int(size)) for n, size in lazrs.read_chunk_table(f, vlr)]
+        except Exception:
+            return None
+
+
+def _cells_touched(x, y, grid_bounds, grid_size):
+    """Packed occupancy bits of the grid cells containing any of the points."""
+    minx, miny, maxx, maxy = grid_bounds
+    ix = np.clip(((x - minx) / max(maxx - minx, 1e-9) * grid_size).astype(np.int64), 0, grid_size - 1)
+    iy = np.clip(((y - miny) / max(maxy - miny, 1e-9) * grid_size).astype(np.int64), 0, grid_size - 1)
+    occupied = np.zeros(grid_size * grid_size, dtype=bool)
+    occupied[iy * grid_size + ix] = True
+    return np.packbits(occupied)
+
+
+def build_point_index(laz_file_path, index_dir=None, grid_size=INDEX_GRID_SIZE):
+    """
+    Scans a tile once and writes its chunk index sidecar.
+
+    Args:
+        laz_file_path (str): Path to the .las/.laz file.
+        index_dir (str, optional): Sidecar directory. Defaults to .point_index next to the tile.
+        grid_size (int): Occupancy grid cells per side.
+
+    Returns:
+        str: Path of the sidecar.
+    """
+    import laspy
+
+    index_dir = index_dir or _default_index_dir(laz_file_path)
+    os.makedirs(index_dir, exist_ok=True)
+    file_size, mtime_ns, chunk_table_offset = _tile_signature(laz_file_path)
+    header = read_las_header(laz_file_path)
+    b = header['bounds']
+    grid_bounds = np.array([b['minx'], b['miny'], b['maxx'], b['maxy']], dtype=np.float64)
+
+    chunk_table = read_chunk_table(laz_file_path)
+    if chunk_table is None:
+        n = header['point_count']
+        counts = [min(LAS_BLOCK_POINTS, n - start) for start in range(0, n, LAS_BLOCK_POINTS)]
+        point_bytes = (os.path.getsize(laz_file_path) / max(n, 1))
+        chunk_table = [(count, int(count * point_bytes)) for count in counts]
+    counts = np.array([n for n, _ in chunk_table], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.int64)
+
+    bounds = np.zeros((len(counts), 4), dtype=np.float64)
+    cells = np.zeros((len(counts), (grid_size * grid_size + 7) // 8), dtype=np.uint8)
+    with laspy.open(laz_file_path) as reader:
+        for i, (start, count) in enumerate(zip(starts, counts)):
+            if count == 0:
+                continue
+            reader.seek(int(start))
+            points = reader.read_points(int(count))
+            x = np.asarray(points.x, dtype=np.float64)
+            y = np.asarray(points.y, dtype=np.float64)
+            bounds[i] = (x.min(), y.min(), x.max(), y.max())
+            cells[i] = _cells_touched(x, y, grid_bounds, grid_size)
+
+    path = _index_path(laz_file_path, index_dir)
+    np.savez(path + ".tmp.npz",
+             file_size=file_size, mtime_ns=mtime_ns, chunk_table_offset=chunk_table_offset, grid_size=grid_size, grid_bounds=grid_bounds,
+             chunk_start=starts, chunk_count=counts,
+             chunk_bytes=np.array([size for _, size in chunk_table], dtype=np.int64),
+             chunk_bounds=bounds, chunk_cells=cells)
+    os.replace(path + ".tmp.npz", path)
+    return path
+
+
+def load_point_index(laz_file_path, index_dir=None, build=False):
+    """
+    Loads a tile's index sidecar, optionally building it if missing or stale.
+
+    Returns:
+        dict or None: Index arrays plus 'crs' (the tile's EPSG code, may be None);
+            None if there is no current sidecar and build is False.
+    """
+    index_dir = index_dir or _default_index_dir(laz_file_path)
+    path = _index_path(laz_file_path, index_dir)
+    index = None
+    if os.path.exists(path):
+        with np.load(path) as data:
+            index = {key: data[key] for key in data.files}
+        stored = tuple(int(index[key]) if key in index else None
+                       for key in ('file_size', 'mtime_ns', 'chunk_table_offset'))
+        if stored != _tile_signature(laz_file_path):
+            index = None
+    if index is None:
+        if not build:
+            return None
+        with np.load(build_point_index(laz_file_path, index_dir)) as data:
+            index = {key: data[key] for key in data.files}
+    index['grid_size'] = int(index['grid_size'])
+    index['crs'] = read_las_header(laz_file_path)['crs_epsg_code']
+    return index
+
+
+def query_chunks(index, polygon):
+    """
+    Chunks that may hold points inside a polygon given in the tile's own CRS.
+
+    Returns:
+        numpy.ndarray: Sorted chunk positions.
+    """
+    minx, miny, maxx, maxy = polygon.bounds
+    cb = index['chunk_bounds']
+    near = np.flatnonzero((cb[:, 0] <= maxx) & (cb[:, 2] >= minx) & (cb[:, 1] <= maxy) & (cb[:, 3] >= miny)
+                          & (index['chunk_count'] > 0))
+    if len(near) == 0:
+        return near
+
+    n = index['grid_size']
+    gx0, gy0, gx1, gy1 = index['grid_bounds']
+    xs = np.linspace(gx0, gx1, n + 1)
+    ys = np.linspace(gy0, gy1, n + 1)
+    col, row = np.meshgrid(np.arange(n), np.arange(n))
+    cell_boxes = shapely.box(xs[col.ravel()], ys[row.ravel()], xs[col.ravel() + 1], ys[row.ravel() + 1])
+    shapely.prepare(polygon)
+    wanted = np.packbits(shapely.intersects(polygon, cell_boxes))
+    hits = (index['chunk_cells'][near] & wanted).any(axis=1)
+    return near[hits]
+
+
+def _polygon_in_tile_crs(polygon, polygon_crs, tile_crs):
+    """Reprojects a query polygon into the tile's CRS (densified, so edges stay close to true)."""
+    from reprojection import get_transformer, same_crs
+
+    if polygon_crs is None or not tile_crs or same_crs(tile_crs, polygon_crs):
+        return polygon
+    transformer = get_transformer(polygon_crs, tile_crs)
+    densified = shapely.segmentize(polygon, max(1.0, shapely.length(polygon) / 1000.0))
+    return shapely.transform(densified, lambda xy: np.column_stack(transformer.transform(xy[:, 0], xy[:, 1])))
+
+
+def iter_points_in_area(laz_file_path, area, target_crs=None, chunk_size=DEFAULT_CHUNK_SIZE,
+                        index_dir=None, build_index=False, assumed_crs=None):
+    """
+    Streams the points of a tile's chunks that intersect an area.
+
+    Consecutive selected chunks are read together, up to chunk_size points
+    per read. Points are not clipped to the area: callers already bin points
+    into their own grids, and the chunks' extra points cost nothing extra to
+    decode. Without an index sidecar (and build_index=False) this falls back
+    to streaming the whole tile.
+
+    Args:
+        laz_file_path (str): Path to the .las/.laz file.
+        area (shapely.Geometry): Query polygon in target_crs.
+        target_crs (str, optional): CRS of area and of the returned coordinates.
+            None means the tile's own CRS.
+        chunk_size (int): Maximum points decoded at once.
+        index_dir (str, optional): Sidecar directory.
+        build_index (bool): Index the tile first if it has no current sidecar.
+        assumed_crs (str or dict, optional): CRS of tiles without a header CRS
+            (see point_stream.assumed_tile_crs_for).
+
+    Yields:
+        dict: {'x', 'y', 'z' (float64), 'classification' (uint8)}, as iter_point_chunks.
+    """
+    import laspy
+
+    transformer = tile_transformer(laz_file_path, target_crs, assumed_crs) if target_crs else None
+    index = load_point_index(laz_file_path, index_dir, build=build_index)
+    if index is None:
+        yield from iter_point_chunks(laz_file_path, chunk_size=chunk_size, transformer=transformer)
+        return
+
+    tile_crs = tile_native_crs(laz_file_path, assumed_crs) if target_crs else None
+    selected = query_chunks(index, _polygon_in_tile_crs(area, target_crs, tile_crs))
+    starts, counts = index['chunk_start'][selected], index['chunk_count'][selected]
+    # Merge runs of adjacent chunks into reads of at most chunk_size points
+    reads = []
+    for start, count in zip(starts.tolist(), counts.tolist()):
+        if reads and reads[-1][0] + reads[-1][1] == start and reads[-1][1] + count <= chunk_size:
+            reads[-1][1] += count
+        else:
+            reads.append([start, count])
+
+    with laspy.open(laz_file_path) as reader:
+        for start, count in reads:
+            reader.seek(start)
+            points = reader.read_points(count)
+            x = np.asarray(points.x, dtype=np.float64)
+            y = np.asarray(points.y, dtype=np.float64)
+            if transformer is not None:
+                x, y = transformer.transform(x, y)
+            add_counter('points_decoded', len(x))
+            yield {
+                'x': x,
+                'y': y,
+                'z': np.asarray(points.z, dtype=np.float64),
+                'classification': np.asarray(points.classification, dtype=np.uint8),
+            }
+    add_counter('bytes_read', int(index['chunk_bytes'][selected].sum()))
+
+
+def read_points_in_polygon(laz_file_path, polygon, target_crs=None, index_dir=None, build_index=True,
+                           assumed_crs=None):
+    """
+    Returns only the points of a tile that fall inside a polygon.
+
+    Args:
+        laz_file_path (str): Path to the .las/.laz file.
+        polygon (shapely.Geometry): Query polygon in target_crs.
+        target_crs (str, optional): CRS of polygon and of the returned coordinates.
+        index_dir (str, optional): Sidecar directory.
+        build_index (bool): Index the tile first if it has no current sidecar.
+        assumed_crs (str or dict, optional): CRS of tiles without a header CRS.
+
+    Returns:
+        dict: {'x', 'y', 'z', 'classification'} arrays of the points inside polygon.
+    """
+    shapely.prepare(polygon)
+    parts = []
+    for chunk in iter_points_in_area(laz_file_path, polygon, target_crs, index_dir=index_dir,
+                                     build_index=build_index, assumed_crs=assumed_crs):
+        inside = shapely.contains_xy(polygon, chunk['x'], chunk['y'])
+        parts.append({key: values[inside] for key, values in chunk.items()})
+    if not parts:
+        return {'x': np.empty(0), 'y': np.empty(0), 'z': np.empty(0), 'classification': np.empty(0, dtype=np.uint8)}
+    return {key: np.concatenate([p[key] for p in parts]) for key in parts[0]}
+
+
+def _index_tile(laz_file_path, index_dir):
+    """Worker wrapper: (path, sidecar path or None, error or None)."""
+    try:
+        if load_point_index(laz_file_path, index_dir) is not None:
+            return laz_file_path, None, None
+        return laz_file_path, build_point_index(laz_file_path, index_dir), None
+    except Exception as e:
+        return laz_file_path, None, f"{type(e).__name__}: {e}"
+
+
+def build_point_indexes(laz_files, index_dir=None, workers=None):
+    """
+    Indexes every tile that has no current sidecar, spread over worker processes.
+
+    Args:
+        laz_files (list): Paths of the .las/.laz files.
+        index_dir (str, optional): Sidecar directory. Defaults to .point_index next to each tile.
+        workers (int): Worker processes. 1 indexes in-process; None uses os.cpu_count().
+
+    Returns:
+        tuple: (built, failures) — sidecar paths written, and [(path, reason), ...].
+    """
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(laz_files) or 1))
+
+    with span("build_point_indexes", tiles=len(laz_files)):
+        if workers == 1:
+            results = [_index_tile(f, index_dir) for f in laz_files]
+        else:
+            largest_first = sorted(laz_files, key=lambda f: os.path.getsize(f), reverse=True)
+            results = []
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(_index_tile, f, index_dir): f for f in largest_first}
+                for future in as_completed(futures):
+                    try:
+                        results.append(future.result())
+                    except Exception as e: # e.g. BrokenProcessPool if a worker died
+                        results.append((futures[future], None, f"{type(e).__name__}: {e}"))
+
+    built = [path for _, path, error in results if path]
+    failures = [(f, error) for f, _, error in results if error]
+    return built, failures
+
+
+if __name__ == "__main__":
+    import glob
+
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    lidar_data_dir = os.path.join(base_dir, "LiDAR: northern Mato Grosso near the Upper Xingu region")
+
+    laz_files = sorted(glob.glob(os.path.join(lidar_data_dir, "*.laz")) + glob.glob(os.path.join(lidar_data_dir, "*.las")))
+    print(f"Indexing {len(laz_files)} LiDAR file(s) in {lidar_data_dir}...")
+    built, failures = build_point_indexes(laz_files)
+    print(f"Wrote {len(built)} index sidecar(s); {len(laz_files) - len(built) - len(failures)} already up to date.")
+    for laz_file, reason in failures:
+        print(f"Warning: could not index {os.path.basename(laz_file)}: {reason}")
@@ -0,0 +1,119 @@
+import os
+import numpy as np
+from instrumentation import add_counter
+from las_header import read_las_header
+
+# Fixed-size chunked point reader shared by the per-point stages (features,
+# rasters, coverage). Memory use is bounded by chunk_size, not by tile size.
+DEFAULT_CHUNK_SIZE = 1_000_000
+GROUND_CLASS = 2
+
+_inventory_crs = {} # Tile inventory CRS lookups, per tile directory
+
+
+def iter_point_chunks(laz_file_path, chunk_size=DEFAULT_CHUNK_SIZE, transformer=None):
+    """
+    Streams a .las/.laz file in chunks of at most chunk_size points.
+
+    Args:
+        laz_file_path (str): Path to the .las/.laz file.
+        chunk_size (int): Maximum number of points decoded at once.
+        transformer (pyproj.Transformer, optional): Applied to x/y (always_xy order)
+            so callers receive coordinates in their working CRS.
+
+    Yields:
+        dict: {'x', 'y', 'z' (float64), 'classification' (uint8)} numpy arrays.
+    """
+    import laspy
+
+    with laspy.open(laz_file_path) as reader:
+        for points in reader.chunk_iterator(chunk_size):
+            x = np.asarray(points.x, dtype=np.float64)
+            y = np.asarray(points.y, dtype=np.float64)
+            if transformer is not None:
+                x, y = transformer.transform(x, y)
+            add_counter('points_decoded', len(x))
+            yield {
+                'x': x,
+                'y': y,
+                'z': np.asarray(points.z, dtype=np.float64),
+                'classification': np.asarray(points.classification, dtype=np.uint8),
+            }
+    add_counter('bytes_read', os.path.getsize(laz_file_path))
+
+
+def assumed_tile_crs_for(laz_file_path, assumed_crs=None):
+    """
+    Returns the CRS to use for a tile whose header has no CRS record.
+
+    An explicit assumed_crs wins; otherwise the tile is looked up in the tile
+    inventory CSV (lidar_inventory.INVENTORY_CSV_FILENAME) in its directory.
+    The working CRS of the run is never used as a fallback: it is picked from
+    the segments' extent and need not be the zone the tile was flown in.
+
+    Args:
+        laz_file_path (str): Path to the .las/.laz file.
+        assumed_crs (str or dict, optional): One CRS for all header-less tiles, or
+            {tile base name: CRS}.
+
+    Returns:
+        str or None: The CRS, or None if nothing is known about the tile.
+    """
+    file_name = os.path.basename(laz_file_path)
+    if isinstance(assumed_crs, dict):
+        if assumed_crs.get(file_name):
+            return assumed_crs[file_name]
+    elif assumed_crs:
+        return assumed_crs
+
+    tile_dir = os.path.dirname(os.path.abspath(laz_file_path))
+    if tile_dir not in _inventory_crs:
+        from lidar_inventory import INVENTORY_CSV_FILENAME, inventory_tile_crs, load_tile_inventory
+
+        inventory_csv = os.path.join(tile_dir, INVENTORY_CSV_FILENAME)
+        _inventory_crs[tile_dir] = {}
+        if os.path.exists(inventory_csv):
+            try:
+                _inventory_crs[tile_dir] = inventory_tile_crs(load_tile_inventory(inventory_csv))
+            except Exception as e:
+                print(f"Warning: Could not read tile CRS from {inventory_csv} ({e}).")
+    return _inventory_crs[tile_dir].get(file_name)
+
+
+def tile_native_crs(laz_file_path, assumed_crs=None):
+    """
+    Returns a tile's native CRS: its header CRS, else see assumed_tile_crs_for.
+
+    Returns:
+        str or None
+    """
+    return read_las_header(laz_file_path)['crs_epsg_code'] or assumed_tile_crs_for(laz_file_path, assumed_crs)
+
+
+def tile_transformer(laz_file_path, target_crs, assumed_crs=None):
+    """
+    Returns a transformer from a tile's native CRS to target_crs, or None.
+
+    None means the tile is already in target_crs.
+
+    Args:
+        laz_file_path (str): Path to the .las/.laz file.
+        target_crs (str): Working CRS, e.g. "EPSG:32722".
+        assumed_crs (str or dict, optional): CRS of tiles without a header CRS
+            (see assumed_tile_crs_for).
+
+    Returns:
+        pyproj.Transformer or None
+
+    Raises:
+        ValueError: If the tile's CRS is unknown.
+    """
+    from reprojection import get_transformer, same_crs
+
+    tile_crs = tile_native_crs(laz_file_path, assumed_crs)
+    if not tile_crs:
+        raise ValueError(f"{os.path.basename(laz_file_path)} has no CRS in its header and is not in the tile "
+                         f"inventory; pass its CRS as assumed_tile_crs.")
+    if same_crs(tile_crs, target_crs):
+        return None
+    return get_transformer(tile_crs, target_crs)
@@ -0,0 +1,282 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import numpy as np
+from las_header import read_las_header
+from point_stream import iter_point_chunks, tile_native_crs, tile_transformer, DEFAULT_CHUNK_SIZE, GROUND_CLASS
+from tile_catalog import file_signature, load_content_hash, open_tile_catalog, save_content_hash
+
+# Per-tile DTM / CHM grids rasterised once and kept as memory-mapped .npy files
+# with a JSON georeferencing sidecar. Cache entries are keyed by a hash of the
+# source tile's contents, the target CRS and the grid resolution, so a rerun
+# with the same inputs reads the grids through numpy.memmap instead of decoding
+# the point cloud.
+#
+# Grids follow the GeoTIFF convention: row 0 is the northern edge and the
+# affine transform is (x_min, res, 0, y_max, 0, -res).
+
+RASTER_CACHE_DIRNAME = ".raster_cache"
+FINGERPRINT_BLOCK_BYTES = 1024 * 1024
+FINGERPRINT_HEADER_BYTES = 64 * 1024
+
+_fingerprints = {} # (path, size, mtime_ns, use_catalog) -> fingerprint, for this process
+
+
+def tile_fingerprint(laz_file_path, use_catalog=True):
+    """
+    Fingerprints a tile's contents.
+
+    With use_catalog the full contents are hashed. Hashing a multi-GB tile
+    takes seconds, so the digest is memoised in the tile catalog of the tile's
+    directory under the file's (size, mtime) signature and only recomputed
+    when that changes. If the catalog cannot be opened (e.g. a read-only
+    directory) the file is hashed every time.
+
+    Without use_catalog nothing is written next to the tile: the fingerprint
+    is a hash of the file's size, mtime and first FINGERPRINT_HEADER_BYTES
+    (the LAS header and VLRs), computed in memory.
+
+    Returns:
+        str: 16-hex-digit fingerprint.
+    """
+    file_size, mtime_ns = file_signature(laz_file_path)
+    memo_key = (os.path.abspath(laz_file_path), file_size, mtime_ns, use_catalog)
+    if memo_key in _fingerprints:
+        return _fingerprints[memo_key]
+
+    if not use_catalog:
+        hasher = hashlib.blake2b(f"{file_size}:{mtime_ns}:".encode(), digest_size=8)
+        with open(laz_file_path, "rb") as f:
+            hasher.update(f.read(FINGERPRINT_HEADER_BYTES))
+        _fingerprints[memo_key] = hasher.hexdigest()
+        return _fingerprints[memo_key]
+
+    file_name = os.path.basename(laz_file_path)
+    conn = None
+    fingerprint = None
+    try:
+        conn = open_tile_catalog(os.path.dirname(os.path.abspath(laz_file_path)))
+        fingerprint = load_content_hash(conn, file_name, file_size, mtime_ns)
+    except sqlite3.Error as e:
+        print(f"Warning: tile catalog unavailable for {file_name} ({e}); hashing without memoisation.")
+    try:
+        if fingerprint is None:
+            hasher = hashlib.blake2b(digest_size=8)
+            with open(laz_file_path, "rb") as f:
+                for block in iter(lambda: f.read(FINGERPRINT_BLOCK_BYTES), b""):
+                    hasher.update(block)
+            fingerprint = hasher.hexdigest()
+            if conn is not None:
+                try:
+                    save_content_hash(conn, file_name, file_size, mtime_ns, fingerprint)
+                except sqlite3.Error as e:
+                    print(f"Warning: could not memoise the hash of {file_name}: {e}")
+    finally:
+        if conn is not None:
+            conn.close()
+    _fingerprints[memo_key] = fingerprint
+    return fingerprint
+
+
+def _crs_tag(crs):
+    """Filename-safe tag of a CRS string: "EPSG:32722" -> "EPSG32722", anything else a short hash."""
+    tag = re.sub(r"[^A-Za-z0-9]", "", crs or "none")
+    if len(tag) > 16:
+        tag = hashlib.blake2b(crs.encode(), digest_size=4).hexdigest()
+    return tag
+
+
+def _cache_paths(laz_file_path, cache_dir, resolution_m, fingerprint, target_crs):
+    """Returns the (dtm, chm, meta) paths of a tile's cache entry."""
+    stem = (f"{os.path.splitext(os.path.basename(laz_file_path))[0]}_{fingerprint}"
+            f"_{_crs_tag(target_crs)}_{resolution_m:g}m")
+    base = os.path.join(cache_dir, stem)
+    return base + "_dtm.npy", base + "_chm.npy", base + ".json"
+
+
+def _grid_for_tile(laz_file_path, transformer, resolution_m):
+    """Computes the grid origin and shape covering a tile in the working CRS."""
+    b = read_las_header(laz_file_path)['bounds']
+    minx, miny, maxx, maxy = b['minx'], b['miny'], b['maxx'], b['maxy']
+    if transformer is not None:
+        minx, miny, maxx, maxy = transformer.transform_bounds(minx, miny, maxx, maxy, densify_pts=21)
+    x0 = np.floor(minx / resolution_m) * resolution_m
+    y_top = np.ceil(maxy / resolution_m) * resolution_m
+    width = max(1, int(np.ceil((maxx - x0) / resolution_m)))
+    height = max(1, int(np.ceil((y_top - miny) / resolution_m)))
+    return float(x0), float(y_top), width, height
+
+
+def build_tile_rasters(laz_file_path, cache_dir, resolution_m=1.0, target_crs="EPSG:32722",
+                       chunk_size=DEFAULT_CHUNK_SIZE, assumed_crs=None, use_catalog=True):
+    """
+    Rasterises a tile into a ground DTM and a canopy height model in cache_dir.
+
+    DTM cells hold the mean elevation of ground (class 2) returns, CHM cells
+    the highest return minus the DTM. Cells without ground returns are NaN;
+    no gap filling is done here.
+
+    Args:
+        laz_file_path (str): Path to the .laz file.
+        cache_dir (str): Directory for the cache entry.
+        resolution_m (float): Cell size in metres.
+        target_crs (str): CRS of the output grids.
+        chunk_size (int): Points decoded per chunk.
+        assumed_crs (str or dict, optional): CRS of tiles without a header CRS
+            (see point_stream.assumed_tile_crs_for).
+        use_catalog (bool): Memoise the tile's content hash in its tile catalog
+            (see tile_fingerprint).
+
+    Returns:
+        str: Path of the entry's JSON metadata file.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fingerprint = tile_fingerprint(laz_file_path, use_catalog)
+    dtm_path, chm_path, meta_path = _cache_paths(laz_file_path, cache_dir, resolution_m, fingerprint, target_crs)
+
+    transformer = tile_transformer(laz_file_path, target_crs, assumed_crs)
+    x0, y_top, width, height = _grid_for_tile(laz_file_path, transformer, resolution_m)
+    n_cells = width * height
+
+    ground_sum = np.zeros(n_cells, dtype=np.float64)
+    ground_n = np.zeros(n_cells, dtype=np.int64)
+    max_z = np.full(n_cells, -np.inf, dtype=np.float64)
+
+    for chunk in iter_point_chunks(laz_file_path, chunk_size=chunk_size, transformer=transformer):
+        col = np.floor((chunk['x'] - x0) / resolution_m).astype(np.int64)
+        row = np.floor((y_top - chunk['y']) / resolution_m).astype(np.int64)
+        inside = (col >= 0) & (col < width) & (row >= 0) & (row < height)
+        flat = row[inside] * width + col[inside]
+        z = chunk['z'][inside]
+        np.maximum.at(max_z, flat, z)
+        ground = chunk['classification'][inside] == GROUND_CLASS
+        ground_n += np.bincount(flat[ground], minlength=n_cells)
+        ground_sum += np.bincount(flat[ground], weights=z[ground], minlength=n_cells)
+
+    # Write under temporary names and rename, so a crash never leaves a half-built entry
+    dtm = np.lib.format.open_memmap(dtm_path + ".tmp", mode="w+", dtype=np.float32, shape=(height, width))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        dtm[:] = np.where(ground_n > 0, ground_sum / ground_n, np.nan).reshape(height, width)
+    chm = np.lib.format.open_memmap(chm_path + ".tmp", mode="w+", dtype=np.float32, shape=(height, width))
+    chm[:] = np.maximum(max_z.reshape(height, width) - dtm, 0.0)
+    dtm.flush()
+    chm.flush()
+    del dtm, chm
+    os.replace(dtm_path + ".tmp", dtm_path)
+    os.replace(chm_path + ".tmp", chm_path)
+
+    meta = {
+        'source': os.path.abspath(laz_file_path),
+        'fingerprint': fingerprint,
+        'resolution_m': resolution_m,
+        'crs': target_crs,
+        'source_crs': tile_native_crs(laz_file_path, assumed_crs),
+        'transform': [x0, resolution_m, 0.0, y_top, 0.0, -resolution_m],
+        'shape': [height, width],
+        'dtm': os.path.basename(dtm_path),
+        'chm': os.path.basename(chm_path),
+    }
+    with open(meta_path, "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta_path
+
+
+def get_tile_rasters(laz_file_path, cache_dir=None, resolution_m=1.0, target_crs="EPSG:32722",
+                     chunk_size=DEFAULT_CHUNK_SIZE, assumed_crs=None, use_catalog=True):
+    """
+    Returns a tile's DTM and CHM as read-only memory maps, building them on a cache miss.
+
+    Args:
+        laz_file_path (str): Path to the .laz file.
+        cache_dir (str, optional): Cache directory. Defaults to .raster_cache next to the tile.
+        resolution_m (float): Cell size in metres.
+        target_crs (str): CRS of the grids.
+        chunk_size (int): Points decoded per chunk when building.
+        assumed_crs (str or dict, optional): CRS of tiles without a header CRS.
+        use_catalog (bool): Memoise the tile's content hash in its tile catalog (see tile_fingerprint).
+
+    Returns:
+        dict: {'dtm': numpy.memmap, 'chm': numpy.memmap, 'meta': dict}
+    """
+    if cache_dir is None:
+        cache_dir = os.path.join(os.path.dirname(os.path.abspath(laz_file_path)), RASTER_CACHE_DIRNAME)
+    fingerprint = tile_fingerprint(laz_file_path, use_catalog)
+    dtm_path, chm_path, meta_path = _cache_paths(laz_file_path, cache_dir, resolution_m, fingerprint, target_crs)
+
+    meta = None
+    if os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+        # A header-less tile's source CRS can change with the inventory or assumed_crs
+        if (meta.get('crs') != target_crs or meta.get('source_crs') != tile_native_crs(laz_file_path, assumed_crs)
+                or not (os.path.exists(dtm_path) and os.path.exists(chm_path))):
+            meta = None
+    if meta is None:
+        print(f"Rasterising {os.path.basename(laz_file_path)} at {resolution_m:g} m...")
+        build_tile_rasters(laz_file_path, cache_dir, resolution_m, target_crs, chunk_size, assumed_crs, use_catalog)
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    return {
+        'dtm': np.load(dtm_path, mmap_mode="r"),
+        'chm': np.load(chm_path, mmap_mode="r"),
+        'meta': meta,
+    }
+
+
+def window_for_bounds(meta, minx, miny, maxx, maxy):
+    """
+    Converts a bounding box into a (row_slice, col_slice) window clipped to the grid.
+
+    Returns:
+        tuple or None: (slice, slice), or None if the box misses the grid.
+    """
+    x0, res, _, y_top, _, _ = meta['transform']
+    height, width = meta['shape']
+    col_start = max(0, int(np.floor((minx - x0) / res)))
+    col_stop = min(width, int(np.ceil((maxx - x0) / res)))
+    row_start = max(0, int(np.floor((y_top - maxy) / res)))
+    row_stop = min(height, int(np.ceil((y_top - miny) / res)))
+    if col_start >= col_stop or row_start >= row_stop:
+        return None
+    return slice(row_start, row_stop), slice(col_start, col_stop)
+
+
+def read_window(rasters, minx, miny, maxx, maxy, layer="dtm"):
+    """
+    Returns the part of a cached grid inside a bounding box as a zero-copy memmap view.
+
+    Args:
+        rasters (dict): Output of get_tile_rasters.
+        minx, miny, maxx, maxy (float): Box in the grid's CRS.
+        layer (str): 'dtm' or 'chm'.
+
+    Returns:
+        numpy.ndarray or None: View into the memory map, or None if the box misses the tile.
+    """
+    window = window_for_bounds(rasters['meta'], minx, miny, maxx, maxy)
+    if window is None:
+        return None
+    return rasters[layer][window]
+
+
+if __name__ == "__main__":
+    from geo_io import read_geotable
+    from segment_features import parse_lidar_file_paths
+
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    matched_segments_file = os.path.join(base_dir, "gis_outputs", "river_segments_with_lidar.parquet")
+    resolution_m = 1.0
+
+    if not os.path.exists(matched_segments_file):
+        print(f"ERROR: Matched segments file not found: {matched_segments_file}")
+        print("Please run match_lidar_to_segments.py first.")
+    else:
+        matched = read_geotable(matched_segments_file, columns=['lidar_file_paths'])
+        tiles = sorted({f for v in matched['lidar_file_paths'] for f in parse_lidar_file_paths(v)})
+        for laz_file in tiles:
+            rasters = get_tile_rasters(laz_file, resolution_m=resolution_m)
+            print(f"{os.path.basename(laz_file)}: grid {rasters['meta']['shape']} cached.")
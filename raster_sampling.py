@@ -0,0 +1,364 @@
+import glob
+import hashlib
+import os
+import re
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+import numpy as np
+import shapely
+from geo_io import read_geotable, write_geotable
+from instrumentation import span, add_counter
+from reprojection import estimate_utm_crs, get_transformer, same_crs
+from segment_features import build_segment_cell_grid, points_to_cells
+
+# Per-segment NDVI statistics from local Sentinel-2 (or any GeoTIFF/JP2) scenes.
+#
+# A scene is either a single-band NDVI raster or a red/NIR band pair (B04/B08).
+# Only the blocks of a scene that overlap the segment buffers are read, at the
+# coarsest overview that still meets the requested resolution, so a 10980 x
+# 10980 Sentinel-2 tile is never loaded whole. Within a block every pixel is
+# labelled with the segment that owns it (the same nearest-segment cell grid as
+# segment_features), and the statistics are folded in with bincount.
+#
+# Label blocks depend only on the segment geometries and the scene grid, and
+# all dates of a Sentinel-2 tile share one grid, so they are cached as .npy
+# files keyed by a hash of both. Scenes are spread over a process pool.
+
+SCENE_BLOCK_SIZE = 1024
+NDVI_BINS = 200 # Histogram over [-1, 1]
+VEGETATION_GAP_NDVI = 0.4
+MASK_CACHE_DIRNAME = ".raster_masks"
+RASTER_EXTENSIONS = (".tif", ".tiff", ".jp2")
+NDVI_COLUMNS = [
+    'ndvi_mean', 'ndvi_std', 'ndvi_p10', 'ndvi_p50',
+    'vegetation_gap_fraction', 'ndvi_pixels', 'ndvi_scenes',
+]
+
+_worker = {} # Per-process segment grid, built on the first label-cache miss
+
+
+def find_scenes(scene_dir):
+    """
+    Finds the scenes in a directory tree.
+
+    Band pairs are matched by name (..._B04_10m.jp2 with ..._B08_10m.jp2, as
+    in Sentinel-2 SAFE products); any raster with "ndvi" in its name is taken
+    as a ready-made NDVI scene.
+
+    Returns:
+        list: Scene dicts, {'name', 'red', 'nir'} or {'name', 'ndvi'}.
+    """
+    scenes = []
+    paths = sorted(p for p in glob.glob(os.path.join(scene_dir, "**", "*"), recursive=True)
+                   if p.lower().endswith(RASTER_EXTENSIONS))
+    path_set = set(paths)
+    for path in paths:
+        name = os.path.basename(path)
+        if "ndvi" in name.lower():
+            scenes.append({'name': os.path.splitext(name)[0], 'ndvi': path})
+        elif re.search(r"B04", name):
+            nir = os.path.join(os.path.dirname(path), re.sub(r"B04", "B08", name))
+            if nir in path_set:
+                scenes.append({'name': re.sub(r"_?B04", "", os.path.splitext(name)[0]), 'red': path, 'nir': nir})
+    return scenes
+
+
+def choose_overview_level(overview_factors, native_resolution, target_resolution=None):
+    """
+    Picks the coarsest overview whose resolution is still at least as fine as the target.
+
+    Args:
+        overview_factors (list): Decimation factors, e.g. src.overviews(1) -> [2, 4, 8].
+        native_resolution (float): Full-resolution pixel size, in scene CRS units.
+        target_resolution (float, optional): Wanted pixel size. None reads full resolution.
+
+    Returns:
+        int or None: Overview level for rasterio.open(overview_level=...), None for full resolution.
+    """
+    level = None
+    if target_resolution:
+        for i, factor in enumerate(overview_factors):
+            if native_resolution * factor <= target_resolution:
+                level = i
+    return level
+
+
+def _open_band(path, target_resolution):
+    import rasterio
+
+    with rasterio.open(path) as src:
+        level = choose_overview_level(src.overviews(1), abs(src.res[0]), target_resolution)
+    return rasterio.open(path, overview_level=level) if level is not None else rasterio.open(path)
+
+
+def _grid_key(segments_gdf, buffer_distance_m, cell_size_m):
+    hasher = hashlib.blake2b(digest_size=8)
+    hasher.update(f"{segments_gdf.crs}|{buffer_distance_m}|{cell_size_m}".encode())
+    for wkb in shapely.to_wkb(segments_gdf.geometry.values):
+        hasher.update(wkb)
+    return hasher.hexdigest()
+
+
+def _init_worker(segment_wkb, segments_crs, buffer_distance_m, cell_size_m, grid_key, cache_dir):
+    _worker.clear()
+    _worker.update(segment_wkb=segment_wkb, crs=segments_crs, buffer=buffer_distance_m,
+                   cell_size=cell_size_m, grid_key=grid_key, cache_dir=cache_dir)
+
+
+def _segment_grid():
+    if 'grid' not in _worker:
+        import geopandas as gpd
+        segments = gpd.GeoDataFrame(geometry=shapely.from_wkb(_worker['segment_wkb']), crs=_worker['crs'])
+        _worker['grid'] = build_segment_cell_grid(segments, _worker['buffer'], _worker['cell_size'])
+    return _worker['grid']
+
+
+def _block_labels(src, window, to_segments):
+    """Segment position owning each pixel of a window (-1 outside every buffer), via the mask cache."""
+    transform = src.window_transform(window)
+    key = hashlib.blake2b(
+        f"{_worker['grid_key']}|{src.crs}|{tuple(transform)[:6]}|{window.height}x{window.width}".encode(),
+        digest_size=10,
+    ).hexdigest()
+    path = os.path.join(_worker['cache_dir'], f"{key}.npy")
+    if os.path.exists(path):
+        return np.load(path)
+
+    cols = transform.c + (np.arange(window.width) + 0.5) * transform.a
+    rows = transform.f + (np.arange(window.height) + 0.5) * transform.e
+    x, y = np.tile(cols, window.height), np.repeat(rows, window.width)
+    if to_segments is not None:
+        x, y = to_segments.transform(x, y)
+    grid = _segment_grid()
+    cells = points_to_cells(grid, x, y)
+    labels = np.where(cells >= 0, grid['cell_segment'][np.maximum(cells, 0)], -1).astype(np.int32)
+    labels = labels.reshape(window.height, window.width)
+    os.makedirs(_worker['cache_dir'], exist_ok=True)
+    # Workers sampling scenes on the same grid can build the same entry at once: each
+    # writes its own temporary file, and a writer that loses the rename keeps the winner's
+    fd, tmp_path = tempfile.mkstemp(dir=_worker['cache_dir'], prefix=key + ".", suffix=".tmp.npy")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            np.save(f, labels)
+        os.replace(tmp_path, path)
+    except OSError:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        if os.path.exists(path):
+            return np.load(path)
+    return labels
+
+
+def _scene_windows(src, area_bounds, block_size):
+    """Block windows of a dataset covering area_bounds (in the dataset CRS)."""
+    from rasterio.windows import Window, from_bounds
+
+    full = Window(0, 0, src.width, src.height)
+    try:
+        area = from_bounds(*area_bounds, transform=src.transform).round_offsets().round_lengths()
+        area = area.intersection(full)
+    except Exception: # WindowError: the area misses the scene
+        return []
+    windows = []
+    for row in range(int(area.row_off), int(area.row_off + area.height), block_size):
+        for col in range(int(area.col_off), int(area.col_off + area.width), block_size):
+            height = min(block_size, int(area.row_off + area.height) - row)
+            width = min(block_size, int(area.col_off + area.width) - col)
+            windows.append(Window(col, row, width, height))
+    return windows
+
+
+def _read_ndvi(bands, window, dn_offset):
+    """NDVI for a window, NaN where any input is nodata/masked."""
+    if 'ndvi' in bands:
+        data = bands['ndvi'].read(1, window=window, masked=True).astype(np.float32)
+        return data.filled(np.nan)
+    red = bands['red'].read(1, window=window, masked=True).astype(np.float32) + dn_offset
+    nir = bands['nir'].read(1, window=window, masked=True).astype(np.float32) + dn_offset
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ndvi = (nir - red) / (nir + red)
+    return ndvi.filled(np.nan)
+
+
+def _sample_scene(scene, area_wkb, n_segments, target_resolution, gap_threshold, dn_offset, block_size):
+    """
+    Worker: accumulates one scene's NDVI statistics per segment.
+
+    Returns:
+        dict: 'count', 'sum', 'sum_sq', 'gap' (per segment) and 'hist' (segments x NDVI_BINS).
+    """
+    acc = {
+        'count': np.zeros(n_segments, dtype=np.int64),
+        'sum': np.zeros(n_segments), 'sum_sq': np.zeros(n_segments),
+        'gap': np.zeros(n_segments, dtype=np.int64),
+        'hist': np.zeros((n_segments, NDVI_BINS), dtype=np.int64),
+    }
+    bands = {role: _open_band(scene[role], target_resolution) for role in ('ndvi', 'red', 'nir') if role in scene}
+    try:
+        ref = next(iter(bands.values()))
+        if 'red' in bands and (bands['red'].transform != bands['nir'].transform or bands['red'].shape != bands['nir'].shape):
+            raise ValueError(f"Red and NIR bands of {scene['name']} are on different grids.")
+        to_scene = None if same_crs(ref.crs.to_string(), _worker['crs']) else get_transformer(_worker['crs'], ref.crs.to_string())
+        to_segments = None if to_scene is None else get_transformer(ref.crs.to_string(), _worker['crs'])
+
+        area = shapely.from_wkb(area_wkb)
+        if to_scene is not None:
+            area = shapely.transform(shapely.segmentize(area, 100.0),
+                                     lambda xy: np.column_stack(to_scene.transform(xy[:, 0], xy[:, 1])))
+        shapely.prepare(area)
+        for window in _scene_windows(ref, area.bounds, block_size):
+            left, bottom, right, top = ref.window_bounds(window)
+            if not area.intersects(shapely.box(left, bottom, right, top)):
+                continue
+            labels = _block_labels(ref, window, to_segments)
+            if not (labels >= 0).any():
+                continue
+            ndvi = _read_ndvi(bands, window, dn_offset)
+            add_counter('pixels_read', ndvi.size)
+            keep = (labels >= 0) & np.isfinite(ndvi)
+            segment = labels[keep]
+            values = np.clip(ndvi[keep], -1.0, 1.0).astype(np.float64)
+            acc['count'] += np.bincount(segment, minlength=n_segments)
+            acc['sum'] += np.bincount(segment, weights=values, minlength=n_segments)
+            acc['sum_sq'] += np.bincount(segment, weights=values ** 2, minlength=n_segments)
+            acc['gap'] += np.bincount(segment[values < gap_threshold], minlength=n_segments)
+            bins = np.minimum(((values + 1.0) / 2.0 * NDVI_BINS).astype(np.int64), NDVI_BINS - 1)
+            acc['hist'] += np.bincount(segment * NDVI_BINS + bins, minlength=n_segments * NDVI_BINS).reshape(n_segments, NDVI_BINS)
+    finally:
+        for band in bands.values():
+            band.close()
+    return acc
+
+
+def _ndvi_quantile(hist, q):
+    """Per-segment quantile (bin centre) from the NDVI histogram; NaN without pixels."""
+    cumulative = np.cumsum(hist, axis=1)
+    totals = cumulative[:, -1]
+    idx = (cumulative < (q * totals)[:, None]).sum(axis=1)
+    values = -1.0 + (np.minimum(idx, NDVI_BINS - 1) + 0.5) * (2.0 / NDVI_BINS)
+    return np.where(totals > 0, values, np.nan)
+
+
+def sample_segment_ndvi(segments_path, scenes, output_path, target_crs=None, buffer_distance_m=250,
+                        cell_size_m=10, target_resolution=None, gap_threshold=VEGETATION_GAP_NDVI,
+                        dn_offset=0, cache_dir=None, block_size=SCENE_BLOCK_SIZE, workers=None):
+    """
+    Computes per-segment NDVI statistics over a set of local scenes.
+
+    Columns added (pooled over all scenes):
+        ndvi_mean / ndvi_std: mean and standard deviation of NDVI in the segment's buffer.
+        ndvi_p10 / ndvi_p50: NDVI quantiles from a 200-bin histogram.
+        vegetation_gap_fraction: share of pixels with NDVI below gap_threshold.
+        ndvi_pixels / ndvi_scenes: pixels used, and scenes that contributed any.
+    Segments outside every scene keep NaN statistics.
+
+    Args:
+        segments_path (str): river_segments GeoParquet (or legacy GeoJSON).
+        scenes (list or str): Scene dicts (see find_scenes), or a directory to search.
+        output_path (str): GeoParquet of the segments with NDVI_COLUMNS.
+        target_crs (str, optional): Projected CRS of the segment grid. Defaults to the segments' UTM zone.
+        buffer_distance_m (float): Half-width of the area sampled around each segment.
+        cell_size_m (float): Cell size of the segment ownership grid.
+        target_resolution (float, optional): Coarsest acceptable pixel size in scene CRS units
+            (metres for Sentinel-2); selects an overview. None reads full resolution.
+        gap_threshold (float): NDVI below which a pixel counts as a vegetation gap.
+        dn_offset (float): Added to red/NIR digital numbers before the ratio, e.g. -1000
+            for Sentinel-2 L2A from processing baseline 04.00 on.
+        cache_dir (str, optional): Label cache. Defaults to .raster_masks next to output_path.
+        block_size (int): Read window edge in pixels.
+        workers (int, optional): Worker processes. 1 runs in-process; None uses os.cpu_count().
+
+    Returns:
+        geopandas.GeoDataFrame: Segments with NDVI_COLUMNS.
+    """
+    if isinstance(scenes, str):
+        scenes = find_scenes(scenes)
+    if workers is None:
+        workers = os.cpu_count() or 1
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(output_path)), MASK_CACHE_DIRNAME)
+
+    print(f"Loading segments from: {segments_path}")
+    segments_gdf = read_geotable(segments_path)
+    if segments_gdf.crs is None:
+        segments_gdf = segments_gdf.set_crs(target_crs or "EPSG:32722")
+    target_crs = target_crs or estimate_utm_crs(segments_gdf)
+    segments_gdf = segments_gdf.to_crs(target_crs).reset_index(drop=True)
+    n_segments = len(segments_gdf)
+
+    lines = segments_gdf.geometry.values
+    area_wkb = shapely.to_wkb(shapely.union_all(shapely.buffer(lines, buffer_distance_m)))
+    init_args = (shapely.to_wkb(lines), target_crs, buffer_distance_m, cell_size_m,
+                 _grid_key(segments_gdf, buffer_distance_m, cell_size_m), cache_dir)
+    task_args = (area_wkb, n_segments, target_resolution, gap_threshold, dn_offset, block_size)
+
+    totals = None
+    scene_counts = np.zeros(n_segments, dtype=np.int64)
+
+    def fold(acc):
+        nonlocal totals
+        totals = acc if totals is None else {k: totals[k] + acc[k] for k in totals}
+        scene_counts[acc['count'] > 0] += 1
+
+    print(f"Sampling NDVI from {len(scenes)} scene(s)...")
+    with span("sample_scenes", scenes=len(scenes)):
+        if workers == 1 or len(scenes) <= 1:
+            _init_worker(*init_args)
+            for scene in scenes:
+                try:
+                    with span("sample_scene", scene=scene['name']):
+                        fold(_sample_scene(scene, *task_args))
+                except Exception as e:
+                    print(f"Error sampling scene {scene['name']}: {e}. Skipping.")
+        else:
+            with ProcessPoolExecutor(max_workers=min(workers, len(scenes)), initializer=_init_worker,
+                                     initargs=init_args) as executor:
+                futures = {executor.submit(_sample_scene, scene, *task_args): scene for scene in scenes}
+                for future in as_completed(futures):
+                    try:
+                        fold(future.result())
+                    except Exception as e: # Includes BrokenProcessPool if a worker died
+                        print(f"Error sampling scene {futures[future]['name']}: {e}. Skipping.")
+
+    out = segments_gdf.copy()
+    if totals is None:
+        for column in NDVI_COLUMNS:
+            out[column] = np.nan
+        out['ndvi_pixels'] = 0
+        out['ndvi_scenes'] = 0
+    else:
+        count = totals['count']
+        with np.errstate(invalid='ignore', divide='ignore'):
+            mean = totals['sum'] / count
+            variance = np.where(count > 1, (totals['sum_sq'] - count * mean ** 2) / (count - 1), np.nan)
+            out['ndvi_mean'] = mean
+            out['ndvi_std'] = np.sqrt(np.maximum(variance, 0.0))
+            out['ndvi_p10'] = _ndvi_quantile(totals['hist'], 0.10)
+            out['ndvi_p50'] = _ndvi_quantile(totals['hist'], 0.50)
+            out['vegetation_gap_fraction'] = totals['gap'] / count
+        out['ndvi_pixels'] = count
+        out['ndvi_scenes'] = scene_counts
+
+    print(f"Saving segment NDVI statistics to: {output_path}")
+    write_geotable(out, output_path)
+    print(f"Sampled NDVI for {int((out['ndvi_pixels'] > 0).sum())} out of {n_segments} segments.")
+    return out
+
+
+if __name__ == "__main__":
+    from instrumentation import profiled_run
+
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    segments_file = os.path.join(base_dir, "gis_outputs", "river_segments.parquet")
+    scene_dir = os.path.join(base_dir, "Sentinel-2")
+    output_file = os.path.join(base_dir, "gis_outputs", "river_segment_ndvi.parquet")
+    target_resolution_m = None # e.g. 20 to read the first overview of 10 m bands
+
+    if not os.path.exists(segments_file):
+        print(f"ERROR: Segments file not found: {segments_file}")
+        print("Please run define_river_corridor.py first.")
+    elif not os.path.isdir(scene_dir):
+        print(f"ERROR: Scene directory not found: {scene_dir}")
+    else:
+        with profiled_run(os.path.join(base_dir, "gis_outputs", "profiles"), "raster_sampling"):
+            sample_segment_ndvi(segments_file, scene_dir, output_file, target_resolution=target_resolution_m)
@@ -0,0 +1,107 @@
+import functools
+import numpy as np
+import shapely
+from pyproj import CRS, Transformer
+
+# Batch reprojection helpers shared by the matching and point-streaming stages.
+#
+# Transformers are built once per (source, target) pair and reused. Tile
+# footprints are densified along their edges before transforming, so a bbox
+# that crosses into another UTM zone keeps its true (slightly curved) shape
+# instead of being reduced to four transformed corners, and all footprints
+# sharing a source CRS are transformed in a single vectorised call.
+
+DEFAULT_DENSIFY_PTS = 21
+
+
+@functools.lru_cache(maxsize=None)
+def _crs(crs_input):
+    return CRS.from_user_input(crs_input)
+
+
+@functools.lru_cache(maxsize=None)
+def get_transformer(source_crs, target_crs):
+    """
+    Returns a cached always_xy Transformer between two CRS strings.
+
+    Args:
+        source_crs (str): e.g. "EPSG:32721".
+        target_crs (str): e.g. "EPSG:32722".
+
+    Returns:
+        pyproj.Transformer
+    """
+    return Transformer.from_crs(_crs(source_crs), _crs(target_crs), always_xy=True)
+
+
+def same_crs(crs_a, crs_b):
+    """True if two CRS strings describe the same CRS (e.g. "epsg:32722" and "EPSG:32722")."""
+    return _crs(crs_a) == _crs(crs_b)
+
+
+def densified_boxes(bounds, densify_pts=DEFAULT_DENSIFY_PTS):
+    """
+    Builds bbox polygons with densify_pts vertices along each edge.
+
+    Args:
+        bounds (numpy.ndarray): (N, 4) array of minx, miny, maxx, maxy.
+        densify_pts (int): Vertices per edge (excluding the far corner).
+
+    Returns:
+        numpy.ndarray: N shapely Polygons.
+    """
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    minx, miny, maxx, maxy = (bounds[:, i:i + 1] for i in range(4))
+    t = np.linspace(0.0, 1.0, densify_pts, endpoint=False)[None, :]
+    w, h = maxx - minx, maxy - miny
+    xs = np.concatenate([minx + t * w, np.repeat(maxx, densify_pts, axis=1), maxx - t * w,
+                         np.repeat(minx, densify_pts, axis=1), minx], axis=1)
+    ys = np.concatenate([np.repeat(miny, densify_pts, axis=1), miny + t * h,
+                         np.repeat(maxy, densify_pts, axis=1), maxy - t * h, miny], axis=1)
+    return shapely.polygons(np.stack([xs, ys], axis=-1))
+
+
+def reproject_bounds(bounds, source_crs, target_crs, densify_pts=DEFAULT_DENSIFY_PTS):
+    """
+    Turns many bboxes, each in its own CRS, into footprints in target_crs.
+
+    Footprints are grouped by source CRS and each group is transformed with
+    one cached transformer call. Boxes with no source CRS (None) are returned
+    as plain boxes, i.e. taken to be in target_crs already; callers resolve
+    header-less tiles' CRS beforehand (see point_stream.assumed_tile_crs_for).
+
+    Args:
+        bounds (numpy.ndarray): (N, 4) array of minx, miny, maxx, maxy.
+        source_crs (sequence): N CRS strings or None.
+        target_crs (str): CRS of the output footprints.
+        densify_pts (int): Vertices per bbox edge before transforming.
+
+    Returns:
+        numpy.ndarray: N shapely Polygons in target_crs.
+    """
+    bounds = np.asarray(bounds, dtype=np.float64).reshape(-1, 4)
+    footprints = shapely.box(bounds[:, 0], bounds[:, 1], bounds[:, 2], bounds[:, 3])
+    source_keys = np.array([c if c else "" for c in source_crs], dtype=object)
+
+    for crs in set(source_keys.tolist()):
+        if not crs or same_crs(crs, target_crs):
+            continue
+        idx = np.flatnonzero(source_keys == crs)
+        boxes = densified_boxes(bounds[idx], densify_pts)
+        coords = shapely.get_coordinates(boxes)
+        x, y = get_transformer(crs, target_crs).transform(coords[:, 0], coords[:, 1])
+        footprints[idx] = shapely.set_coordinates(boxes, np.column_stack([x, y]))
+    return footprints
+
+
+def estimate_utm_crs(gdf):
+    """
+    Picks the WGS 84 UTM zone covering the centre of a GeoDataFrame's extent.
+
+    Args:
+        gdf (geopandas.GeoDataFrame or GeoSeries): Geometries with a CRS.
+
+    Returns:
+        str: e.g. "EPSG:32722".
+    """
+    return _crs(gdf.estimate_utm_crs().to_string()).to_string()
@@ -0,0 +1,395 @@
+import numpy as np
+import shapely
+import json
+import os
+from geo_io import read_geotable, write_geotable
+from known_sites import annotate_known_sites, load_known_sites, DEFAULT_COUNT_RADII_M, KNOWN_SITES_XLS
+from point_index import iter_points_in_area
+from point_stream import DEFAULT_CHUNK_SIZE, GROUND_CLASS
+from reprojection import estimate_utm_crs
+
+# Streaming emission-feature extraction for the HMM.
+#
+# Every segment gets a buffer; the buffers are rasterised once into a grid of
+# cells, each cell owned by its nearest segment. Points are then streamed
+# chunk by chunk from the segment's LiDAR tiles, dropped into cells with a
+# vectorised lookup into the sorted ids of the buffer cells, and folded into
+# running per-cell and per-segment statistics (Welford/Chan mean and variance,
+# elevation histograms). Memory is bounded by the chunk size plus the number of
+# buffer cells, never by tile size or by the extent of the river network.
+# Tiles with a point_index sidecar only decode the chunks that touch the buffers.
+
+HIST_MIN_Z = -100.0
+HIST_MAX_Z = 1000.0
+HIST_STEP_Z = 1.0
+CELL_BATCH_SIZE = 4_000_000 # Window cells tested against their buffers per batch
+WATER_CLASS = 9 # ASPRS water
+LOW_GROUND_FRACTION = 0.05 # Stand-in for water in segments without class 9 returns
+
+FEATURE_COLUMNS = [
+    'point_count', 'ground_point_count', 'covered_fraction',
+    'ground_mean_z', 'terrain_variance', 'canopy_mean_height', 'canopy_stddev',
+    'water_distance_m', 'anomaly_score', 'z_p05', 'z_p50', 'z_p95',
+]
+
+
+def parse_lidar_file_paths(value):
+    """
+    Normalises a 'lidar_file_paths' cell into a list.
+
+    GeoParquet gives a numpy array (or None); legacy GeoJSON outputs give a
+    list or a JSON-encoded string, depending on the OGR driver.
+
+    Returns:
+        list: File paths (empty if the segment has no LiDAR).
+    """
+    if value is None:
+        return []
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except json.JSONDecodeError:
+            return [value]
+    if isinstance(value, float): # NaN from a missing value
+        return []
+    return [str(v) for v in value]
+
+
+def build_segment_cell_grid(segments_gdf, buffer_distance_m, cell_size_m):
+    """
+    Rasterises the segment buffers into cells owned by the nearest segment.
+
+    Only cells whose centre falls inside a buffer are stored, as sorted ids
+    into the (virtual) grid over the buffers' bounding box. Each segment is
+    rasterised over its own buffer's window, so memory follows the number of
+    buffer cells rather than the bounding-box area (a long diagonal river does
+    not cost a full grid of its extent).
+
+    Args:
+        segments_gdf (geopandas.GeoDataFrame): Segments in a projected (metre) CRS.
+        buffer_distance_m (float): Half-width of the area observed around each segment.
+        cell_size_m (float): Cell edge length in metres.
+
+    Returns:
+        dict: {
+            'x0', 'y0', 'cell_size', 'nx', 'ny',
+            'area' (shapely geometry): union of the segment buffers,
+            'cell_ids' (int64[n_cells]): sorted iy * nx + ix of the cells inside the buffers;
+                a cell's position in this array is its compact cell id,
+            'cell_segment' (int64[n_cells]): row position in segments_gdf of each cell's owner
+        }
+    """
+    lines = segments_gdf.geometry.values
+    buffers = shapely.buffer(lines, buffer_distance_m)
+    buffer_union = shapely.union_all(buffers)
+    minx, miny, maxx, maxy = buffer_union.bounds
+    nx = int(np.ceil((maxx - minx) / cell_size_m))
+    ny = int(np.ceil((maxy - miny) / cell_size_m))
+
+    # Per-segment windows of the grid, in index space
+    bounds = np.nan_to_num(shapely.bounds(buffers), nan=minx) # Empty geometries get empty windows
+    ix0 = np.clip(np.floor((bounds[:, 0] - minx) / cell_size_m), 0, nx).astype(np.int64)
+    ix1 = np.clip(np.ceil((bounds[:, 2] - minx) / cell_size_m), 0, nx).astype(np.int64)
+    iy0 = np.clip(np.floor((bounds[:, 1] - miny) / cell_size_m), 0, ny).astype(np.int64)
+    iy1 = np.clip(np.ceil((bounds[:, 3] - miny) / cell_size_m), 0, ny).astype(np.int64)
+    widths = np.maximum(ix1 - ix0, 0)
+    window_cells = widths * np.maximum(iy1 - iy0, 0)
+
+    # Test the window cells against their own buffer, a bounded batch of windows at a time
+    shapely.prepare(buffers)
+    inside_ids = []
+    start = 0
+    while start < len(lines):
+        stop = start + 1
+        total = window_cells[start]
+        while stop < len(lines) and total + window_cells[stop] <= CELL_BATCH_SIZE:
+            total += window_cells[stop]
+            stop += 1
+        counts = window_cells[start:stop]
+        seg = np.repeat(np.arange(start, stop), counts)
+        local = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        ix = ix0[seg] + local % np.maximum(widths[seg], 1)
+        iy = iy0[seg] + local // np.maximum(widths[seg], 1)
+        inside = shapely.contains_xy(buffers[seg], minx + (ix + 0.5) * cell_size_m, miny + (iy + 0.5) * cell_size_m)
+        inside_ids.append(iy[inside] * nx + ix[inside])
+        start = stop
+    cell_ids = np.unique(np.concatenate(inside_ids)) if inside_ids else np.empty(0, dtype=np.int64)
+
+    tree = shapely.STRtree(lines)
+    centres = shapely.points(minx + (cell_ids % nx + 0.5) * cell_size_m, miny + (cell_ids // nx + 0.5) * cell_size_m)
+    centre_idx, line_idx = tree.query_nearest(centres, all_matches=False)
+    cell_segment = np.empty(len(cell_ids), dtype=np.int64)
+    cell_segment[centre_idx] = line_idx
+
+    return {
+        'x0': minx, 'y0': miny, 'cell_size': cell_size_m, 'nx': nx, 'ny': ny,
+        'area': buffer_union,
+        'cell_ids': cell_ids,
+        'cell_segment': cell_segment,
+    }
+
+
+def points_to_cells(grid, x, y):
+    """
+    Vectorised grid hash: maps point coordinates to compact cell ids.
+
+    Returns:
+        numpy.ndarray: int32 cell id per point, -1 for points outside every buffer.
+    """
+    ix = np.floor((x - grid['x0']) / grid['cell_size']).astype(np.int64)
+    iy = np.floor((y - grid['y0']) / grid['cell_size']).astype(np.int64)
+    in_grid = (ix >= 0) & (ix < grid['nx']) & (iy >= 0) & (iy < grid['ny'])
+    cell_ids = np.full(len(x), -1, dtype=np.int32)
+    if len(grid['cell_ids']) == 0:
+        return cell_ids
+    flat = iy[in_grid] * grid['nx'] + ix[in_grid]
+    pos = np.minimum(np.searchsorted(grid['cell_ids'], flat), len(grid['cell_ids']) - 1)
+    found = grid['cell_ids'][pos] == flat
+    cell_ids[np.flatnonzero(in_grid)[found]] = pos[found]
+    return cell_ids
+
+
+def _new_accumulators(n_segments, n_cells):
+    """Allocates the running statistics for one extraction run."""
+    n_bins = int(np.ceil((HIST_MAX_Z - HIST_MIN_Z) / HIST_STEP_Z))
+    return {
+        'seg_points': np.zeros(n_segments, dtype=np.int64),
+        'seg_ground_n': np.zeros(n_segments, dtype=np.int64),
+        'seg_ground_mean': np.zeros(n_segments, dtype=np.float64),
+        'seg_ground_m2': np.zeros(n_segments, dtype=np.float64),
+        'seg_hist': np.zeros((n_segments, n_bins), dtype=np.int32),
+        'cell_points': np.zeros(n_cells, dtype=np.int64),
+        'cell_max_z': np.full(n_cells, -np.inf),
+        'cell_ground_min_z': np.full(n_cells, np.inf),
+        'cell_ground_n': np.zeros(n_cells, dtype=np.int64),
+        'cell_ground_sum': np.zeros(n_cells, dtype=np.float64),
+        'cell_water_n': np.zeros(n_cells, dtype=np.int64),
+    }
+
+
+def _accumulate_chunk(acc, grid, chunk):
+    """Folds one chunk of points into the accumulators."""
+    cell_ids = points_to_cells(grid, chunk['x'], chunk['y'])
+    keep = cell_ids >= 0
+    if not keep.any():
+        return
+    cells = cell_ids[keep]
+    z = chunk['z'][keep]
+    classes = chunk['classification'][keep]
+    ground = classes == GROUND_CLASS
+    segs = grid['cell_segment'][cells]
+    n_segments = len(acc['seg_points'])
+    n_cells = len(acc['cell_points'])
+
+    acc['seg_points'] += np.bincount(segs, minlength=n_segments)
+    acc['cell_points'] += np.bincount(cells, minlength=n_cells)
+    np.maximum.at(acc['cell_max_z'], cells, z)
+
+    n_bins = acc['seg_hist'].shape[1]
+    bins = np.clip(((z - HIST_MIN_Z) / HIST_STEP_Z).astype(np.int64), 0, n_bins - 1)
+    np.add.at(acc['seg_hist'], (segs, bins), 1)
+    acc['cell_water_n'] += np.bincount(cells[classes == WATER_CLASS], minlength=n_cells)
+
+    if not ground.any():
+        return
+    g_cells, g_z, g_segs = cells[ground], z[ground], segs[ground]
+    np.minimum.at(acc['cell_ground_min_z'], g_cells, g_z)
+    acc['cell_ground_n'] += np.bincount(g_cells, minlength=n_cells)
+    acc['cell_ground_sum'] += np.bincount(g_cells, weights=g_z, minlength=n_cells)
+
+    # Chan et al. merge of the chunk's per-segment (n, mean, M2) into the running Welford state
+    n_b = np.bincount(g_segs, minlength=n_segments)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_b = np.bincount(g_segs, weights=g_z, minlength=n_segments) / n_b
+    m2_b = np.bincount(g_segs, weights=(g_z - mean_b[g_segs]) ** 2, minlength=n_segments)
+    has_b = n_b > 0
+    n_a = acc['seg_ground_n']
+    n = n_a + n_b
+    delta = np.where(has_b, mean_b - acc['seg_ground_mean'], 0.0)
+    safe_n = np.maximum(n, 1)
+    acc['seg_ground_mean'] = np.where(has_b, acc['seg_ground_mean'] + delta * n_b / safe_n, acc['seg_ground_mean'])
+    acc['seg_ground_m2'] = acc['seg_ground_m2'] + np.where(has_b, m2_b + delta ** 2 * n_a * n_b / safe_n, 0.0)
+    acc['seg_ground_n'] = n
+
+
+def _histogram_quantile(hist, q):
+    """Per-row quantile (bin centre) from a 2-D histogram; NaN for empty rows."""
+    cumulative = np.cumsum(hist, axis=1)
+    totals = cumulative[:, -1]
+    idx = (cumulative < (q * totals)[:, None]).sum(axis=1)
+    values = HIST_MIN_Z + (np.minimum(idx, hist.shape[1] - 1) + 0.5) * HIST_STEP_Z
+    return np.where(totals > 0, values, np.nan)
+
+
+def _water_distance(acc, grid, cell_ground_mean, has_ground, n_segments):
+    """
+    Distance from each ground cell's centre to the nearest water cell (NaN if there is none).
+
+    Water cells are those with class 9 returns. Segments without any stand in
+    their lowest LOW_GROUND_FRACTION of ground cells by elevation, where the
+    channel and wet ground usually are.
+    """
+    cell_segment = grid['cell_segment']
+    water = acc['cell_water_n'] > 0
+    segment_has_water = np.bincount(cell_segment[water], minlength=n_segments) > 0
+
+    # Rank the ground cells of each segment by elevation
+    ground = np.flatnonzero(has_ground)
+    order = ground[np.lexsort((cell_ground_mean[ground], cell_segment[ground]))]
+    counts = np.bincount(cell_segment[order], minlength=n_segments)
+    rank = np.arange(len(order)) - np.repeat(np.cumsum(counts) - counts, counts)
+    low = order[rank < np.ceil(LOW_GROUND_FRACTION * counts[cell_segment[order]])]
+    water[low[~segment_has_water[cell_segment[low]]]] = True
+
+    distance = np.full(len(cell_segment), np.nan)
+    if not water.any() or not len(ground):
+        return distance
+    cell_ids, nx, size = grid['cell_ids'], grid['nx'], grid['cell_size']
+    centres = shapely.points(grid['x0'] + (cell_ids % nx + 0.5) * size, grid['y0'] + (cell_ids // nx + 0.5) * size)
+    (ground_idx, _), distances = shapely.STRtree(centres[water]).query_nearest(
+        centres[ground], return_distance=True, all_matches=False)
+    distance[ground[ground_idx]] = distances
+    return distance
+
+
+def _finalize_features(acc, grid, n_segments, anomaly_sigma):
+    """Turns the accumulators into the per-segment feature columns."""
+    cell_segment = grid['cell_segment']
+    cells_per_segment = np.bincount(cell_segment, minlength=n_segments)
+
+    def per_segment_mean(values, mask):
+        total = np.bincount(cell_segment[mask], weights=values[mask], minlength=n_segments)
+        count = np.bincount(cell_segment[mask], minlength=n_segments)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return total / count, count
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        terrain_variance = np.where(acc['seg_ground_n'] > 1, acc['seg_ground_m2'] / (acc['seg_ground_n'] - 1), np.nan)
+        ground_mean = np.where(acc['seg_ground_n'] > 0, acc['seg_ground_mean'], np.nan)
+
+        has_ground = acc['cell_ground_n'] > 0
+        canopy_height = np.where(has_ground, acc['cell_max_z'] - acc['cell_ground_min_z'], 0.0)
+        canopy_mean, _ = per_segment_mean(canopy_height, has_ground)
+        canopy_sq_mean, ground_cells = per_segment_mean(canopy_height ** 2, has_ground)
+        canopy_std = np.sqrt(np.maximum(canopy_sq_mean - canopy_mean ** 2, 0.0))
+
+        cell_ground_mean = acc['cell_ground_sum'] / np.maximum(acc['cell_ground_n'], 1)
+        seg_std = np.sqrt(terrain_variance)
+        deviation = np.abs(cell_ground_mean - ground_mean[cell_segment])
+        anomalous = has_ground & (deviation > anomaly_sigma * seg_std[cell_segment])
+        anomaly_score = np.bincount(cell_segment[anomalous], minlength=n_segments) / ground_cells
+
+        cell_water_distance = _water_distance(acc, grid, cell_ground_mean, has_ground, n_segments)
+        water_distance, _ = per_segment_mean(cell_water_distance, has_ground)
+        covered_fraction = np.bincount(cell_segment[acc['cell_points'] > 0], minlength=n_segments) / cells_per_segment
+
+    return {
+        'point_count': acc['seg_points'],
+        'ground_point_count': acc['seg_ground_n'],
+        'covered_fraction': covered_fraction,
+        'ground_mean_z': ground_mean,
+        'terrain_variance': terrain_variance,
+        'canopy_mean_height': canopy_mean,
+        'canopy_stddev': canopy_std,
+        'water_distance_m': water_distance,
+        'anomaly_score': anomaly_score,
+        'z_p05': _histogram_quantile(acc['seg_hist'], 0.05),
+        'z_p50': _histogram_quantile(acc['seg_hist'], 0.50),
+        'z_p95': _histogram_quantile(acc['seg_hist'], 0.95),
+    }
+
+
+def extract_segment_features(segments_with_lidar_path, output_path, target_crs=None,
+                             buffer_distance_m=250, cell_size_m=10, chunk_size=DEFAULT_CHUNK_SIZE,
+                             anomaly_sigma=2.0, known_sites_path=None, known_site_radii_m=DEFAULT_COUNT_RADII_M,
+                             assumed_tile_crs=None):
+    """
+    Computes per-segment emission features by streaming the matched LiDAR tiles.
+
+    Features per segment:
+        point_count / ground_point_count: returns inside the segment's cells.
+        covered_fraction: share of the segment's cells with at least one return.
+        ground_mean_z / terrain_variance: Welford mean and variance of ground (class 2) elevations.
+        canopy_mean_height / canopy_stddev: per-cell (max return - lowest ground) heights.
+        water_distance_m: mean distance of cells with ground returns from the nearest water cell:
+            cells with class 9 returns, or a segment's lowest ground cells if it has none.
+        anomaly_score: share of ground cells more than anomaly_sigma std-devs from the segment mean.
+        z_p05 / z_p50 / z_p95: elevation quantiles from the running histogram.
+    Circularity is a shape measure and comes from morphometric_detector, not this stage.
+    Segments without LiDAR keep NaN features. With known_sites_path, the
+    known_sites proximity columns (nearest_known_site_m, known_sites_<r>km) are added too.
+
+    Args:
+        segments_with_lidar_path (str): Output of match_lidar_to_segments.
+        output_path (str): Where to write the per-segment feature GeoParquet.
+        target_crs (str, optional): Projected CRS the segments and points are processed in.
+            Defaults to the WGS 84 UTM zone of the segments' extent.
+        buffer_distance_m (float): Half-width of the observed area around each segment.
+        cell_size_m (float): Cell size of the aggregation grid.
+        chunk_size (int): Points decoded per chunk.
+        anomaly_sigma (float): Threshold for anomaly_score.
+        known_sites_path (str, optional): archaeogeodesy.xls to cross-check segments against.
+        known_site_radii_m (tuple): Radii of the known-site counts.
+        assumed_tile_crs (str or dict, optional): CRS of tiles without a header CRS; defaults
+            to the tile inventory (see point_stream.assumed_tile_crs_for).
+
+    Returns:
+        geopandas.GeoDataFrame: Segments with the feature columns.
+    """
+    print(f"Loading matched segments from: {segments_with_lidar_path}")
+    segments_gdf = read_geotable(segments_with_lidar_path)
+    if segments_gdf.crs is None:
+        target_crs = target_crs or "EPSG:32722"
+        segments_gdf = segments_gdf.set_crs(target_crs)
+    elif target_crs is None:
+        target_crs = estimate_utm_crs(segments_gdf)
+    if segments_gdf.crs.to_string().upper() != target_crs.upper():
+        segments_gdf = segments_gdf.to_crs(target_crs)
+    segments_gdf = segments_gdf.reset_index(drop=True)
+    file_lists = segments_gdf['lidar_file_paths'].apply(parse_lidar_file_paths)
+    tiles = sorted({f for files in file_lists for f in files})
+
+    print(f"Building {cell_size_m} m cell grid over {buffer_distance_m} m segment buffers...")
+    grid = build_segment_cell_grid(segments_gdf, buffer_distance_m, cell_size_m)
+    acc = _new_accumulators(len(segments_gdf), len(grid['cell_segment']))
+    print(f"Grid has {len(grid['cell_segment'])} cells for {len(segments_gdf)} segments.")
+
+    for laz_file in tiles:
+        if not os.path.exists(laz_file):
+            print(f"Warning: LiDAR file {laz_file} not found. Skipping.")
+            continue
+        print(f"Streaming points from {os.path.basename(laz_file)}...")
+        try:
+            for chunk in iter_points_in_area(laz_file, grid['area'], target_crs, chunk_size=chunk_size,
+                                             assumed_crs=assumed_tile_crs):
+                _accumulate_chunk(acc, grid, chunk)
+        except Exception as e:
+            print(f"Error streaming {laz_file}: {e}. Skipping the rest of this tile.")
+
+    features = _finalize_features(acc, grid, len(segments_gdf), anomaly_sigma)
+    features_gdf = segments_gdf.drop(columns=['lidar_file_paths'])
+    for column in FEATURE_COLUMNS:
+        features_gdf[column] = features[column]
+    if known_sites_path:
+        features_gdf = annotate_known_sites(features_gdf, load_known_sites(known_sites_path), radii_m=known_site_radii_m)
+
+    print(f"Saving segment features to: {output_path}")
+    write_geotable(features_gdf, output_path)
+    observed = int((features_gdf['point_count'] > 0).sum())
+    print(f"Extracted features for {observed} out of {len(features_gdf)} segments.")
+    return features_gdf
+
+
+if __name__ == "__main__":
+    # Configuration
+    base_dir = "/Users/anyadecarlo/TuesdayAppointment"
+    matched_segments_file = os.path.join(base_dir, "gis_outputs", "river_segments_with_lidar.parquet")
+    features_output_file = os.path.join(base_dir, "gis_outputs", "river_segment_features.parquet")
+    known_sites_xls = os.path.join(base_dir, KNOWN_SITES_XLS)
+
+    if not os.path.exists(matched_segments_file):
+        print(f"ERROR: Matched segments file not found: {matched_segments_file}")
+        print("Please run match_lidar_to_segments.py first.")
+    else:
+        extract_segment_features(matched_segments_file, features_output_file,
+                                 known_sites_path=known_sites_xls if os.path.exists(known_sites_xls) else None)
@@ -0,0 +1,198 @@
+import sqlite3
+import os
+
+# Sidecar catalog stored next to the .laz files. One row per tile with the
+# header-derived metadata, plus one row per (tile, target CRS) with the
+# reprojected footprint, so reruns only probe files whose size or mtime changed.
+# A third table memoises full-content hashes of tiles (see
+# raster_cache.tile_fingerprint) under the same size/mtime signature.
+CATALOG_FILENAME = ".tile_catalog.sqlite"
+CATALOG_SCHEMA_VERSION = 1
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS tiles (
+    file_name   TEXT PRIMARY KEY,
+    file_size   INTEGER NOT NULL,
+    mtime_ns    INTEGER NOT NULL,
+    minx        REAL NOT NULL,
+    miny        REAL NOT NULL,
+    maxx        REAL NOT NULL,
+    maxy        REAL NOT NULL,
+    native_crs  TEXT,
+    point_count INTEGER
+);
+CREATE TABLE IF NOT EXISTS footprints (
+    file_name     TEXT NOT NULL REFERENCES tiles(file_name) ON DELETE CASCADE,
+    target_crs    TEXT NOT NULL,
+    footprint_wkb BLOB NOT NULL,
+    PRIMARY KEY (file_name, target_crs)
+);
+CREATE TABLE IF NOT EXISTS content_hashes (
+    file_name    TEXT PRIMARY KEY,
+    file_size    INTEGER NOT NULL,
+    mtime_ns     INTEGER NOT NULL,
+    content_hash TEXT NOT NULL
+);
+"""
+
+
+def open_tile_catalog(lidar_data_dir, catalog_filename=CATALOG_FILENAME):
+    """
+    Opens (creating if needed) the tile catalog sidecar in a LiDAR directory.
+
+    A catalog written by a different schema version is discarded and rebuilt.
+
+    Args:
+        lidar_data_dir (str): Directory containing the .laz files.
+        catalog_filename (str): Name of the SQLite sidecar file.
+
+    Returns:
+        sqlite3.Connection: Open connection to the catalog.
+    """
+    catalog_path = os.path.join(lidar_data_dir, catalog_filename)
+    conn = sqlite3.connect(catalog_path)
+    conn.execute("PRAGMA foreign_keys = ON")
+    if conn.execute("PRAGMA user_version").fetchone()[0] != CATALOG_SCHEMA_VERSION:
+        conn.executescript("DROP TABLE IF EXISTS footprints; DROP TABLE IF EXISTS tiles;")
+        conn.execute(f"PRAGMA user_version = {CATALOG_SCHEMA_VERSION}")
+    conn.executescript(_SCHEMA)
+    return conn
+
+
+def file_signature(file_path):
+    """
+    Returns the (size, mtime_ns) pair used to detect changed tiles.
+
+    Args:
+        file_path (str): Path to the tile.
+
+    Returns:
+        tuple: (file_size, mtime_ns)
+    """
+    st = os.stat(file_path)
+    return st.st_size, st.st_mtime_ns
+
+
+def load_tile_records(conn, target_crs):
+    """
+    Loads every catalogued tile together with its footprint in target_crs.
+
+    Args:
+        conn (sqlite3.Connection): Open catalog connection.
+        target_crs (str): CRS the footprints are wanted in (e.g., "EPSG:32722").
+
+    Returns:
+        dict: file_name -> {
+            'file_size', 'mtime_ns', 'bounds', 'native_crs', 'point_count',
+            'footprint_wkb' (bytes or None if not yet computed for target_crs)
+        }
+    """
+    rows = conn.execute(
+        """
+        SELECT t.file_name, t.file_size, t.mtime_ns, t.minx, t.miny, t.maxx, t.maxy,
+               t.native_crs, t.point_count, f.footprint_wkb
+        FROM tiles t
+        LEFT JOIN footprints f ON f.file_name = t.file_name AND f.target_crs = ?
+        """,
+        (target_crs.upper(),),
+    )
+    records = {}
+    for file_name, size, mtime_ns, minx, miny, maxx, maxy, native_crs, point_count, wkb in rows:
+        records[file_name] = {
+            'file_size': size,
+            'mtime_ns': mtime_ns,
+            'bounds': {'minx': minx, 'miny': miny, 'maxx': maxx, 'maxy': maxy},
+            'native_crs': native_crs,
+            'point_count': point_count,
+            'footprint_wkb': wkb,
+        }
+    return records
+
+
+def save_tile_records(conn, records, target_crs):
+    """
+    Inserts or replaces tile rows and their footprints in target_crs.
+
+    Replacing a tile row drops the footprints cached for every other CRS,
+    since they were derived from the old file contents.
+
+    Args:
+        conn (sqlite3.Connection): Open catalog connection.
+        records (dict): file_name -> record as returned by load_tile_records.
+        target_crs (str): CRS of the 'footprint_wkb' values.
+    """
+    with conn:
+        for file_name, rec in records.items():
+            b = rec['bounds']
+            conn.execute("DELETE FROM tiles WHERE file_name = ?", (file_name,))
+            conn.execute(
+                "INSERT INTO tiles VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (file_name, rec['file_size'], rec['mtime_ns'], b['minx'], b['miny'], b['maxx'], b['maxy'],
+                 rec['native_crs'], rec['point_count']),
+            )
+            if rec.get('footprint_wkb') is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO footprints VALUES (?, ?, ?)",
+                    (file_name, target_crs.upper(), rec['footprint_wkb']),
+                )
+
+
+def save_footprints(conn, footprints, target_crs):
+    """
+    Stores footprints for tiles whose header metadata is already catalogued.
+
+    Args:
+        conn (sqlite3.Connection): Open catalog connection.
+        footprints (dict): file_name -> footprint WKB bytes.
+        target_crs (str): CRS of the footprints.
+    """
+    with conn:
+        conn.executemany(
+            "INSERT OR REPLACE INTO footprints VALUES (?, ?, ?)",
+            [(file_name, target_crs.upper(), wkb) for file_name, wkb in footprints.items()],
+        )
+
+
+def prune_tile_records(conn, existing_file_names):
+    """
+    Removes catalog rows for tiles that no longer exist on disk.
+
+    Args:
+        conn (sqlite3.Connection): Open catalog connection.
+        existing_file_names (iterable): File names currently present.
+
+    Returns:
+        int: Number of rows removed.
+    """
+    existing = set(existing_file_names)
+    stale = [(name,) for (name,) in conn.execute("SELECT file_name FROM tiles") if name not in existing]
+    if stale:
+        with conn:
+            conn.executemany("DELETE FROM tiles WHERE file_name = ?", stale)
+    return len(stale)
+
+
+def load_content_hash(conn, file_name, file_size, mtime_ns):
+    """
+    Returns the memoised content hash of a tile, or None if missing or the file has changed since.
+
+    Args:
+        conn (sqlite3.Connection): Open catalog connection.
+        file_name (str): Tile file name.
+        file_size (int), mtime_ns (int): Current signature, see file_signature.
+
+    Returns:
+        str or None: Hex digest.
+    """
+    row = conn.execute(
+        "SELECT content_hash FROM content_hashes WHERE file_name = ? AND file_size = ? AND mtime_ns = ?",
+        (file_name, file_size, mtime_ns),
+    ).fetchone()
+    return row[0] if row else None
+
+
+def save_content_hash(conn, file_name, file_size, mtime_ns, content_hash):
+    """Memoises a tile's content hash under its current (size, mtime) signature."""
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO content_hashes VALUES (?, ?, ?, ?)",
+                     (file_name, file_size, mtime_ns, content_hash))